@@ -0,0 +1,215 @@
+#!/usr/bin/env python
+
+# Copyright (c) 2013 Calin Crisan
+# This file is part of motionEye.
+#
+# motionEye is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+# compares the media scanner, with scandir and with its listdir() fallback, with the former listing
+# (a recursive listdir()/lstat() in a subprocess, sending each file through a pipe as a separate dict,
+# polled every 0.5s), on synthetic trees laid out
+# like the motion target dirs: one dir per day, holding pictures and a movie every 10 pictures;
+# the trees are made once, under the given dir, and reused by the following runs;
+# each listing is run once before being measured, so that both are measured against a warm dentry cache;
+# usage: python benchmarks/mediascan.py [dir] [files...]
+
+import datetime
+import multiprocessing
+import os.path
+import resource
+import stat
+import sys
+import time
+
+_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, _ROOT)
+sys.path.insert(0, os.path.join(_ROOT, 'motioneye'))
+
+from tornado.ioloop import IOLoop
+
+import mediafiles
+import mediascan
+
+
+_FILES_PER_DIR = 1000
+_COMPLETE_FILE_NAME = '.complete'
+
+
+def make_tree(path, count):
+    # the names and times of the files only depend on their number, so that the trees are always the same
+    if os.path.exists(os.path.join(path, _COMPLETE_FILE_NAME)):
+        return
+
+    print 'making a tree of %s files in %s...' % (count, path)
+
+    start = datetime.datetime(2020, 1, 1)
+    for i in xrange(count):
+        moment = start + datetime.timedelta(days=i / _FILES_PER_DIR, seconds=(i % _FILES_PER_DIR) * 60)
+        dir_path = os.path.join(path, moment.strftime('%Y-%m-%d'))
+        if i % _FILES_PER_DIR == 0 and not os.path.isdir(dir_path):
+            os.makedirs(dir_path)
+
+        ext = 'avi' if i % 10 == 9 else 'jpg'
+        file_path = os.path.join(dir_path, '%s-%02d.%s' % (moment.strftime('%H-%M-%S'), i % 100, ext))
+        with open(file_path, 'w'):
+            pass
+
+        t = time.mktime(moment.timetuple())
+        os.utime(file_path, (t, t))
+
+    open(os.path.join(path, _COMPLETE_FILE_NAME), 'w').close()
+
+
+def former_listing(target_dir, on_first, callback):
+    def find_files(path):
+        files = []
+        for name in os.listdir(path):
+            if name.startswith('.') or name == 'lastsnap.jpg':
+                continue
+
+            full_path = os.path.join(path, name)
+            st = os.lstat(full_path)
+            if stat.S_ISDIR(st.st_mode):
+                files.extend(find_files(full_path))
+
+            elif stat.S_ISREG(st.st_mode):
+                files.append((full_path, st))
+
+        return files
+
+    def do_list(pipe):
+        for (full_path, st) in find_files(target_dir):
+            if mediafiles.get_media_type(full_path):
+                pipe.send({'path': full_path[len(target_dir):], 'timestamp': st.st_mtime, 'size': st.st_size})
+
+        pipe.close()
+
+    (parent_pipe, child_pipe) = multiprocessing.Pipe(duplex=False)
+    process = multiprocessing.Process(target=do_list, args=(child_pipe, ))
+    process.start()
+
+    media_list = []
+    io_loop = IOLoop.instance()
+
+    def read_media_list():
+        try:
+            while parent_pipe.poll():
+                media_list.append(parent_pipe.recv())
+
+        except EOFError: # the subprocess has finished
+            pass
+
+        if media_list:
+            on_first()
+
+    def poll_process():
+        if process.is_alive():
+            read_media_list()
+            io_loop.add_timeout(datetime.timedelta(seconds=0.5), poll_process)
+
+        else:
+            read_media_list()
+            process.join()
+            callback(len(media_list))
+
+    poll_process()
+
+
+def scanner_listing(target_dir, on_first, callback):
+    def iter_media_files():
+        for batch in mediascan.walk(target_dir, accept=mediafiles.get_media_type):
+            yield [(p[len(target_dir):], st.st_mtime, st.st_size) for (p, st) in batch]
+
+    media_list = []
+
+    def on_batch(batch):
+        media_list.extend(batch)
+        on_first()
+
+    def on_done(error):
+        if error:
+            raise Exception(error)
+
+        callback(len(media_list))
+
+    mediascan.run(iter_media_files, on_batch=on_batch, on_done=on_done)
+
+
+def fallback_listing(target_dir, on_first, callback):
+    # the scanner without scandir; the subprocess is forked with the module as it is at that moment
+    scandir = mediascan.scandir
+    mediascan.scandir = None
+    try:
+        scanner_listing(target_dir, on_first, callback)
+
+    finally:
+        mediascan.scandir = scandir
+
+
+def run(listing, target_dir):
+    io_loop = IOLoop.instance()
+    result = {'first': None, 'count': 0}
+
+    def on_first():
+        if result['first'] is None:
+            result['first'] = time.time()
+
+    def on_done(count):
+        result['count'] = count
+        io_loop.stop()
+
+    usage = resource.getrusage(resource.RUSAGE_SELF)
+    cpu = usage.ru_utime + usage.ru_stime
+    usage = resource.getrusage(resource.RUSAGE_CHILDREN)
+    child_cpu = usage.ru_utime + usage.ru_stime
+    start = time.time()
+
+    io_loop.add_callback(listing, target_dir, on_first, on_done)
+    io_loop.start()
+
+    duration = time.time() - start
+    usage = resource.getrusage(resource.RUSAGE_SELF)
+    cpu = usage.ru_utime + usage.ru_stime - cpu
+    usage = resource.getrusage(resource.RUSAGE_CHILDREN)
+    child_cpu = usage.ru_utime + usage.ru_stime - child_cpu
+
+    return (result['count'], duration, (result['first'] or start) - start, cpu, child_cpu)
+
+
+def main():
+    base_dir = sys.argv[1] if len(sys.argv) > 1 else '/tmp/motioneye-mediascan-benchmark'
+    counts = [int(a) for a in sys.argv[2:]] or [10000, 100000, 1000000]
+
+    for count in counts:
+        target_dir = os.path.join(base_dir, str(count))
+        make_tree(target_dir, count)
+
+        print 'tree of %s files:' % count
+        listings = [former_listing, scanner_listing]
+        if mediascan.scandir:
+            listings.append(fallback_listing)
+
+        else:
+            print 'scandir is not installed, the scanner uses its listdir() fallback'
+
+        for listing in listings:
+            run(listing, target_dir)
+            (found, duration, first, cpu, child_cpu) = run(listing, target_dir)
+
+            print '%-16s %8d files %8.2f s total %8.2f s to first files %8.2f s CPU (IO loop) %8.2f s CPU (subprocess)' % (
+                    listing.__name__, found, duration, first, cpu, child_cpu)
+
+
+if __name__ == '__main__':
+    main()
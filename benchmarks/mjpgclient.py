@@ -0,0 +1,170 @@
+#!/usr/bin/env python
+
+# Copyright (c) 2013 Calin Crisan
+# This file is part of motionEye.
+#
+# motionEye is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+# compares the multipart parser of the mjpg client with the former
+# read_until()/read_bytes() chain, against a local stand-in mjpg server;
+# the clients take turns, in alternating order, and the best of the rounds is reported for each;
+# usage: python benchmarks/mjpgclient.py [frames] [frame_size] [rounds]
+
+import multiprocessing
+import os.path
+import re
+import resource
+import socket
+import sys
+import time
+
+_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, _ROOT)
+sys.path.insert(0, os.path.join(_ROOT, 'motioneye'))
+
+from tornado.ioloop import IOLoop
+from tornado.iostream import IOStream
+
+import mjpgclient
+
+
+_BOUNDARY = 'BoundaryString'
+
+
+def serve(server_socket, frames, frame_size):
+    # a stand-in for the motion streaming server, sending frames as fast as possible
+    jpg = '\xff\xd8' + os.urandom(frame_size - 4).replace('\xff', '\x00') + '\xff\xd9'
+    part = '--%s\r\nContent-type: image/jpeg\r\nContent-Length: %s\r\n\r\n%s\r\n\r\n' % (_BOUNDARY, len(jpg), jpg)
+
+    while True:
+        conn, addr = server_socket.accept()  # @UnusedVariable
+        conn.recv(1024)
+        conn.sendall('HTTP/1.0 200 OK\r\nContent-Type: multipart/x-mixed-replace; boundary=%s\r\n\r\n' % _BOUNDARY)
+
+        try:
+            for i in xrange(frames):  # @UnusedVariable
+                conn.sendall(part)
+
+        except socket.error:
+            pass
+
+        conn.close()
+
+
+class ChainClient(IOStream):
+    # the former way of reading frames: one read_until()/read_bytes() chain per frame
+
+    def __init__(self, port, on_jpg):
+        IOStream.__init__(self, socket.socket(socket.AF_INET, socket.SOCK_STREAM, 0))
+        self.connect(('127.0.0.1', port), self._on_connect)
+        self._on_jpg = on_jpg
+
+    def _on_connect(self):
+        self.write('GET / HTTP/1.0\r\n\r\n')
+        self.read_until_regex('HTTP/1.\d \d+ ', self._on_http)
+
+    def _on_http(self, data):
+        self._seek_content_length()
+
+    def _seek_content_length(self):
+        self.read_until('Content-Length:', self._on_before_content_length)
+
+    def _on_before_content_length(self, data):
+        self.read_until('\r\n\r\n', self._on_content_length)
+
+    def _on_content_length(self, data):
+        length = int(re.findall('(\d+)', data)[0])
+        self.read_bytes(length, self._on_jpg_data)
+
+    def _on_jpg_data(self, data):
+        self._on_jpg(data)
+        self._seek_content_length()
+
+
+class ParserClient(IOStream):
+    # the current way of reading frames: the multipart parser of the mjpg client
+
+    def __init__(self, port, on_jpg):
+        IOStream.__init__(self, socket.socket(socket.AF_INET, socket.SOCK_STREAM, 0), read_chunk_size=65536)
+        self.connect(('127.0.0.1', port), self._on_connect)
+        self._parser = mjpgclient.MjpgParser(self, on_jpg, self._on_error)
+
+    def _on_connect(self):
+        self.write('GET / HTTP/1.0\r\n\r\n')
+        self.read_until_regex('HTTP/1.\d \d+ ', self._on_http)
+
+    def _on_http(self, data):
+        self._parser.start()
+
+    def _on_error(self, error):
+        raise Exception(error)
+
+
+def run(client_class, port, frames):
+    io_loop = IOLoop.instance()
+    received = [0]
+
+    def on_jpg(jpg):
+        received[0] += 1
+        if received[0] == frames:
+            io_loop.stop()
+
+    usage = resource.getrusage(resource.RUSAGE_SELF)
+    cpu = usage.ru_utime + usage.ru_stime
+    start = time.time()
+
+    client = client_class(port, on_jpg)
+    io_loop.start()
+    client.close()
+
+    duration = time.time() - start
+    usage = resource.getrusage(resource.RUSAGE_SELF)
+    cpu = usage.ru_utime + usage.ru_stime - cpu
+
+    return (frames / duration, 1000000 * cpu / frames)
+
+
+def main():
+    frames = int(sys.argv[1]) if len(sys.argv) > 1 else 5000
+    frame_size = int(sys.argv[2]) if len(sys.argv) > 2 else 50000
+    rounds = int(sys.argv[3]) if len(sys.argv) > 3 else 5
+
+    server_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM, 0)
+    server_socket.bind(('127.0.0.1', 0))
+    server_socket.listen(1)
+    port = server_socket.getsockname()[1]
+
+    # the server runs in a separate process, so that it doesn't count towards the measured CPU time
+    server = multiprocessing.Process(target=serve, args=(server_socket, frames, frame_size))
+    server.daemon = True
+    server.start()
+
+    print 'frame size: %s bytes' % frame_size
+
+    client_classes = [ChainClient, ParserClient]
+    results = dict((client_class, []) for client_class in client_classes)
+    for i in xrange(rounds):
+        for client_class in (client_classes if i % 2 == 0 else reversed(client_classes)):
+            results[client_class].append(run(client_class, port, frames))
+
+    for client_class in client_classes:
+        print '%-12s %8d frames %10.1f frames/s %10.1f us CPU/frame' % (
+                client_class.__name__, frames, max(r[0] for r in results[client_class]),
+                min(r[1] for r in results[client_class]))
+
+    server.terminate()
+
+
+if __name__ == '__main__':
+    main()
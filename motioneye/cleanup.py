@@ -20,23 +20,37 @@ import logging
 import multiprocessing
 import os
 import signal
+import time
 
 from tornado.ioloop import IOLoop
 
+import config
 import mediafiles
+import mediaindex
 import settings
+import utils
 
 
+_CHECK_INTERVAL = 10 # seconds between the checks of the storage quotas
+_QUOTA_SLACK = 0.05 # the part of a quota freed in addition, so that files are not removed one at a time
+
 _process = None
+_next_cleanup = None # when the files older than their preserve period are to be removed next
+
+# the ids of the cameras whose quota could not be checked, as their media index is not ready
+_unchecked_ids = set()
 
 
 def start():
-    if not settings.CLEANUP_INTERVAL:
-        return
+    global _next_cleanup
+
+    # the quotas are checked even when the files are never removed because of their age
+    if settings.CLEANUP_INTERVAL:
+        # schedule the first cleanup a bit later to improve performance at startup
+        _next_cleanup = time.time() + min(settings.CLEANUP_INTERVAL, 60)
 
-    # schedule the first call a bit later to improve performance at startup
     io_loop = IOLoop.instance()
-    io_loop.add_timeout(datetime.timedelta(seconds=min(settings.CLEANUP_INTERVAL, 60)), _run_process)
+    io_loop.add_timeout(datetime.timedelta(seconds=_CHECK_INTERVAL), _check)
 
 
 def stop():
@@ -60,22 +74,104 @@ def running():
     return _process is not None and _process.is_alive()
 
 
-def _run_process():
+def _check():
+    # the quotas are checked often, using the media index and the file system stats,
+    # but the files are only looked at by the cleanup process
     global _process
-    
+    global _next_cleanup
+
     io_loop = IOLoop.instance()
-    
-    # schedule the next call
-    io_loop.add_timeout(datetime.timedelta(seconds=settings.CLEANUP_INTERVAL), _run_process)
+    io_loop.add_timeout(datetime.timedelta(seconds=_CHECK_INTERVAL), _check)
+
+    if running(): # check that the previous process has finished
+        return
+
+    now = time.time()
+    remove_old = _next_cleanup is not None and now >= _next_cleanup
+    if not remove_old and not _get_camera_excess() and not _get_device_excess():
+        return
+
+    if remove_old:
+        _next_cleanup = now + settings.CLEANUP_INTERVAL
+
+    logging.debug('running cleanup process...')
+
+    _process = multiprocessing.Process(target=_do_cleanup, args=(remove_old, ))
+    _process.start()
+
+
+def _get_local_cameras():
+    camera_configs = []
+    for camera_id in config.get_camera_ids():
+        camera_config = config.get_camera(camera_id)
+        if utils.local_motion_camera(camera_config):
+            camera_configs.append(camera_config)
 
-    if not running(): # check that the previous process has finished
-        logging.debug('running cleanup process...')
+    return camera_configs
 
-        _process = multiprocessing.Process(target=_do_cleanup)
-        _process.start()
 
+def _get_camera_excess(from_disk=False):
+    # returns a list of (camera configs, size) tuples, size being the number of bytes
+    # to be freed by removing the oldest media files of the cameras;
+    # the cameras whose media index is not ready are skipped, unless their files may be listed from disk
+    excess = []
+    for camera_config in _get_local_cameras():
+        max_size = camera_config.get('@max_media_size', 0) * 1024 * 1024
+        if not max_size:
+            continue # no limit
 
-def _do_cleanup():
+        total_size = mediaindex.get_total_size(camera_config)
+        if total_size is None and from_disk:
+            total_size = mediafiles.get_media_size(camera_config)
+
+        elif total_size is None:
+            if camera_config['@id'] not in _unchecked_ids:
+                logging.warning('the media index of camera %(id)s is not ready, its size limit cannot be checked yet' % {
+                        'id': camera_config['@id']})
+
+                _unchecked_ids.add(camera_config['@id'])
+
+            continue
+
+        _unchecked_ids.discard(camera_config['@id'])
+
+        if total_size > max_size:
+            excess.append(([camera_config], total_size - max_size * (1 - _QUOTA_SLACK)))
+
+    return excess
+
+
+def _get_device_excess():
+    # like _get_camera_excess(), for the storage devices without enough free space,
+    # along with all the cameras whose media is stored there
+    if not settings.CLEANUP_MIN_FREE_SPACE:
+        return []
+
+    devices = {}
+    for camera_config in _get_local_cameras():
+        target_dir = camera_config.get('target_dir')
+        try:
+            device = os.stat(target_dir).st_dev
+            if device not in devices:
+                st = os.statvfs(target_dir)
+                devices[device] = (st.f_bavail * st.f_frsize, [])
+
+        except OSError:
+            continue # not created yet
+
+        devices[device][1].append(camera_config)
+
+    excess = []
+    for (free_size, camera_configs) in devices.itervalues():
+        # there's nothing to be done once the media of the cameras is known to be gone
+        camera_configs = [c for c in camera_configs if mediaindex.get_total_size(c) != 0]
+        if camera_configs and free_size < settings.CLEANUP_MIN_FREE_SPACE:
+            excess.append((camera_configs, settings.CLEANUP_MIN_FREE_SPACE * (1 + _QUOTA_SLACK) - free_size))
+
+    return excess
+
+
+def _do_cleanup(remove_old):
     # this will be executed in a separate subprocess
     
     # ignore the terminate and interrupt signals in this subprocess
@@ -83,8 +179,22 @@ def _do_cleanup():
     signal.signal(signal.SIGTERM, signal.SIG_IGN)
     
     try:
-        mediafiles.cleanup_media('picture')
-        mediafiles.cleanup_media('movie')
+        if remove_old:
+            mediafiles.cleanup_media('picture')
+            mediafiles.cleanup_media('movie')
+
+        # the free space is checked only after the cameras are back within their limits,
+        # so the device excess is measured once the camera excess has been removed
+        for get_excess in [lambda: _get_camera_excess(from_disk=remove_old), _get_device_excess]:
+            for (camera_configs, size) in get_excess():
+                logging.debug('freeing %(size)s bytes of media of cameras %(ids)s...' % {
+                        'size': int(size), 'ids': ', '.join(str(c['@id']) for c in camera_configs)})
+
+                freed = mediafiles.remove_oldest_media(camera_configs, size)
+                if freed < size:
+                    logging.warning('could only free %(freed)s of %(size)s bytes of media of cameras %(ids)s' % {
+                            'freed': freed, 'size': int(size), 'ids': ', '.join(str(c['@id']) for c in camera_configs)})
+
         logging.debug('cleanup done')
          
     except Exception as e:
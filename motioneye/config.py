@@ -58,6 +58,10 @@ _EXPONENTIAL_QUALITY_FACTOR = 100000 # voodoo
 _EXPONENTIAL_DEF_QUALITY = 511 # about 75%
 _MAX_FFMPEG_VARIABLE_BITRATE = 32767
 
+# stream profiles are given as "name:width:quality" entries separated by commas;
+# the "full" profile, which serves the frames as they are, is always available
+_DEFAULT_STREAM_PROFILES = 'mobile:320:50,thumb:160:40'
+
 _KNOWN_MOTION_OPTIONS = set([
     'auto_brightness', 'brightness', 'contrast', 'emulate_motion', 'event_gap', 'ffmpeg_bps', 'ffmpeg_output_movies', 'ffmpeg_variable_bitrate', 'ffmpeg_video_codec',
     'framerate', 'height', 'hue', 'lightswitch', 'locate_motion_mode', 'locate_motion_style', 'minimum_motion_frames', 'movie_filename', 'max_movie_time', 'max_mpeg_time',
@@ -647,6 +651,7 @@ def motion_camera_ui_to_dict(ui, old_config=None):
         '@upload_subfolders': ui['upload_subfolders'],
         '@upload_username': ui['upload_username'],
         '@upload_password': ui['upload_password'],
+        '@max_media_size': int(float(ui['max_media_size']) * 1024),
         
         # text overlay
         'text_left': '',
@@ -660,6 +665,7 @@ def motion_camera_ui_to_dict(ui, old_config=None):
         'stream_quality': max(1, int(ui['streaming_quality'])),
         '@webcam_resolution': max(1, int(ui['streaming_resolution'])),
         '@webcam_server_resize': ui['streaming_server_resize'],
+        '@stream_profiles': ui['streaming_profiles'].replace(' ', ''),
         'stream_motion': ui['streaming_motion'],
         'stream_auth_method': {'disabled': 0, 'basic': 1, 'digest': 2}.get(ui['streaming_auth_mode'], 0),
         'stream_authentication': main_config['@normal_username'] + ':' + main_config['@normal_password'],
@@ -986,6 +992,7 @@ def motion_camera_dict_to_ui(data):
         'network_password': data['@network_password'],
         'disk_used': 0,
         'disk_total': 0,
+        'max_media_size': data['@max_media_size'] / 1024.0,
         'available_disks': diskctl.list_mounted_disks(),
         'upload_enabled': data['@upload_enabled'],
         'upload_picture': data['@upload_picture'],
@@ -1015,6 +1022,7 @@ def motion_camera_dict_to_ui(data):
         'streaming_quality': int(data['stream_quality']),
         'streaming_resolution': int(data['@webcam_resolution']),
         'streaming_server_resize': data['@webcam_server_resize'],
+        'streaming_profiles': data['@stream_profiles'],
         'streaming_port': int(data['stream_port']),
         'streaming_auth_mode': {0: 'disabled', 1: 'basic', 2: 'digest'}.get(data.get('stream_auth_method'), 'disabled'),
         'streaming_motion': int(data['stream_motion']),
@@ -1391,6 +1399,23 @@ def simple_mjpeg_camera_dict_to_ui(data):
     return ui
 
 
+def get_stream_profiles(camera_config):
+    profiles = {'full': None}
+    for entry in camera_config.get('@stream_profiles', _DEFAULT_STREAM_PROFILES).split(','):
+        if not entry:
+            continue
+
+        try:
+            name, width, quality = entry.split(':')
+            profiles[name] = (int(width), max(1, min(100, int(quality))))
+
+        except ValueError:
+            logging.warning('ignoring invalid stream profile "%(entry)s" of camera %(id)s' % {
+                    'entry': entry, 'id': camera_config.get('@id')})
+
+    return profiles
+
+
 def get_action_commands(camera_id):
     action_commands = {}
     for action in _ACTIONS:
@@ -1718,6 +1743,7 @@ def _set_default_motion_camera(camera_id, data):
     data.setdefault('@network_username', '')
     data.setdefault('@network_password', '')
     data.setdefault('target_dir', os.path.join(settings.MEDIA_PATH, data['@name']))
+    data.setdefault('@max_media_size', 0)
     data.setdefault('@upload_enabled', False)
     data.setdefault('@upload_picture', True)
     data.setdefault('@upload_movie', True)
@@ -1739,6 +1765,7 @@ def _set_default_motion_camera(camera_id, data):
 
     data.setdefault('@webcam_resolution', 100)
     data.setdefault('@webcam_server_resize', False)
+    data.setdefault('@stream_profiles', _DEFAULT_STREAM_PROFILES)
     
     data.setdefault('text_left', data['@name'])
     data.setdefault('text_right', '%Y-%m-%d\\n%T')
@@ -1793,6 +1820,13 @@ def _set_default_simple_mjpeg_camera(camera_id, data):
     data.setdefault('@name', 'Camera' + str(camera_id))
     data.setdefault('@id', camera_id)
 
+    # lightweight motion detection, done by motionEye itself
+    data.setdefault('@motion_detection', False)
+    data.setdefault('@motion_detection_rate', 2) # samples per second
+    data.setdefault('@motion_detection_cpu', 10) # percent of one cpu
+    data.setdefault('@motion_detection_threshold', 1.5) # percent of changed pixels
+    data.setdefault('@motion_detection_event_gap', 10) # seconds
+
     
 def get_additional_structure(camera, separators=False):
     if _additional_structure_cache.get((camera, separators)) is None:
@@ -15,14 +15,21 @@
 # You should have received a copy of the GNU General Public License
 # along with this program.  If not, see <http://www.gnu.org/licenses/>. 
 
+import collections
 import datetime
+import email.utils
+import functools
 import json
 import logging
 import os
 import re
 import socket
 import subprocess
+import threading
+import time
+import urllib
 
+from tornado import httputil
 from tornado.ioloop import IOLoop
 from tornado.web import RequestHandler, HTTPError, asynchronous
 
@@ -30,21 +37,34 @@ import config
 import mediafiles
 import mjpgclient
 import monitor
+import mosaic
 import motionctl
+import moviepreview
+import movieremux
 import powerctl
 import prefs
+import preparedcache
 import remote
 import settings
 import smbctl
 import tasks
 import template
+import thumbcache
+import timelapse
 import update
 import uploadservices
 import utils
 import v4l2ctl
+import zipstream
 
 
 class BaseHandler(RequestHandler):
+    _FILE_CHUNK_SIZE = 64 * 1024
+    _READ_AHEAD_CHUNKS = 4
+    _PREVIEWS_BOUNDARY = 'motioneyepreview'
+    _PREVIEWS_PAGE_SIZE = 100
+    _RANGE_REGEX = re.compile('^bytes=(\d*)-(\d*)$')
+
     def get_all_arguments(self):
         keys = self.request.arguments.keys()
         arguments = dict([(key, self.get_argument(key)) for key in keys])
@@ -105,6 +125,367 @@ class BaseHandler(RequestHandler):
         self.set_header('Content-Type', 'application/json')
         self.finish(json.dumps(data))
 
+    def etag_matches(self, etag):
+        if_none_match = self.request.headers.get('If-None-Match')
+        if not if_none_match:
+            return False
+
+        return if_none_match.strip() == '*' or if_none_match.find(etag) != -1
+
+    def get_media_list_params(self):
+        # returns the pagination parameters of a media list request,
+        # or None for a request of the whole list in the legacy format
+        names = ['sort', 'since', 'until', 'cursor', 'limit']
+        params = dict((n, self.get_argument(n, None)) for n in names)
+        if not [v for v in params.values() if v is not None]:
+            return None
+
+        params['sort'] = params['sort'] or '-time'
+        if params['sort'] not in ['time', '-time', 'size', '-size']:
+            raise HTTPError(400, 'invalid sort')
+
+        try:
+            params['since'] = params['since'] and float(params['since'])
+            params['until'] = params['until'] and float(params['until'])
+            params['limit'] = params['limit'] and int(params['limit'])
+
+        except ValueError:
+            raise HTTPError(400, 'invalid media list parameters')
+
+        if params['limit'] is not None and params['limit'] <= 0:
+            raise HTTPError(400, 'invalid media list parameters')
+
+        return params
+
+    def send_media_previews(self, camera_config, media_type):
+        # answers a request for the previews of several media files, given either as a list of paths
+        # or as a page of a group, with a multipart response holding a part for each available preview
+        try:
+            width = self.get_argument('width', None) and int(self.get_argument('width'))
+            height = self.get_argument('height', None) and int(self.get_argument('height'))
+
+        except ValueError:
+            raise HTTPError(400, 'invalid preview size')
+
+        if not width and not height:
+            raise HTTPError(400, 'missing preview size')
+
+        def send_previews(paths):
+            self.set_header('Content-Type', 'multipart/mixed; boundary=' + self._PREVIEWS_BOUNDARY)
+
+            def on_preview(path, content):
+                self.write('--%(boundary)s\r\nContent-Type: image/jpeg\r\nContent-Length: %(length)s\r\n' \
+                        'X-Path: %(path)s\r\n\r\n' % {
+                        'boundary': self._PREVIEWS_BOUNDARY, 'length': len(content),
+                        'path': urllib.quote(utils.make_str(path))})
+                self.write(content)
+                self.write('\r\n')
+                self.flush()
+
+            def on_done():
+                self.write('--%(boundary)s--\r\n' % {'boundary': self._PREVIEWS_BOUNDARY})
+                self.finish()
+
+            mediafiles.get_media_previews(camera_config, paths, media_type, width, height, on_preview, on_done)
+
+        paths = self.get_argument('paths', None)
+        if paths is not None:
+            if not isinstance(paths, list):
+                raise HTTPError(400, 'invalid paths')
+
+            if len(paths) > self._PREVIEWS_PAGE_SIZE:
+                raise HTTPError(400, 'too many paths')
+
+            return send_previews(paths)
+
+        def on_media_list(media_list, cursor=None):
+            if media_list is None:
+                return self.finish_json({'error': 'Failed to get media list.'})
+
+            self.set_header('X-Cursor', cursor or '') # of the next page
+            send_previews([m['path'] for m in media_list])
+
+        params = self.get_media_list_params() or {}
+        params['limit'] = params.get('limit') or self._PREVIEWS_PAGE_SIZE
+
+        try:
+            mediafiles.list_media_page(camera_config, media_type=media_type, callback=on_media_list,
+                    prefix=self.get_argument('prefix', None), **params)
+
+        except ValueError as e:
+            raise HTTPError(400, unicode(e))
+
+    def send_chunks(self, chunks):
+        # sends the pieces yielded by chunks one after the other; they are produced by a separate thread,
+        # at most _READ_AHEAD_CHUNKS ahead of what has been sent, so that slow disks don't block the IO loop
+        io_loop = IOLoop.instance()
+        self._chunks = collections.deque() # produced but not sent yet, None marking the end
+        self._chunk_sending = False
+        self._chunk_slots = threading.Semaphore(self._READ_AHEAD_CHUNKS)
+
+        def produce():
+            try:
+                while True:
+                    self._chunk_slots.acquire()
+                    if self._chunks is None: # connection closed
+                        break
+
+                    chunk = next(chunks, None)
+                    io_loop.add_callback(self.on_chunk_ready, chunk)
+                    if chunk is None:
+                        break
+
+            except IOError as e:
+                logging.error('failed to read data to be sent: %(msg)s' % {'msg': unicode(e)})
+                io_loop.add_callback(self.on_chunk_ready, None, error=True)
+
+            finally:
+                chunks.close()
+
+        thread = threading.Thread(target=produce)
+        thread.daemon = True
+        thread.start()
+
+    def on_chunk_ready(self, chunk, error=False):
+        if self._chunks is None:
+            return # connection closed
+
+        if error:
+            # the announced content length can't be honored anymore
+            self._chunks = None
+            return self.request.connection.close()
+
+        self._chunks.append(chunk)
+        self.send_next_chunk()
+
+    def send_next_chunk(self):
+        if self._chunk_sending or not self._chunks:
+            return
+
+        chunk = self._chunks.popleft()
+        if chunk is None:
+            self._chunks = None
+            return self.finish()
+
+        # only one flush may be pending at a time
+        self._chunk_sending = True
+        self.write(chunk)
+        self.flush(callback=self.on_chunk_flushed)
+
+    def on_chunk_flushed(self):
+        self._chunk_sending = False
+        self._chunk_slots.release()
+        if self._chunks is not None:
+            self.send_next_chunk()
+
+    def get_range(self, size):
+        # returns the (start, end) byte positions requested with a Range header (end included),
+        # or None for the whole content; multiple ranges are not supported, so they're ignored too,
+        # as are the invalid ranges and the ranges of an empty file
+        match = self._RANGE_REGEX.match(self.request.headers.get('Range', ''))
+        if not match or size == 0:
+            return None
+
+        (start, end) = match.groups()
+        if start:
+            start = int(start)
+            if end and int(end) < start:
+                return None
+
+            end = min(int(end), size - 1) if end else size - 1
+
+        elif end: # suffix range, the last bytes
+            start = max(0, size - int(end))
+            end = size - 1
+
+        else:
+            return None
+
+        if start > end or start >= size:
+            self.set_header('Content-Range', 'bytes */%s' % size)
+            raise HTTPError(416, 'range not satisfiable')
+
+        return (start, end)
+
+    def not_modified(self, etag, last_modified):
+        if self.request.headers.get('If-None-Match'):
+            return self.etag_matches(etag)
+
+        if_modified_since = self.request.headers.get('If-Modified-Since')
+        if if_modified_since:
+            if_modified_since = email.utils.parsedate(if_modified_since)
+            if if_modified_since:
+                return datetime.datetime(*if_modified_since[:6]) >= last_modified
+
+        return False
+
+    def send_file(self, path):
+        # sends a file without reading it all into memory, or just the part requested with a Range header;
+        # the file is validated by its modification time and size
+        f = open(path, 'rb')
+        st = os.fstat(f.fileno())
+        size = st.st_size
+        etag = '"%x-%x"' % (int(st.st_mtime), size)
+        last_modified = datetime.datetime.utcfromtimestamp(int(st.st_mtime))
+
+        self.set_header('Accept-Ranges', 'bytes')
+        self.set_header('ETag', etag)
+        self.set_header('Last-Modified', last_modified)
+
+        if self.not_modified(etag, last_modified):
+            f.close()
+            self.set_status(304)
+            return self.finish()
+
+        # a range is only valid for the version of the file it was computed for
+        if_range = self.request.headers.get('If-Range')
+        byte_range = None
+        if not if_range or if_range == etag or if_range == httputil.format_timestamp(last_modified):
+            try:
+                byte_range = self.get_range(size)
+
+            except:
+                f.close()
+                raise
+
+        if byte_range:
+            (start, end) = byte_range
+            self.set_status(206)
+            self.set_header('Content-Range', 'bytes %s-%s/%s' % (start, end, size))
+
+        else:
+            (start, end) = (0, size - 1)
+
+        self.set_header('Content-Length', end - start + 1)
+
+        def read_chunks():
+            remaining = end - start + 1
+            with f:
+                f.seek(start)
+                while remaining > 0:
+                    chunk = f.read(min(self._FILE_CHUNK_SIZE, remaining))
+                    if not chunk:
+                        raise IOError('file %s is shorter than expected' % path)
+
+                    remaining -= len(chunk)
+                    yield chunk
+
+        self.send_chunks(read_chunks())
+
+    def get_proxy_headers(self):
+        # the request headers passed on to a remote camera whose content is streamed
+        names = ['Range', 'If-Range', 'If-None-Match', 'If-Modified-Since']
+
+        return dict((name, self.request.headers[name]) for name in names if name in self.request.headers)
+
+    def sign_url(self, url):
+        # adds the authentication parameters of the current user to a GET url,
+        # for urls requested by the browser on its own (e.g. by a media player)
+        main_config = config.get_main()
+        if self.current_user == 'admin':
+            (username, password) = (main_config.get('@admin_username'), main_config.get('@admin_password'))
+
+        elif main_config.get('@normal_password'):
+            (username, password) = (main_config.get('@normal_username'), main_config.get('@normal_password'))
+
+        else: # no authentication required
+            return url
+
+        url += ('&' if '?' in url else '?') + '_username=' + urllib.quote(username, safe='')
+
+        return url + '&_signature=' + utils.compute_signature('GET', url, None, password)
+
+    def proxy_stream(self, camera_config, what, stream, content_type=None, content_disposition=None, error_status=None):
+        # passes on the content streamed from a remote camera by calling stream(on_headers, on_chunk, callback)
+        # (see remote._stream); the content type and disposition of the remote response are used unless given;
+        # the errors are answered with error_status, if given
+        self._proxy_flush_callbacks = []
+        self._proxy_closed = False
+        started = [False]
+
+        def on_headers(headers):
+            started[0] = True
+            self.set_status(headers['code'])
+            self.set_header('Content-Type', content_type or headers['content_type'])
+            if content_disposition or headers['content_disposition']:
+                self.set_header('Content-Disposition', content_disposition or headers['content_disposition'])
+
+            names = [('Content-Range', 'content_range'), ('Accept-Ranges', 'accept_ranges'),
+                    ('ETag', 'etag'), ('Last-Modified', 'last_modified')]
+
+            if headers['code'] in [200, 206]: # other answers have no body to be passed on
+                names.append(('Content-Length', 'content_length'))
+
+            for (name, key) in names:
+                if headers[key]:
+                    self.set_header(name, headers[key])
+
+        def on_response(error=None):
+            if error:
+                if started[0]: # too late to answer with an error
+                    return self.request.connection.close()
+
+                if error_status:
+                    self.set_status(error_status)
+
+                return self.finish_json({'error': 'Failed to download %(what)s from %(url)s: %(msg)s.' % {
+                        'what': what, 'url': remote.pretty_camera_url(camera_config), 'msg': error}})
+
+            if not self._proxy_closed:
+                self.finish()
+
+        stream(on_headers=on_headers, on_chunk=self.on_proxy_chunk, callback=on_response)
+
+    def on_proxy_chunk(self, chunk, callback):
+        if self._proxy_closed:
+            return callback() # nobody to send it to anymore
+
+        # a new flush replaces the callback of the pending one, so the callbacks are kept here
+        self._proxy_flush_callbacks.append(callback)
+        self.write(chunk)
+        self.flush(callback=self.on_proxy_chunk_flushed)
+
+    def on_proxy_chunk_flushed(self):
+        (callbacks, self._proxy_flush_callbacks) = (self._proxy_flush_callbacks, [])
+        for callback in callbacks:
+            callback()
+
+    def send_media_content(self, camera_config, filename, media_type, content_type):
+        if utils.local_motion_camera(camera_config):
+            full_path = mediafiles.get_media_path(camera_config, filename)
+            if full_path is None or not os.path.isfile(full_path):
+                raise HTTPError(404, 'no such file')
+
+            pretty_filename = camera_config['@name'] + '_' + os.path.basename(filename)
+            self.set_header('Content-Type', content_type)
+            self.set_header('Content-Disposition', 'attachment; filename=' + pretty_filename + ';')
+            self.send_file(full_path)
+
+        elif utils.remote_camera(camera_config):
+            pretty_filename = os.path.basename(filename) # no camera name available w/o additional request
+            stream = functools.partial(remote.get_media_content, camera_config, filename=filename,
+                    media_type=media_type, headers=self.get_proxy_headers())
+
+            self.proxy_stream(camera_config, media_type, stream, content_type=content_type,
+                    content_disposition='attachment; filename=' + pretty_filename + ';')
+
+        else: # assuming simple mjpeg camera
+            raise HTTPError(400, 'unknown operation')
+
+    def on_connection_close(self):
+        if getattr(self, '_chunks', None) is not None:
+            logging.debug('connection closed while sending data')
+
+            self._chunks = None
+            self._chunk_slots.release() # lets the producing thread see it
+
+        if getattr(self, '_proxy_flush_callbacks', None) is not None:
+            logging.debug('connection closed while passing on remote data')
+
+            # let the remote transfer go on, its data will be dropped
+            self._proxy_closed = True
+            self.on_proxy_chunk_flushed()
+
     def get_current_user(self):
         main_config = config.get_main()
         
@@ -884,6 +1265,8 @@ class ConfigHandler(BaseHandler):
 
 
 class PictureHandler(BaseHandler):
+    _STREAM_BOUNDARY = 'motioneyeframe'
+
     @asynchronous
     def get(self, camera_id, op, filename=None, group=None):
         if camera_id is not None:
@@ -894,9 +1277,18 @@ class PictureHandler(BaseHandler):
         if op == 'current':
             self.current(camera_id)
             
+        elif op == 'stream':
+            self.stream(camera_id)
+
+        elif op == 'recent':
+            self.recent(camera_id)
+
         elif op == 'list':
             self.list(camera_id)
-            
+
+        elif op == 'summary':
+            self.summary(camera_id)
+
         elif op == 'frame':
             self.frame(camera_id)
             
@@ -930,6 +1322,9 @@ class PictureHandler(BaseHandler):
 
         elif op == 'delete_all':
             self.delete_all(camera_id, group)
+
+        elif op == 'previews':
+            self.previews(camera_id)
         
         else:
             raise HTTPError(400, 'unknown operation')
@@ -943,23 +1338,42 @@ class PictureHandler(BaseHandler):
         
         width = width and float(width)
         height = height and float(height)
+        profile = self.get_argument('profile', None)
         
         camera_id_str = str(camera_id)
         
         camera_config = config.get_camera(camera_id)
-        if utils.local_motion_camera(camera_config):
-            picture = mediafiles.get_current_picture(camera_config,
+        if utils.local_motion_camera(camera_config) or utils.simple_mjpeg_camera(camera_config):
+            if profile and profile not in config.get_stream_profiles(camera_config):
+                raise HTTPError(400, 'unknown stream profile')
+
+            etag = mediafiles.get_current_picture_etag(camera_config,
                     width=width,
-                    height=height)
+                    height=height,
+                    profile=profile)
+
+            if etag and self.etag_matches(etag):
+                picture = None
+            
+            elif profile:
+                picture = mediafiles.get_profile_picture(camera_config, profile)
+
+            else:
+                picture = mediafiles.get_current_picture(camera_config,
+                        width=width,
+                        height=height)
             
+            # simple mjpeg cameras may have their motion detected by motionEye itself
             self.set_cookie('motion_detected_' + camera_id_str, str(motionctl.is_motion_detected(camera_id)).lower())
+            if utils.local_motion_camera(camera_config):
+                self.set_cookie('monitor_info_' + camera_id_str, monitor.get_monitor_info(camera_id))
+
             self.set_cookie('capture_fps_' + camera_id_str, '%.1f' % mjpgclient.get_fps(camera_id))
-            self.set_cookie('monitor_info_' + camera_id_str, monitor.get_monitor_info(camera_id))
 
-            self.try_finish(picture)
+            self.try_finish_etag(picture, etag)
 
         elif utils.remote_camera(camera_config):
-            def on_response(motion_detected=False, capture_fps=None, monitor_info=None, picture=None, error=None):
+            def on_response(motion_detected=False, capture_fps=None, monitor_info=None, picture=None, etag=None, error=None):
                 if error:
                     return self.try_finish(None)
 
@@ -967,31 +1381,144 @@ class PictureHandler(BaseHandler):
                 self.set_cookie('capture_fps_' + camera_id_str, '%.1f' % capture_fps)
                 self.set_cookie('monitor_info_' + camera_id_str, monitor_info or '')
 
-                self.try_finish(picture)
+                self.try_finish_etag(picture, etag)
             
-            remote.get_current_picture(camera_config, width=width, height=height, callback=on_response)
+            remote.get_current_picture(camera_config, width=width, height=height, callback=on_response, profile=profile)
             
-        else: # assuming simple mjpeg camera
+        else:
             raise HTTPError(400, 'unknown operation')
-            
+
+    @BaseHandler.auth(prompt=False)
+    def stream(self, camera_id):
+        profile = self.get_argument('profile', 'full')
+
+        camera_config = config.get_camera(camera_id)
+        if not utils.local_motion_camera(camera_config) and not utils.simple_mjpeg_camera(camera_config):
+            raise HTTPError(400, 'unknown operation')
+
+        if profile not in config.get_stream_profiles(camera_config):
+            raise HTTPError(400, 'unknown stream profile')
+
+        logging.debug('starting mjpg stream for camera %(id)s, %(profile)s profile' % {'id': camera_id, 'profile': profile})
+
+        import motioneye
+
+        self.set_header('Server', 'motionEye/%s' % motioneye.VERSION)
+        self.set_header('Content-Type', 'multipart/x-mixed-replace; boundary=' + self._STREAM_BOUNDARY)
+        self.set_header('Cache-Control', 'no-store, no-cache, must-revalidate')
+        self.set_header('Pragma', 'no-cache')
+
+        self._stream_camera_id = camera_id
+        self._stream_camera_config = camera_config
+        self._stream_profile = profile
+        self._stream_flushing = False
+
+        mjpgclient.subscribe(camera_id, self.on_stream_jpg)
+
+        # don't let the viewer wait for the next frame
+        jpg = mjpgclient.get_jpg(camera_id)
+        if jpg:
+            self.on_stream_jpg(jpg)
+
+    @BaseHandler.auth(prompt=False)
+    def recent(self, camera_id):
+        try:
+            since = self.get_argument('since', None) and int(self.get_argument('since'))
+            seconds = self.get_argument('seconds', None) and float(self.get_argument('seconds'))
+
+        except ValueError:
+            raise HTTPError(400, 'invalid recent frames parameters')
+
+        camera_config = config.get_camera(camera_id)
+        if not utils.local_motion_camera(camera_config) and not utils.simple_mjpeg_camera(camera_config):
+            raise HTTPError(400, 'unknown operation')
+
+        timestamp = None
+        if seconds:
+            timestamp = time.time() - seconds
+
+        frames = mjpgclient.get_jpgs_since(camera_id,
+                seq=since,
+                timestamp=timestamp)
+
+        self.set_header('Content-Type', 'multipart/mixed; boundary=' + self._STREAM_BOUNDARY)
+        self.set_header('Cache-Control', 'no-store, no-cache, must-revalidate')
+
+        for (seq, timestamp, jpg) in frames:
+            self.write(('--%(boundary)s\r\nContent-Type: image/jpeg\r\nContent-Length: %(length)s\r\n' +
+                    'X-Sequence: %(seq)s\r\nX-Timestamp: %(timestamp).3f\r\n\r\n') % {
+                    'boundary': self._STREAM_BOUNDARY, 'length': len(jpg), 'seq': seq, 'timestamp': timestamp})
+            self.write(jpg)
+            self.write('\r\n')
+
+        self.write('--%(boundary)s--\r\n' % {'boundary': self._STREAM_BOUNDARY})
+        self.try_finish(None)
+
+    def on_stream_jpg(self, jpg):
+        if self._stream_flushing:
+            return # the previous frame hasn't been sent yet, drop this one
+
+        if self._stream_profile != 'full':
+            jpg = mediafiles.get_profile_picture(self._stream_camera_config, self._stream_profile)
+
+        self.write('--%(boundary)s\r\nContent-Type: image/jpeg\r\nContent-Length: %(length)s\r\n\r\n' % {
+                'boundary': self._STREAM_BOUNDARY, 'length': len(jpg)})
+        self.write(jpg)
+        self.write('\r\n')
+
+        self._stream_flushing = True
+        try:
+            self.flush(callback=self.on_stream_flushed)
+
+        except IOError as e:
+            logging.debug('could not write mjpg stream frame: %(msg)s' % {'msg': unicode(e)})
+            self.on_connection_close()
+
+    def on_stream_flushed(self):
+        self._stream_flushing = False
+
+    def on_connection_close(self):
+        BaseHandler.on_connection_close(self)
+
+        camera_id = getattr(self, '_stream_camera_id', None)
+        if camera_id is not None:
+            logging.debug('mjpg stream for camera %(id)s closed' % {'id': camera_id})
+
+            mjpgclient.unsubscribe(camera_id, self.on_stream_jpg)
+            self._stream_camera_id = None
 
     @BaseHandler.auth()
     def list(self, camera_id):
         logging.debug('listing pictures for camera %(id)s' % {'id': camera_id})
         
         camera_config = config.get_camera(camera_id)
+        params = self.get_media_list_params()
         if utils.local_motion_camera(camera_config):
-            def on_media_list(media_list):
+            def on_media_list(media_list, cursor=None):
                 if media_list is None:
                     return self.finish_json({'error': 'Failed to get pictures list.'})
 
-                self.finish_json({
+                response = {
                     'mediaList': media_list,
                     'cameraName': camera_config['@name']
-                })
-            
-            mediafiles.list_media(camera_config, media_type='picture',
-                    callback=on_media_list, prefix=self.get_argument('prefix', None))
+                }
+
+                if params is not None:
+                    response['cursor'] = cursor
+
+                self.finish_json(response)
+
+            if params is not None: # a page of entries with raw timestamps and sizes
+                try:
+                    mediafiles.list_media_page(camera_config, media_type='picture',
+                            callback=on_media_list, prefix=self.get_argument('prefix', None), **params)
+
+                except ValueError as e:
+                    raise HTTPError(400, unicode(e))
+
+            else:
+                mediafiles.list_media(camera_config, media_type='picture',
+                        callback=on_media_list, prefix=self.get_argument('prefix', None))
 
         elif utils.remote_camera(camera_config):
             def on_response(remote_list=None, error=None):
@@ -1001,7 +1528,38 @@ class PictureHandler(BaseHandler):
 
                 self.finish_json(remote_list)
             
-            remote.list_media(camera_config, media_type='picture', prefix=self.get_argument('prefix', None), callback=on_response)
+            remote.list_media(camera_config, media_type='picture', prefix=self.get_argument('prefix', None),
+                    callback=on_response, **(params or {}))
+
+        else: # assuming simple mjpeg camera
+            raise HTTPError(400, 'unknown operation')
+
+    @BaseHandler.auth()
+    def summary(self, camera_id):
+        logging.debug('summarizing pictures for camera %(id)s' % {'id': camera_id})
+
+        camera_config = config.get_camera(camera_id)
+        if utils.local_motion_camera(camera_config):
+            def on_media_groups(groups):
+                if groups is None:
+                    return self.finish_json({'error': 'Failed to get pictures summary.'})
+
+                self.finish_json({
+                    'groups': groups,
+                    'cameraName': camera_config['@name']
+                })
+
+            mediafiles.get_media_groups(camera_config, media_type='picture', callback=on_media_groups)
+
+        elif utils.remote_camera(camera_config):
+            def on_response(remote_summary=None, error=None):
+                if error:
+                    return self.finish_json({'error': 'Failed to get picture summary for %(url)s: %(msg)s.' % {
+                            'url': remote.pretty_camera_url(camera_config), 'msg': error}})
+
+                self.finish_json(remote_summary)
+
+            remote.get_media_summary(camera_config, media_type='picture', callback=on_response)
 
         else: # assuming simple mjpeg camera
             raise HTTPError(400, 'unknown operation')
@@ -1045,31 +1603,7 @@ class PictureHandler(BaseHandler):
                 'filename': filename, 'id': camera_id})
         
         camera_config = config.get_camera(camera_id)
-        if utils.local_motion_camera(camera_config):
-            content = mediafiles.get_media_content(camera_config, filename, 'picture')
-            
-            pretty_filename = camera_config['@name'] + '_' + os.path.basename(filename)
-            self.set_header('Content-Type', 'image/jpeg')
-            self.set_header('Content-Disposition', 'attachment; filename=' + pretty_filename + ';')
-            
-            self.finish(content)
-        
-        elif utils.remote_camera(camera_config):
-            def on_response(response=None, error=None):
-                if error:
-                    return self.finish_json({'error': 'Failed to download picture from %(url)s: %(msg)s.' % {
-                            'url': remote.pretty_camera_url(camera_config), 'msg': error}})
-
-                pretty_filename = os.path.basename(filename) # no camera name available w/o additional request
-                self.set_header('Content-Type', 'image/jpeg')
-                self.set_header('Content-Disposition', 'attachment; filename=' + pretty_filename + ';')
-                
-                self.finish(response)
-
-            remote.get_media_content(camera_config, filename=filename, media_type='picture', callback=on_response)
-
-        else: # assuming simple mjpeg camera
-            raise HTTPError(400, 'unknown operation')
+        self.send_media_content(camera_config, filename, 'picture', 'image/jpeg')
 
     @BaseHandler.auth()
     def preview(self, camera_id, filename):
@@ -1078,18 +1612,20 @@ class PictureHandler(BaseHandler):
         
         camera_config = config.get_camera(camera_id)
         if utils.local_motion_camera(camera_config):
-            content = mediafiles.get_media_preview(camera_config, filename, 'picture',
+            def on_preview(content):
+                if content:
+                    self.set_header('Content-Type', 'image/jpeg')
+
+                else:
+                    self.set_header('Content-Type', 'image/svg+xml')
+                    content = open(os.path.join(settings.STATIC_PATH, 'img', 'no-preview.svg')).read()
+
+                self.finish(content)
+
+            mediafiles.get_media_preview(camera_config, filename, 'picture',
                     width=self.get_argument('width', None),
-                    height=self.get_argument('height', None))
-            
-            if content:
-                self.set_header('Content-Type', 'image/jpeg')
-                
-            else:
-                self.set_header('Content-Type', 'image/svg+xml')
-                content = open(os.path.join(settings.STATIC_PATH, 'img', 'no-preview.svg')).read()
-                
-            self.finish(content)
+                    height=self.get_argument('height', None),
+                    callback=on_preview)
         
         elif utils.remote_camera(camera_config):
             def on_response(content=None, error=None):
@@ -1110,6 +1646,32 @@ class PictureHandler(BaseHandler):
         else: # assuming simple mjpeg camera
             raise HTTPError(400, 'unknown operation')
     
+    @BaseHandler.auth()
+    def previews(self, camera_id):
+        logging.debug('previewing pictures of camera %(id)s' % {'id': camera_id})
+
+        camera_config = config.get_camera(camera_id)
+        if utils.local_motion_camera(camera_config):
+            self.send_media_previews(camera_config, 'picture')
+
+        elif utils.remote_camera(camera_config):
+            def on_response(response=None, error=None):
+                if error:
+                    return self.finish_json({'error': 'Failed to get picture previews from %(url)s: %(msg)s.' % {
+                            'url': remote.pretty_camera_url(camera_config), 'msg': error}})
+
+                if response['cursor'] is not None:
+                    self.set_header('X-Cursor', response['cursor'])
+
+                self.set_header('Content-Type', response['content_type'])
+                self.finish(response['data'])
+
+            remote.get_media_previews(camera_config, media_type='picture', data=self.get_json() or {},
+                    callback=on_response)
+
+        else: # assuming simple mjpeg camera
+            raise HTTPError(400, 'unknown operation')
+
     @BaseHandler.auth(admin=True)
     def delete(self, camera_id, filename):
         logging.debug('deleting picture %(filename)s of camera %(id)s' % {
@@ -1147,30 +1709,29 @@ class PictureHandler(BaseHandler):
                     'group': group or 'ungrouped', 'id': camera_id, 'key': key})
             
             if utils.local_motion_camera(camera_config):
-                data = mediafiles.get_prepared_cache(key)
-                if not data:
+                entries = preparedcache.get_data(key)
+                if entries is None:
                     logging.error('prepared cache data for key "%s" does not exist' % key)
                     
                     raise HTTPError(404, 'no such key')
 
+                entries = json.loads(entries)
+
                 pretty_filename = camera_config['@name'] + '_' + group
                 pretty_filename = re.sub('[^a-zA-Z0-9]', '_', pretty_filename)
-         
+
+                # the archive is built while being sent, a chunk at a time
+                zip_stream = zipstream.ZipStream(entries)
                 self.set_header('Content-Type', 'application/zip')
                 self.set_header('Content-Disposition', 'attachment; filename=' + pretty_filename + '.zip;')
-                self.finish(data)
-                
-            elif utils.remote_camera(camera_config):
-                def on_response(response=None, error=None):
-                    if error:
-                        return self.finish_json({'error': 'Failed to download zip file from %(url)s: %(msg)s.' % {
-                                'url': remote.pretty_camera_url(camera_config), 'msg': error}})
+                self.set_header('Content-Length', zip_stream.size)
+                self.send_chunks(zip_stream.chunks())
 
-                    self.set_header('Content-Type', response['content_type'])
-                    self.set_header('Content-Disposition', response['content_disposition'])
-                    self.finish(response['data'])
+            elif utils.remote_camera(camera_config):
+                stream = functools.partial(remote.get_zipped_content, camera_config, media_type='picture',
+                        key=key, group=group)
 
-                remote.get_zipped_content(camera_config, media_type='picture', key=key, group=group, callback=on_response)
+                self.proxy_stream(camera_config, 'zip file', stream)
 
             else: # assuming simple mjpeg camera
                 raise HTTPError(400, 'unknown operation')
@@ -1180,11 +1741,11 @@ class PictureHandler(BaseHandler):
                     'group': group or 'ungrouped', 'id': camera_id})
 
             if utils.local_motion_camera(camera_config):
-                def on_zip(data):
-                    if data is None:
+                def on_zip(entries):
+                    if entries is None:
                         return self.finish_json({'error': 'Failed to create zip file.'})
     
-                    key = mediafiles.set_prepared_cache(data)
+                    key = preparedcache.add_data(json.dumps(entries))
                     logging.debug('prepared zip file for group "%(group)s" of camera %(id)s with key %(key)s' % {
                             'group': group or 'ungrouped', 'id': camera_id, 'key': key})
                     self.finish_json({'key': key})
@@ -1215,8 +1776,8 @@ class PictureHandler(BaseHandler):
                     'group': group or 'ungrouped', 'id': camera_id, 'key': key})
             
             if utils.local_motion_camera(camera_config):
-                data = mediafiles.get_prepared_cache(key)
-                if data is None:
+                path = preparedcache.get_path(key)
+                if path is None:
                     logging.error('prepared cache data for key "%s" does not exist' % key)
 
                     raise HTTPError(404, 'no such key')
@@ -1227,37 +1788,34 @@ class PictureHandler(BaseHandler):
     
                 self.set_header('Content-Type', 'video/x-msvideo')
                 self.set_header('Content-Disposition', 'attachment; filename=' + pretty_filename + ';')
-                self.finish(data)
+                self.send_file(path)
 
             elif utils.remote_camera(camera_config):
-                def on_response(response=None, error=None):
-                    if error:
-                        return self.finish_json({'error': 'Failed to download timelapse movie from %(url)s: %(msg)s.' % {
-                                'url': remote.pretty_camera_url(camera_config), 'msg': error}})
-
-                    self.set_header('Content-Type', response['content_type'])
-                    self.set_header('Content-Disposition', response['content_disposition'])
-                    self.finish(response['data'])
+                stream = functools.partial(remote.get_timelapse_movie, camera_config, key, group=group,
+                        headers=self.get_proxy_headers())
 
-                remote.get_timelapse_movie(camera_config, key, group=group, callback=on_response)
+                self.proxy_stream(camera_config, 'timelapse movie', stream)
 
             else: # assuming simple mjpeg camera
                 raise HTTPError(400, 'unknown operation')
 
         elif check:
+            job = self.get_argument('job', None)
+
             logging.debug('checking timelapse movie status for group "%(group)s" of camera %(id)s' % {
                     'group': group or 'ungrouped', 'id': camera_id})
 
             if utils.local_motion_camera(camera_config):
-                status = mediafiles.check_timelapse_movie()
-                if status['progress'] == -1 and status['data']:
-                    key = mediafiles.set_prepared_cache(status['data'])
+                job = job or timelapse.find_job(camera_config['@id'], group)
+                status = job and timelapse.get_job(job)
+                if not status:
+                    return self.finish_json({'progress': -1, 'key': None})
+
+                if status['progress'] == -1 and status['key']:
                     logging.debug('prepared timelapse movie for group "%(group)s" of camera %(id)s with key %(key)s' % {
-                            'group': group or 'ungrouped', 'id': camera_id, 'key': key})
-                    self.finish_json({'key': key, 'progress': -1})
+                            'group': group or 'ungrouped', 'id': camera_id, 'key': status['key']})
 
-                else:
-                    self.finish_json(status)
+                self.finish_json(status)
 
             elif utils.remote_camera(camera_config):
                 def on_response(response=None, error=None):
@@ -1265,52 +1823,49 @@ class PictureHandler(BaseHandler):
                         return self.finish_json({'error': 'Failed to check timelapse movie progress at %(url)s: %(msg)s.' % {
                                 'url': remote.pretty_camera_url(camera_config), 'msg': error}})
 
-                    if response['progress'] == -1 and response.get('key'):
-                        self.finish_json({'key': response['key'], 'progress': -1})
-                    
-                    else:
-                        self.finish_json(response)
+                    self.finish_json(response)
 
-                remote.check_timelapse_movie(camera_config, group=group, callback=on_response)
+                remote.check_timelapse_movie(camera_config, group=group, callback=on_response, job=job)
 
             else: # assuming simple mjpeg camera
                 raise HTTPError(400, 'unknown operation')
 
         else: # start timelapse
-            interval = int(self.get_argument('interval'))
-            framerate = int(self.get_argument('framerate'))
+            try:
+                interval = int(self.get_argument('interval'))
+                framerate = int(self.get_argument('framerate'))
+                since = self.get_argument('since', None)
+                since = since and float(since)
+                until = self.get_argument('until', None)
+                until = until and float(until)
+
+            except (TypeError, ValueError):
+                raise HTTPError(400, 'invalid timelapse parameters')
+
+            if interval <= 0 or framerate <= 0:
+                raise HTTPError(400, 'invalid timelapse parameters')
 
             logging.debug('preparing timelapse movie for group "%(group)s" of camera %(id)s with rate %(framerate)s/%(int)s' % {
                     'group': group or 'ungrouped', 'id': camera_id, 'framerate': framerate, 'int': interval})
 
             if utils.local_motion_camera(camera_config):
-                status = mediafiles.check_timelapse_movie()
-                if status['progress'] != -1:
-                    self.finish_json({'progress': status['progress']}) # timelapse already active
+                # a time range without a group spans all the groups
+                if not group and (since or until):
+                    group = None
 
-                else:
-                    mediafiles.make_timelapse_movie(camera_config, framerate, interval, group=group)
-                    self.finish_json({'progress': -1})
+                job = timelapse.make_job(camera_config, framerate, interval, group=group, since=since, until=until)
+                self.finish_json(timelapse.get_job(job))
 
             elif utils.remote_camera(camera_config):
-                def on_status(response=None, error=None):
+                def on_make(response=None, error=None):
                     if error:
                         return self.finish_json({'error': 'Failed to make timelapse movie at %(url)s: %(msg)s.' % {
                                 'url': remote.pretty_camera_url(camera_config), 'msg': error}})
-                    
-                    if response['progress'] != -1:
-                        return self.finish_json({'progress': response['progress']}) # timelapse already active
-    
-                    def on_make(response=None, error=None):
-                        if error:
-                            return self.finish_json({'error': 'Failed to make timelapse movie at %(url)s: %(msg)s.' % {
-                                    'url': remote.pretty_camera_url(camera_config), 'msg': error}})
-    
-                        self.finish_json({'progress': -1})
-                    
-                    remote.make_timelapse_movie(camera_config, framerate, interval, group=group, callback=on_make)
 
-                remote.check_timelapse_movie(camera_config, group=group, callback=on_status)
+                    self.finish_json(response)
+
+                remote.make_timelapse_movie(camera_config, framerate, interval, group=group, callback=on_make,
+                        since=since, until=until)
 
             else: # assuming simple mjpeg camera
                 raise HTTPError(400, 'unknown operation')
@@ -1349,6 +1904,134 @@ class PictureHandler(BaseHandler):
         except IOError as e:
             logging.warning('could not write response: %(msg)s' % {'msg': unicode(e)})
 
+    def try_finish_etag(self, content, etag):
+        if etag:
+            self.set_header('Etag', etag)
+
+            if self.etag_matches(etag):
+                self.set_status(304)
+                content = None
+
+        self.try_finish(content)
+
+
+class MosaicHandler(BaseHandler):
+    _STREAM_BOUNDARY = 'motioneyeframe'
+
+    @asynchronous
+    def get(self, op):
+        if op == 'current':
+            self.current()
+
+        elif op == 'stream':
+            self.stream()
+
+        else:
+            raise HTTPError(400, 'unknown operation')
+
+    def get_mosaic(self):
+        cameras = self.get_argument('cameras', None)
+        columns = self.get_argument('columns', None)
+        width = self.get_argument('width', None)
+        height = self.get_argument('height', None)
+
+        try:
+            camera_ids = cameras and [int(c) for c in cameras.split(',')]
+            columns = columns and int(columns)
+            width = width and int(width)
+            height = height and int(height)
+
+        except ValueError:
+            raise HTTPError(400, 'invalid mosaic layout')
+
+        for (value, maximum) in [(columns, mosaic.MAX_COLUMNS), (width, mosaic.MAX_WIDTH), (height, mosaic.MAX_HEIGHT)]:
+            if value is not None and not 0 < value <= maximum:
+                raise HTTPError(400, 'invalid mosaic layout')
+
+        m = mosaic.get(camera_ids, columns=columns, width=width, height=height)
+        if m is None:
+            raise HTTPError(404, 'no cameras to show')
+
+        return m
+
+    @BaseHandler.auth(prompt=False)
+    def current(self):
+        m = self.get_mosaic()
+
+        self.set_header('Content-Type', 'image/jpeg')
+        self.set_header('Cache-Control', 'no-store, no-cache, must-revalidate')
+
+        self.try_finish(m.get_jpg())
+
+    @BaseHandler.auth(prompt=False)
+    def stream(self):
+        try:
+            framerate = float(self.get_argument('framerate', mosaic.DEFAULT_FRAMERATE))
+
+        except ValueError:
+            raise HTTPError(400, 'invalid mosaic framerate')
+
+        if framerate != framerate: # nan
+            raise HTTPError(400, 'invalid mosaic framerate')
+
+        framerate = min(max(framerate, 0.1), mosaic.MAX_FRAMERATE)
+
+        m = self.get_mosaic()
+
+        logging.debug('starting mosaic stream')
+
+        import motioneye
+
+        self.set_header('Server', 'motionEye/%s' % motioneye.VERSION)
+        self.set_header('Content-Type', 'multipart/x-mixed-replace; boundary=' + self._STREAM_BOUNDARY)
+        self.set_header('Cache-Control', 'no-store, no-cache, must-revalidate')
+        self.set_header('Pragma', 'no-cache')
+
+        self._stream_mosaic = m
+        self._stream_flushing = False
+
+        # don't let the viewer wait for the next frame
+        jpg = m.get_jpg()
+        if jpg:
+            self.on_stream_jpg(jpg)
+
+        m.subscribe(self.on_stream_jpg, framerate)
+
+    def on_stream_jpg(self, jpg):
+        if self._stream_flushing:
+            return # the previous frame hasn't been sent yet, drop this one
+
+        self.write('--%(boundary)s\r\nContent-Type: image/jpeg\r\nContent-Length: %(length)s\r\n\r\n' % {
+                'boundary': self._STREAM_BOUNDARY, 'length': len(jpg)})
+        self.write(jpg)
+        self.write('\r\n')
+
+        self._stream_flushing = True
+        try:
+            self.flush(callback=self.on_stream_flushed)
+
+        except IOError as e:
+            logging.debug('could not write mosaic stream frame: %(msg)s' % {'msg': unicode(e)})
+            self.on_connection_close()
+
+    def on_stream_flushed(self):
+        self._stream_flushing = False
+
+    def on_connection_close(self):
+        m = getattr(self, '_stream_mosaic', None)
+        if m is not None:
+            logging.debug('mosaic stream closed')
+
+            m.unsubscribe(self.on_stream_jpg)
+            self._stream_mosaic = None
+
+    def try_finish(self, content):
+        try:
+            self.finish(content)
+
+        except IOError as e:
+            logging.warning('could not write response: %(msg)s' % {'msg': unicode(e)})
+
 
 class MovieHandler(BaseHandler):
     @asynchronous
@@ -1360,13 +2043,19 @@ class MovieHandler(BaseHandler):
         
         if op == 'list':
             self.list(camera_id)
-            
+
+        elif op == 'summary':
+            self.summary(camera_id)
+
         elif op == 'download':
             self.download(camera_id, filename)
         
         elif op == 'preview':
             self.preview(camera_id, filename)
         
+        elif op == 'playback':
+            self.playback(camera_id, filename)
+
         else:
             raise HTTPError(400, 'unknown operation')
     
@@ -1385,6 +2074,9 @@ class MovieHandler(BaseHandler):
         
         elif op == 'delete_all':
             self.delete_all(camera_id, group)
+
+        elif op == 'previews':
+            self.previews(camera_id)
         
         else:
             raise HTTPError(400, 'unknown operation')
@@ -1394,18 +2086,33 @@ class MovieHandler(BaseHandler):
         logging.debug('listing movies for camera %(id)s' % {'id': camera_id})
         
         camera_config = config.get_camera(camera_id)
+        params = self.get_media_list_params()
         if utils.local_motion_camera(camera_config):
-            def on_media_list(media_list):
+            def on_media_list(media_list, cursor=None):
                 if media_list is None:
                     return self.finish_json({'error': 'Failed to get movies list.'})
 
-                self.finish_json({
+                response = {
                     'mediaList': media_list,
                     'cameraName': camera_config['@name']
-                })
-            
-            mediafiles.list_media(camera_config, media_type='movie',
-                    callback=on_media_list, prefix=self.get_argument('prefix', None))
+                }
+
+                if params is not None:
+                    response['cursor'] = cursor
+
+                self.finish_json(response)
+
+            if params is not None: # a page of entries with raw timestamps and sizes
+                try:
+                    mediafiles.list_media_page(camera_config, media_type='movie',
+                            callback=on_media_list, prefix=self.get_argument('prefix', None), **params)
+
+                except ValueError as e:
+                    raise HTTPError(400, unicode(e))
+
+            else:
+                mediafiles.list_media(camera_config, media_type='movie',
+                        callback=on_media_list, prefix=self.get_argument('prefix', None))
         
         elif utils.remote_camera(camera_config):
             def on_response(remote_list=None, error=None):
@@ -1415,43 +2122,50 @@ class MovieHandler(BaseHandler):
 
                 self.finish_json(remote_list)
             
-            remote.list_media(camera_config, media_type='movie', prefix=self.get_argument('prefix', None), callback=on_response)
+            remote.list_media(camera_config, media_type='movie', prefix=self.get_argument('prefix', None),
+                    callback=on_response, **(params or {}))
 
         else: # assuming simple mjpeg camera
             raise HTTPError(400, 'unknown operation')
 
     @BaseHandler.auth()
-    def download(self, camera_id, filename):
-        logging.debug('downloading movie %(filename)s of camera %(id)s' % {
-                'filename': filename, 'id': camera_id})
-        
+    def summary(self, camera_id):
+        logging.debug('summarizing movies for camera %(id)s' % {'id': camera_id})
+
         camera_config = config.get_camera(camera_id)
         if utils.local_motion_camera(camera_config):
-            content = mediafiles.get_media_content(camera_config, filename, 'movie')
-            
-            pretty_filename = camera_config['@name'] + '_' + os.path.basename(filename)
-            self.set_header('Content-Type', 'video/mpeg')
-            self.set_header('Content-Disposition', 'attachment; filename=' + pretty_filename + ';')
-            
-            self.finish(content)
-        
+            def on_media_groups(groups):
+                if groups is None:
+                    return self.finish_json({'error': 'Failed to get movies summary.'})
+
+                self.finish_json({
+                    'groups': groups,
+                    'cameraName': camera_config['@name']
+                })
+
+            mediafiles.get_media_groups(camera_config, media_type='movie', callback=on_media_groups)
+
         elif utils.remote_camera(camera_config):
-            def on_response(response=None, error=None):
+            def on_response(remote_summary=None, error=None):
                 if error:
-                    return self.finish_json({'error': 'Failed to download movie from %(url)s: %(msg)s.' % {
+                    return self.finish_json({'error': 'Failed to get movie summary for %(url)s: %(msg)s.' % {
                             'url': remote.pretty_camera_url(camera_config), 'msg': error}})
 
-                pretty_filename = os.path.basename(filename) # no camera name available w/o additional request
-                self.set_header('Content-Type', 'video/mpeg')
-                self.set_header('Content-Disposition', 'attachment; filename=' + pretty_filename + ';')
-                
-                self.finish(response)
+                self.finish_json(remote_summary)
 
-            remote.get_media_content(camera_config, filename=filename, media_type='movie', callback=on_response)
+            remote.get_media_summary(camera_config, media_type='movie', callback=on_response)
 
         else: # assuming simple mjpeg camera
             raise HTTPError(400, 'unknown operation')
 
+    @BaseHandler.auth()
+    def download(self, camera_id, filename):
+        logging.debug('downloading movie %(filename)s of camera %(id)s' % {
+                'filename': filename, 'id': camera_id})
+        
+        camera_config = config.get_camera(camera_id)
+        self.send_media_content(camera_config, filename, 'movie', 'video/mpeg')
+
     @BaseHandler.auth()
     def preview(self, camera_id, filename):
         logging.debug('previewing movie %(filename)s of camera %(id)s' % {
@@ -1459,18 +2173,20 @@ class MovieHandler(BaseHandler):
         
         camera_config = config.get_camera(camera_id)
         if utils.local_motion_camera(camera_config):
-            content = mediafiles.get_media_preview(camera_config, filename, 'movie',
+            def on_preview(content):
+                if content:
+                    self.set_header('Content-Type', 'image/jpeg')
+
+                else:
+                    self.set_header('Content-Type', 'image/svg+xml')
+                    content = open(os.path.join(settings.STATIC_PATH, 'img', 'no-preview.svg')).read()
+
+                self.finish(content)
+
+            mediafiles.get_media_preview(camera_config, filename, 'movie',
                     width=self.get_argument('width', None),
-                    height=self.get_argument('height', None))
-            
-            if content:
-                self.set_header('Content-Type', 'image/jpeg')
-                
-            else:
-                self.set_header('Content-Type', 'image/svg+xml')
-                content = open(os.path.join(settings.STATIC_PATH, 'img', 'no-preview.svg')).read()
-            
-            self.finish(content)
+                    height=self.get_argument('height', None),
+                    callback=on_preview)
         
         elif utils.remote_camera(camera_config):
             def on_response(content=None, error=None):
@@ -1491,6 +2207,115 @@ class MovieHandler(BaseHandler):
         else: # assuming simple mjpeg camera
             raise HTTPError(400, 'unknown operation')
 
+    @BaseHandler.auth()
+    def previews(self, camera_id):
+        logging.debug('previewing movies of camera %(id)s' % {'id': camera_id})
+
+        camera_config = config.get_camera(camera_id)
+        if utils.local_motion_camera(camera_config):
+            self.send_media_previews(camera_config, 'movie')
+
+        elif utils.remote_camera(camera_config):
+            def on_response(response=None, error=None):
+                if error:
+                    return self.finish_json({'error': 'Failed to get movie previews from %(url)s: %(msg)s.' % {
+                            'url': remote.pretty_camera_url(camera_config), 'msg': error}})
+
+                if response['cursor'] is not None:
+                    self.set_header('X-Cursor', response['cursor'])
+
+                self.set_header('Content-Type', response['content_type'])
+                self.finish(response['data'])
+
+            remote.get_media_previews(camera_config, media_type='movie', data=self.get_json() or {},
+                    callback=on_response)
+
+        else: # assuming simple mjpeg camera
+            raise HTTPError(400, 'unknown operation')
+
+    @BaseHandler.auth()
+    def playback(self, camera_id, filename):
+        # answers with the HLS playlist of a movie, or with one of its segments if requested with segment
+        segment = self.get_argument('segment', None)
+        if segment is not None:
+            try:
+                segment = int(segment)
+
+            except ValueError:
+                raise HTTPError(400, 'invalid segment')
+
+        if segment is None and self.request.path.endswith('/'):
+            # the segments are requested relative to the playlist, so it has to be requested without the slash;
+            # the redirect is relative as well, as motionEye may be behind a reverse proxy, and signed again
+            path = self.request.path.rstrip('/')
+            name = path.rsplit('/', 1)[-1]
+
+            return self.redirect('../' + name + self.sign_url(path)[len(path):])
+
+        logging.debug('playing back movie %(filename)s of camera %(id)s (segment %(segment)s)' % {
+                'filename': filename, 'id': camera_id, 'segment': segment})
+
+        camera_config = config.get_camera(camera_id)
+        if utils.local_motion_camera(camera_config):
+            full_path = mediafiles.get_media_path(camera_config, filename)
+            if full_path is None or not os.path.isfile(full_path):
+                raise HTTPError(404, 'no such file')
+
+            # the errors are answered with an error status, as the players don't look into the content
+            if segment is None:
+                def on_segments(segments=None, error=None):
+                    if error:
+                        self.set_status(415 if error == movieremux.UNSUPPORTED_CODEC else 500)
+                        return self.finish_json({'error': 'Failed to play back movie: %(msg)s.' % {'msg': error}})
+
+                    self.send_playlist(segments)
+
+                movieremux.get_segments(camera_config, full_path, callback=on_segments)
+
+            else:
+                def on_segment(segment_path=None, error=None):
+                    if error:
+                        self.set_status(415 if error == movieremux.UNSUPPORTED_CODEC else 500)
+                        return self.finish_json({'error': 'Failed to play back movie: %(msg)s.' % {'msg': error}})
+
+                    self.set_header('Content-Type', 'video/mp2t')
+                    self.send_file(segment_path)
+
+                movieremux.get_segment(camera_config, full_path, segment, callback=on_segment)
+
+        elif utils.remote_camera(camera_config):
+            if segment is None:
+                def on_response(segments=None, error=None):
+                    if error:
+                        self.set_status(502)
+                        return self.finish_json({'error': 'Failed to play back movie from %(url)s: %(msg)s.' % {
+                                'url': remote.pretty_camera_url(camera_config), 'msg': error}})
+
+                    self.send_playlist(segments)
+
+                remote.get_movie_playlist(camera_config, filename, callback=on_response)
+
+            else:
+                stream = functools.partial(remote.get_movie_segment, camera_config, filename, segment,
+                        headers=self.get_proxy_headers())
+
+                self.proxy_stream(camera_config, 'movie segment', stream, error_status=502)
+
+        else: # assuming simple mjpeg camera
+            raise HTTPError(400, 'unknown operation')
+
+    def send_playlist(self, segments):
+        # the segments are requested relative to the playlist, each with its own signature
+        path = self.request.path.rstrip('/')
+        name = path.rsplit('/', 1)[-1]
+
+        def make_uri(index):
+            return name + self.sign_url(path + '?segment=%s' % index)[len(path):]
+
+        self.set_header('Content-Type', 'application/vnd.apple.mpegurl')
+        self.set_header('Cache-Control', 'no-cache') # the signatures are specific to the user
+        self.finish(movieremux.make_playlist(segments, make_uri))
+
     @BaseHandler.auth(admin=True)
     def delete(self, camera_id, filename):
         logging.debug('deleting movie %(filename)s of camera %(id)s' % {
@@ -1672,10 +2497,10 @@ class RelayEventHandler(BaseHandler):
             
         elif event == 'movie_end':
             filename = self.get_argument('filename')
-            
+            mediafiles.index_media_file(camera_config, filename)
+
             # generate preview (thumbnail)
-            tasks.add(5, mediafiles.make_movie_preview, tag='make_movie_preview(%s)' % filename,
-                    camera_config=camera_config, full_path=filename)
+            moviepreview.add(camera_config, filename)
 
             # upload to external service
             if camera_config['@upload_enabled'] and camera_config['@upload_movie']:
@@ -1683,7 +2508,9 @@ class RelayEventHandler(BaseHandler):
 
         elif event == 'picture_save':
             filename = self.get_argument('filename')
-            
+            mediafiles.index_media_file(camera_config, filename)
+            thumbcache.add_pictures(camera_config, [filename])
+
             # upload to external service
             if camera_config['@upload_enabled'] and camera_config['@upload_picture']:
                 self.upload_media_file(filename, camera_id, camera_config)
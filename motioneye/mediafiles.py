@@ -15,34 +15,35 @@
 # You should have received a copy of the GNU General Public License
 # along with this program.  If not, see <http://www.gnu.org/licenses/>. 
 
+import base64
 import datetime
 import errno
-import fcntl
-import functools
-import hashlib
+import heapq
+import json
 import logging
-import multiprocessing
 import os.path
 import pipes
-import re
-import signal
-import stat
 import StringIO
 import subprocess
 import time
-import zipfile
 
 from PIL import Image
 from tornado.ioloop import IOLoop
 
 import config
+import mediaindex
+import mediascan
+import moviepreview
 import settings
+import thumbcache
 import utils
 
 
 _PICTURE_EXTS = ['.jpg']
 _MOVIE_EXTS = ['.avi', '.mp4', '.mov', '.swf', '.flv', '.ogg', '.mkv']
 
+_REMOVE_BATCH_SIZE = 1000 # files read from the index and removed at once
+
 FFMPEG_CODEC_MAPPING = {
     'mpeg4': 'mpeg4',
     'msmpeg4': 'msmpeg4v2',
@@ -79,114 +80,286 @@ FFMPEG_EXT_MAPPING = {
     'hevc': 'mp4'
 }
 
-# a cache of prepared files (whose preparing time is significant)
-_prepared_files = {}
+# resized versions of the current picture of each camera,
+# valid only as long as no newer frame is received
+_current_picture_cache = {}
+_MAX_CURRENT_PICTURE_RENDITIONS = 8
 
-_timelapse_process = None
-_timelapse_data = None
+_start_time = int(time.time())
 
 
-def findfiles(path):
-    files = []
-    for name in os.listdir(path):
-        # ignore hidden files/dirs and other unwanted files
-        if name.startswith('.') or name == 'lastsnap.jpg':
-            continue
-        pathname = os.path.join(path, name)
-        st = os.lstat(pathname)
-        mode = st.st_mode
-        if stat.S_ISDIR(mode):
-            files.extend(findfiles(pathname))
+def _list_media_files(dir, exts, prefix=None):
+    def accept(name):
+        name_lower = name.lower()
+        return bool([e for e in exts if name_lower.endswith(e)])
 
-        elif stat.S_ISREG(mode):
-            files.append((pathname, name, st))
+    if prefix is not None:
+        if prefix == 'ungrouped':
+            prefix = ''
 
-    return files
+        (media_files, subdirs) = mediascan.list_dir(os.path.join(dir, prefix), accept=accept)  # @UnusedVariable
 
+        return media_files
 
-def _list_media_files(dir, exts, prefix=None):
     media_files = []
-    
+    for batch in mediascan.walk(dir, accept=accept):
+        media_files.extend(batch)
+
+    return media_files
+
+
+def get_media_type(full_path):
+    full_path_lower = full_path.lower()
+    if [e for e in _PICTURE_EXTS if full_path_lower.endswith(e)]:
+        return 'picture'
+
+    if [e for e in _MOVIE_EXTS if full_path_lower.endswith(e)]:
+        return 'movie'
+
+    return None
+
+
+def _find_media_files(camera_config, media_type, prefix=None):
+    # returns a list of (full_path, timestamp, size) tuples
+    media_files = []
+    for batch in _iter_media_files(camera_config, media_type, prefix=prefix):
+        media_files.extend(batch)
+
+    return media_files
+
+
+def _iter_media_files(camera_config, media_type, prefix=None):
+    # yields lists of (full_path, timestamp, size) tuples,
+    # taken from the media index and falling back to scanning the target dir when the index is not usable
+    target_dir = camera_config.get('target_dir')
+
+    indexed = mediaindex.list_media(camera_config, media_type, prefix=prefix)
+    if indexed is not None:
+        for i in xrange(0, len(indexed), mediascan.BATCH_SIZE):
+            yield [(os.path.join(target_dir, path.lstrip('/')), timestamp, size)
+                    for (path, timestamp, size) in indexed[i:i + mediascan.BATCH_SIZE]]
+
+        return
+
+    # the index is being built by the media scan of the camera (see mediawatch), in the background
+    logging.debug('media index of camera %(id)s is not available, scanning %(dir)s...' % {
+            'id': camera_config['@id'], 'dir': target_dir})
+
+    exts = _PICTURE_EXTS if media_type == 'picture' else _MOVIE_EXTS
     if prefix is not None:
-        if prefix == 'ungrouped':
-            prefix = ''
-        
-        root = os.path.join(dir, prefix)
-        for name in os.listdir(root):
-            # ignore hidden files/dirs and other unwanted files
-            if name.startswith('.') or name == 'lastsnap.jpg':
-                continue
-                
-            full_path = os.path.join(root, name)
-            try:
-                st = os.stat(full_path)
-            
-            except Exception as e:
-                logging.error('stat failed: ' + unicode(e))
-                continue
-                
-            if not stat.S_ISREG(st.st_mode): # not a regular file
-                continue
+        try:
+            media_files = _list_media_files(target_dir, exts, prefix=prefix)
 
-            full_path_lower = full_path.lower()
-            if not [e for e in exts if full_path_lower.endswith(e)]:
-                continue
-            
-            media_files.append((full_path, st))
+        except OSError as e:
+            logging.error('failed to list group "%(group)s" of camera %(id)s: %(msg)s' % {
+                    'group': prefix, 'id': camera_config['@id'], 'msg': unicode(e)})
+
+            media_files = []
+
+        for i in xrange(0, len(media_files), mediascan.BATCH_SIZE):
+            yield [(p, st.st_mtime, st.st_size) for (p, st) in media_files[i:i + mediascan.BATCH_SIZE]]
+
+        return
+
+    for batch in mediascan.walk(target_dir, accept=lambda name: get_media_type(name) == media_type):
+        yield [(p, st.st_mtime, st.st_size) for (p, st) in batch]
+
+
+def index_media_file(camera_config, full_path):
+    name = os.path.basename(full_path)
+    if name.startswith('.') or name == 'lastsnap.jpg':
+        return
+
+    media_type = get_media_type(full_path)
+    if not media_type:
+        return
+
+    try:
+        st = os.stat(full_path)
+
+    except Exception as e:
+        logging.error('stat failed: ' + unicode(e))
+        return
+
+    mediaindex.add(camera_config, full_path, media_type, st.st_mtime, st.st_size)
+
+
+def _remove_older_files(camera_config, moment, media_type, exts):
+    timestamp = time.mktime(moment.timetuple())
+    if mediaindex.is_complete(camera_config):
+        # the oldest files are read from the index, instead of walking the whole target dir
+        target_dir = camera_config.get('target_dir')
+
+        def iter_older_files():
+            after = None
+            while True:
+                rows = mediaindex.query_media(camera_config, media_type, sort='time', until=timestamp,
+                        after=after, limit=_REMOVE_BATCH_SIZE)
+
+                for (path, file_timestamp, size) in rows or []:  # @UnusedVariable
+                    if file_timestamp < timestamp:
+                        yield os.path.join(target_dir, path.lstrip('/'))
+
+                if not rows or len(rows) < _REMOVE_BATCH_SIZE:
+                    break
+
+                after = (rows[-1][1], rows[-1][0])
+
+        remove_media_files(camera_config, iter_older_files())
 
     else:
-        for full_path, name, st in findfiles(dir):
-            full_path_lower = full_path.lower()
-            if not [e for e in exts if full_path_lower.endswith(e)]:
-                continue
+        full_paths = [full_path for (full_path, st) in _list_media_files(camera_config.get('target_dir'), exts)
+                if datetime.datetime.fromtimestamp(st.st_mtime) < moment]
+
+        remove_media_files(camera_config, full_paths)
+
+
+def remove_media_files(camera_config, full_paths):
+    # removes the given media files (full_paths may be an iterator), along with the previews of the movies,
+    # and then the dirs left empty or containing only previews; each dir is checked only once, at the end
+    dirs = set()
+    batch = []
+    for full_path in full_paths:
+        batch.append(full_path)
+        if len(batch) >= _REMOVE_BATCH_SIZE:
+            _remove_files(camera_config, batch, dirs)
+            batch = []
+
+    _remove_files(camera_config, batch, dirs)
+
+    # the deepest dirs first, so that their parents are checked only after all their removed subdirs
+    root = camera_config.get('target_dir').rstrip('/') + '/'
+    heap = [(-d.count('/'), d) for d in dirs]
+    heapq.heapify(heap)
+    while heap:
+        (depth, dir_path) = heapq.heappop(heap)  # @UnusedVariable
+        if not dir_path.startswith(root):
+            continue # never remove the target dir itself
+
+        try:
+            listing = os.listdir(dir_path)
+
+        except OSError:
+            continue # removed in the meantime
+
+        thumbs = [l for l in listing if l.endswith('.thumb')]
+        if len(listing) > len(thumbs):
+            continue
+
+        for name in thumbs:
+            _remove_file(os.path.join(dir_path, name))
+
+        logging.debug('removing empty directory %(path)s...' % {'path': dir_path})
+
+        try:
+            os.rmdir(dir_path)
+
+        except OSError as e:
+            logging.error('failed to remove %s: %s' % (dir_path, e))
+            continue
+
+        parent = os.path.dirname(dir_path)
+        if parent not in dirs:
+            dirs.add(parent)
+            heapq.heappush(heap, (-parent.count('/'), parent))
+
 
-            media_files.append((full_path, st))
+def _remove_files(camera_config, full_paths, dirs):
+    removed = []
+    for full_path in full_paths:
+        logging.debug('removing file %(path)s...' % {'path': full_path})
+
+        _remove_file(full_path)
+        dirs.add(os.path.dirname(full_path))
+
+        if full_path.endswith('.thumb'):
+            continue # movie previews are not indexed
+
+        if get_media_type(full_path) == 'movie':
+            _remove_file(full_path + '.thumb')
+
+        removed.append(full_path)
+
+    if removed:
+        mediaindex.update(camera_config, [], removed)
+        thumbcache.remove(camera_config, removed)
+
+
+def _remove_file(full_path):
+    try:
+        os.remove(full_path)
+
+    except OSError as e:
+        if e.errno != errno.ENOENT: # the file might have been removed in the meantime
+            logging.error('failed to remove %s: %s' % (full_path, e))
+
+
+def get_media_size(camera_config):
+    # returns the total size of the media files of a camera, listing them from disk if the media index is not ready
+    total_size = mediaindex.get_total_size(camera_config)
+    if total_size is None:
+        total_size = sum(size for (timestamp, full_path, size) in _list_all_media_files(camera_config))  # @UnusedVariable
+
+    return total_size
+
+
+def _list_all_media_files(camera_config):
+    # returns the (timestamp, full_path, size) tuples of all the media files of a camera, listed from disk
+    logging.debug('listing all the media files of camera %(id)s...' % {'id': camera_config['@id']})
+
+    media_files = []
+    for batch in mediascan.walk(camera_config.get('target_dir'), accept=get_media_type):
+        media_files.extend((st.st_mtime, full_path, st.st_size) for (full_path, st) in batch)
 
     return media_files
 
 
-def _remove_older_files(dir, moment, exts):
-    for (full_path, st) in _list_media_files(dir, exts):
-        file_moment = datetime.datetime.fromtimestamp(st.st_mtime)
-        if file_moment < moment:
-            logging.debug('removing file %(path)s...' % {'path': full_path})
-            
-            # remove the file itself
-            try:
-                os.remove(full_path)
-            
-            except OSError as e:
-                if e.errno == errno.ENOENT:
-                    pass # the file might have been removed in the meantime
-                
-                else:
-                    logging.error('failed to remove %s: %s' % (full_path, e))
-
-            # remove the parent directories if empty or contain only thumb files
-            dir_path = os.path.dirname(full_path)
-            if not os.path.exists(dir_path):
-                continue
-            
-            listing = os.listdir(dir_path)
-            thumbs = [l for l in listing if l.endswith('.thumb')]
-            
-            if len(listing) == len(thumbs): # only thumbs
-                for p in thumbs:
-                    try:
-                        os.remove(os.path.join(dir_path, p))
-                    
-                    except:
-                        logging.error('failed to remove %s: %s' % (p, e))
-
-            if not listing or len(listing) == len(thumbs):
-                # this will possibly cause following paths that are in the media files for loop
-                # to be removed in advance; the os.remove call will raise ENOENT which is silently ignored 
-                logging.debug('removing empty directory %(path)s...' % {'path': dir_path})
-                try:
-                    os.removedirs(dir_path)
-                
-                except:
-                    logging.error('failed to remove %s: %s' % (dir_path, e))
+def remove_oldest_media(camera_configs, size):
+    # removes the oldest media files of the given cameras, taken together, until at least size bytes are freed;
+    # the files of the cameras whose media index is not ready are listed from disk; returns the number of bytes freed
+    def iter_oldest(camera_config):
+        target_dir = camera_config.get('target_dir')
+        after = None
+        while True:
+            rows = mediaindex.get_oldest(camera_config, after=after, limit=_REMOVE_BATCH_SIZE)
+            if rows is None and after is None:
+                for (timestamp, full_path, file_size) in sorted(_list_all_media_files(camera_config)):
+                    yield (timestamp, full_path, file_size, camera_config['@id'])
+
+                break
+
+            elif rows is None:
+                logging.error('the media index of camera %(id)s failed, its remaining media files are left alone' % {
+                        'id': camera_config['@id']})
+
+                break
+
+            for (path, timestamp, file_size) in rows:
+                yield (timestamp, os.path.join(target_dir, path.lstrip('/')), file_size, camera_config['@id'])
+
+            if len(rows) < _REMOVE_BATCH_SIZE:
+                break
+
+            after = (rows[-1][1], rows[-1][0])
+
+    full_paths_by_camera = {}
+    freed = 0
+    for (timestamp, full_path, file_size, camera_id) in heapq.merge(*[iter_oldest(c) for c in camera_configs]):  # @UnusedVariable
+        if freed >= size:
+            break
+
+        full_paths_by_camera.setdefault(camera_id, []).append(full_path)
+        freed += file_size
+
+    for camera_config in camera_configs:
+        full_paths = full_paths_by_camera.get(camera_config['@id'])
+        if full_paths:
+            logging.debug('removing %(count)s oldest media files of camera %(id)s...' % {
+                    'count': len(full_paths), 'id': camera_config['@id']})
+
+            remove_media_files(camera_config, full_paths)
+
+    return freed
 
 
 def find_ffmpeg():
@@ -234,10 +407,12 @@ def cleanup_media(media_type):
             # create a sentinel file to make sure the target dir is never removed
             open(os.path.join(target_dir, '.keep'), 'w').close()
 
-        _remove_older_files(target_dir, preserve_moment, exts=exts)
+        _remove_older_files(camera_config, preserve_moment, media_type, exts=exts)
 
 
 def make_movie_preview(camera_config, full_path):
+    # creates the preview of a movie, by running ffmpeg (normally from the moviepreview pool);
+    # returns the path of the preview, or None if it could not be created
     framerate = camera_config['framerate']
     pre_capture = camera_config['pre_capture']
     offs = pre_capture / framerate
@@ -247,36 +422,13 @@ def make_movie_preview(camera_config, full_path):
     logging.debug('creating movie preview for %(path)s with an offset of %(offs)s seconds...' % {
             'path': full_path, 'offs': offs})
 
-    cmd = 'ffmpeg -i %(path)s -f mjpeg -vframes 1 -ss %(offs)s -y %(path)s.thumb'
-    actual_cmd = cmd % {'path': pipes.quote(full_path), 'offs': offs}
-    logging.debug('running command "%s"' % actual_cmd)
-    
-    try:
-        subprocess.check_output(actual_cmd.split(), stderr=subprocess.STDOUT)
-    
-    except subprocess.CalledProcessError as e:
-        logging.error('failed to create movie preview for %(path)s: %(msg)s' % {
-                'path': full_path, 'msg': unicode(e)})
-        
-        return None
-    
-    try:
-        st = os.stat(thumb_path)
-    
-    except os.error:
-        logging.error('failed to create movie preview for %(path)s' % {'path': full_path})
-
-        return None
-
-    if st.st_size == 0:
-        logging.debug('movie probably too short, grabbing first frame from %(path)s...' % {'path': full_path})
-        
-        actual_cmd = cmd % {'path': full_path, 'offs': 0}
-        logging.debug('running command "%s"' % actual_cmd)
+    def grab_frame(offs):
+        # seeking before opening the input skips decoding everything up to the offset
+        cmd = ['ffmpeg', '-ss', str(offs), '-i', full_path, '-f', 'mjpeg', '-vframes', '1', '-y', thumb_path]
+        logging.debug('running command "%s"' % ' '.join(pipes.quote(c) for c in cmd))
 
-        # try again, this time grabbing the very first frame
         try:
-            subprocess.check_output(actual_cmd.split(), stderr=subprocess.STDOUT)
+            subprocess.check_output(cmd, stderr=subprocess.STDOUT)
 
         except subprocess.CalledProcessError as e:
             logging.error('failed to create movie preview for %(path)s: %(msg)s' % {
@@ -285,14 +437,19 @@ def make_movie_preview(camera_config, full_path):
             return None
 
         try:
-            st = os.stat(thumb_path)
-    
+            return os.stat(thumb_path).st_size
+
         except os.error:
-            logging.error('failed to create movie preview for %(path)s' % {'path': full_path})
-    
-            return None
+            return 0
+
+    size = grab_frame(offs)
+    if size == 0:
+        logging.debug('movie probably too short, grabbing first frame from %(path)s...' % {'path': full_path})
 
-    if st.st_size == 0:
+        # try again, this time grabbing the very first frame
+        size = grab_frame(0)
+
+    if not size:
         logging.error('failed to create movie preview for %(path)s' % {'path': full_path})
         try:
             os.remove(thumb_path)
@@ -308,436 +465,270 @@ def make_movie_preview(camera_config, full_path):
 def list_media(camera_config, media_type, callback, prefix=None):
     target_dir = camera_config.get('target_dir')
 
-    if media_type == 'picture':
-        exts = _PICTURE_EXTS
-        
-    elif media_type == 'movie':
-        exts = _MOVIE_EXTS
+    indexed = mediaindex.list_media(camera_config, media_type, prefix=prefix)
+    if indexed is not None:
+        io_loop = IOLoop.instance()
+        io_loop.add_callback(callback, _make_media_list(indexed))
+
+        return
+
+    # a subprocess retrieves the media files and sends them back in batches
+    def iter_media_list():
+        for batch in _iter_media_files(camera_config, media_type, prefix=prefix):
+            files = []
+            for (p, timestamp, size) in batch:
+                path = p[len(target_dir):]
+                if not path.startswith('/'):
+                    path = '/' + path
+
+                files.append((path, timestamp, size))
+
+            yield _make_media_list(files)
 
-    # create a subprocess to retrieve media files
-    def do_list_media(pipe):
-        mf = _list_media_files(target_dir, exts=exts, prefix=prefix)
-        for (p, st) in mf:
-            path = p[len(target_dir):]
-            if not path.startswith('/'):
-                path = '/' + path
-    
-            timestamp = st.st_mtime
-            size = st.st_size
-            
-            pipe.send({
-                'path': path,
-                'momentStr': utils.pretty_date_time(datetime.datetime.fromtimestamp(timestamp)),
-                'momentStrShort': utils.pretty_date_time(datetime.datetime.fromtimestamp(timestamp), short=True),
-                'sizeStr': utils.pretty_size(size),
-                'timestamp': timestamp
-            })
-        
-        pipe.close()
-    
     logging.debug('starting media listing process...')
-    
-    (parent_pipe, child_pipe) = multiprocessing.Pipe(duplex=False)
-    process = multiprocessing.Process(target=do_list_media, args=(child_pipe, ))
-    process.start()
-    
-    # poll the subprocess to see when it has finished
-    started = datetime.datetime.now()
+
     media_list = []
-    
-    def read_media_list():
-        while parent_pipe.poll():
-            media_list.append(parent_pipe.recv())
-    
-    def poll_process():
-        io_loop = IOLoop.instance()
-        if process.is_alive(): # not finished yet
-            now = datetime.datetime.now()
-            delta = now - started
-            if delta.seconds < settings.LIST_MEDIA_TIMEOUT:
-                io_loop.add_timeout(datetime.timedelta(seconds=0.5), poll_process)
-                read_media_list()
-            
-            else: # process did not finish in time
-                logging.error('timeout waiting for the media listing process to finish')
-                try:
-                    os.kill(process.pid, signal.SIGTERM)
-                
-                except:
-                    pass # nevermind
-                    
-                callback(None)
-
-        else: # finished
-            read_media_list()
-            logging.debug('media listing process has returned %(count)s files' % {'count': len(media_list)})
-            callback(media_list)
-    
-    poll_process()
 
+    def on_done(error):
+        if error:
+            logging.error('media listing failed: %(msg)s' % {'msg': error})
+            return callback(None)
 
-def get_media_content(camera_config, path, media_type):
-    target_dir = camera_config.get('target_dir')
+        logging.debug('media listing process has returned %(count)s files' % {'count': len(media_list)})
+        callback(media_list)
 
-    full_path = os.path.join(target_dir, path)
-    
-    try:
-        with open(full_path) as f:
-            return f.read()
-    
-    except Exception as e:
-        logging.error('failed to read file %(path)s: %(msg)s' % {
-                'path': full_path, 'msg': unicode(e)})
-        
-        return None
+    mediascan.run(iter_media_list, on_batch=media_list.extend, on_done=on_done, timeout=settings.LIST_MEDIA_TIMEOUT)
 
 
-def get_zipped_content(camera_config, media_type, group, callback):
-    target_dir = camera_config.get('target_dir')
+def _make_media_list(files):
+    # files is a list of (path, timestamp, size) tuples, the paths being relative to the target dir
+    return [{
+        'path': path,
+        'momentStr': utils.pretty_date_time(datetime.datetime.fromtimestamp(timestamp)),
+        'momentStrShort': utils.pretty_date_time(datetime.datetime.fromtimestamp(timestamp), short=True),
+        'sizeStr': utils.pretty_size(size),
+        'timestamp': timestamp,
+        'size': size
+    } for (path, timestamp, size) in files]
 
-    if media_type == 'picture':
-        exts = _PICTURE_EXTS
-        
-    elif media_type == 'movie':
-        exts = _MOVIE_EXTS
-        
-    working = multiprocessing.Value('b')
-    working.value = True
-
-    # create a subprocess to add files to zip
-    def do_zip(pipe):
-        mf = _list_media_files(target_dir, exts=exts, prefix=group)
-        paths = []
-        for (p, st) in mf:  # @UnusedVariable
-            path = p[len(target_dir):]
-            if path.startswith('/'):
-                path = path[1:]
-
-            paths.append(path)
-            
-        zip_filename = os.path.join(settings.MEDIA_PATH, '.zip-%s' % int(time.time()))
-        logging.debug('adding %d files to zip file "%s"' % (len(paths), zip_filename))
 
-        try:
-            with zipfile.ZipFile(zip_filename, mode='w') as f:
-                for path in paths:
-                    full_path = os.path.join(target_dir, path)
-                    f.write(full_path, path)
+def list_media_page(camera_config, media_type, callback, prefix=None, sort='-time', since=None, until=None,
+        cursor=None, limit=None):
 
-        except Exception as e:
-            logging.error('failed to create zip file "%s": %s' % (zip_filename, e))
+    # calls back with a list of {path, timestamp, size} entries and the cursor of the next page
+    # (None for the last page); raises ValueError if the cursor is invalid
+    after = cursor and _decode_media_cursor(cursor)
+    column = {'time': 'timestamp', 'size': 'size'}[sort.lstrip('-')]
 
-            working.value = False
-            pipe.close()
-            return
+    def on_media_list(media_list):
+        if media_list is None:
+            return callback(None, None)
 
-        logging.debug('reading zip file "%s" into memory' % zip_filename)
+        next_cursor = None
+        if limit is not None and len(media_list) > limit:
+            media_list = media_list[:limit]
+            last = media_list[-1]
+            next_cursor = _encode_media_cursor(last[column], last['path'])
 
-        try:
-            with open(zip_filename, mode='r') as f:
-                data = f.read()
+        callback(media_list, next_cursor)
 
-            working.value = False
-            pipe.send(data)
-            logging.debug('zip data ready')
+    # one more entry than asked for tells whether there is a next page
+    fetch_limit = limit + 1 if limit is not None else None
 
-        except Exception as e:
-            logging.error('failed to read zip file "%s": %s' % (zip_filename, e))
-            working.value = False
+    indexed = mediaindex.query_media(camera_config, media_type, prefix=prefix, sort=sort,
+            since=since, until=until, after=after, limit=fetch_limit)
 
-        finally:
-            os.remove(zip_filename)
-            pipe.close()
+    if indexed is not None:
+        media_list = [{'path': path, 'timestamp': timestamp, 'size': size} for (path, timestamp, size) in indexed]
+        io_loop = IOLoop.instance()
+        io_loop.add_callback(on_media_list, media_list)
 
-    logging.debug('starting zip process...')
+        return
 
-    (parent_pipe, child_pipe) = multiprocessing.Pipe(duplex=False)
-    process = multiprocessing.Process(target=do_zip, args=(child_pipe, ))
-    process.start()
+    # the index is not available (yet), so the whole list is sorted and sliced here
+    def on_full_media_list(media_list):
+        if media_list is None:
+            return on_media_list(None)
 
-    # poll the subprocess to see when it has finished
-    started = datetime.datetime.now()
+        media_list = [{'path': m['path'], 'timestamp': m['timestamp'], 'size': m['size']} for m in media_list
+                if (since is None or m['timestamp'] >= since) and (until is None or m['timestamp'] <= until)]
 
-    def poll_process():
-        io_loop = IOLoop.instance()
-        if working.value:
-            now = datetime.datetime.now()
-            delta = now - started
-            if delta.seconds < settings.ZIP_TIMEOUT:
-                io_loop.add_timeout(datetime.timedelta(seconds=0.5), poll_process)
-
-            else: # process did not finish in time
-                logging.error('timeout waiting for the zip process to finish')
-                try:
-                    os.kill(process.pid, signal.SIGTERM)
-                
-                except:
-                    pass # nevermind
-
-                callback(None)
-
-        else: # finished
-            try:
-                data = parent_pipe.recv()
-                logging.debug('zip process has returned %d bytes' % len(data))
-                
-            except:
-                data = None
-            
-            callback(data)
-
-    poll_process()
-
-
-def make_timelapse_movie(camera_config, framerate, interval, group):
-    global _timelapse_process
-    global _timelapse_data
-    
-    target_dir = camera_config.get('target_dir')
-    codec = camera_config.get('ffmpeg_video_codec')
-    
-    codec = FFMPEG_CODEC_MAPPING.get(codec, codec)
-    format = FFMPEG_FORMAT_MAPPING.get(codec, codec)
-
-    # create a subprocess to retrieve media files
-    def do_list_media(pipe):
-        mf = _list_media_files(target_dir, exts=_PICTURE_EXTS, prefix=group)
-        for (p, st) in mf:
-            timestamp = st.st_mtime
-
-            pipe.send({
-                'path': p,
-                'timestamp': timestamp
-            })
+        descending = sort.startswith('-')
+        media_list.sort(key=lambda m: (m[column], m['path']), reverse=descending)
+        if after is not None:
+            if descending:
+                media_list = [m for m in media_list if (m[column], m['path']) < tuple(after)]
 
-        pipe.close()
+            else:
+                media_list = [m for m in media_list if (m[column], m['path']) > tuple(after)]
 
-    logging.debug('starting media listing process...')
-    
-    (parent_pipe, child_pipe) = multiprocessing.Pipe(duplex=False)
-    _timelapse_process = multiprocessing.Process(target=do_list_media, args=(child_pipe, ))
-    _timelapse_process.progress = 0
-    _timelapse_process.start()
-    _timelapse_data = None
+        on_media_list(media_list[:fetch_limit])
 
-    started = [datetime.datetime.now()]
-    media_list = []
-    
-    tmp_filename = os.path.join(settings.MEDIA_PATH, '.%s.avi' % int(time.time()))
+    list_media(camera_config, media_type, callback=on_full_media_list, prefix=prefix)
+
+
+def get_media_groups(camera_config, media_type, callback):
+    # calls back with a list of {group, count, size, first, last, previewPath} entries,
+    # the preview path being that of the most recent file of the group
+    indexed = mediaindex.get_groups(camera_config, media_type)
+    if indexed is not None:
+        groups = [{
+            'group': group,
+            'count': count,
+            'size': size,
+            'first': first,
+            'last': last,
+            'previewPath': last_path
+        } for (group, count, size, first, last, last_path) in indexed]
 
-    def read_media_list():
-        while parent_pipe.poll():
-            media_list.append(parent_pipe.recv())
-        
-    def poll_media_list_process():
         io_loop = IOLoop.instance()
-        if _timelapse_process.is_alive(): # not finished yet
-            now = datetime.datetime.now()
-            delta = now - started[0]
-            if delta.seconds < settings.TIMELAPSE_TIMEOUT: # the subprocess has limited time to complete its job
-                io_loop.add_timeout(datetime.timedelta(seconds=0.5), poll_media_list_process)
-                read_media_list()
-
-            else: # process did not finish in time
-                logging.error('timeout waiting for the media listing process to finish')
-                try:
-                    os.kill(_timelapse_process.pid, signal.SIGTERM)
-                
-                except:
-                    pass # nevermind
-
-                _timelapse_process.progress = -1
-
-        else: # finished
-            read_media_list()
-            logging.debug('media listing process has returned %(count)s files' % {'count': len(media_list)})
-            
-            if not media_list:
-                _timelapse_process.progress = -1
-                
-                return
-
-            pictures = select_pictures(media_list)
-            make_movie(pictures)
-
-    def select_pictures(media_list):
-        media_list.sort(key=lambda e: e['timestamp'])
-        start = media_list[0]['timestamp']
-        slices = {}
-        max_idx = 0
+        io_loop.add_callback(callback, groups)
+
+        return
+
+    # the index is not available (yet), so the groups are summarized from the whole list
+    def on_media_list(media_list):
+        if media_list is None:
+            return callback(None)
+
+        groups = {}
         for m in media_list:
-            offs = m['timestamp'] - start
-            pos = float(offs) / interval - 0.5
-            idx = int(round(pos))
-            max_idx = idx
-            m['delta'] = abs(pos - idx)
-            slices.setdefault(idx, []).append(m)
-
-        selected = []
-        for i in xrange(max_idx + 1):
-            slice = slices.get(i)
-            if not slice:
-                continue
+            key = os.path.dirname(m['path'])[1:]
+            group = groups.setdefault(key, {
+                'group': key,
+                'count': 0,
+                'size': 0,
+                'first': m['timestamp'],
+                'last': m['timestamp'],
+                'previewPath': m['path']
+            })
 
-            selected.append(min(slice, key=lambda m: m['delta']))
+            group['count'] += 1
+            group['size'] += m['size']
+            group['first'] = min(group['first'], m['timestamp'])
+            if m['timestamp'] >= group['last']:
+                group['last'] = m['timestamp']
+                group['previewPath'] = m['path']
 
-        logging.debug('selected %d/%d media files' % (len(selected), len(media_list)))
-        
-        return selected
+        callback(sorted(groups.values(), key=lambda g: g['group']))
 
-    def make_movie(pictures):
-        global _timelapse_process
+    list_media(camera_config, media_type, callback=on_media_list)
 
-        cmd =  'rm -f %(tmp_filename)s;'
-        cmd += 'cat %(jpegs)s | ffmpeg -framerate %(framerate)s -f image2pipe -vcodec mjpeg -i - -vcodec %(codec)s -format %(format)s -b:v %(bitrate)s -qscale:v 0.1 -f avi %(tmp_filename)s'
 
-        bitrate = 9999999
+def _encode_media_cursor(value, path):
+    return base64.urlsafe_b64encode(json.dumps([value, path]))
 
-        cmd = cmd % {
-            'tmp_filename': tmp_filename,
-            'jpegs': ' '.join((('"' + p['path'] + '"') for p in pictures)),
-            'framerate': framerate,
-            'codec': codec,
-            'format': format,
-            'bitrate': bitrate
-        }
-        
-        logging.debug('executing "%s"' % cmd)
 
-        _timelapse_process = subprocess.Popen(cmd, stdout=subprocess.PIPE, stderr=subprocess.STDOUT, shell=True)
-        _timelapse_process.progress = 0.01 # 1%
-        
-        # make subprocess stdout pipe non-blocking
-        fd = _timelapse_process.stdout.fileno()
-        fl = fcntl.fcntl(fd, fcntl.F_GETFL)
-        fcntl.fcntl(fd, fcntl.F_SETFL, fl | os.O_NONBLOCK)
+def _decode_media_cursor(cursor):
+    try:
+        (value, path) = json.loads(base64.urlsafe_b64decode(str(cursor)))
 
-        poll_movie_process(pictures)
+    except Exception:
+        raise ValueError('invalid cursor')
 
-    def poll_movie_process(pictures):
-        global _timelapse_process
-        global _timelapse_data
-        
-        io_loop = IOLoop.instance()
-        if _timelapse_process.poll() is None: # not finished yet
-            io_loop.add_timeout(datetime.timedelta(seconds=0.5), functools.partial(poll_movie_process, pictures))
-
-            try:
-                output = _timelapse_process.stdout.read()
-            
-            except IOError as e:
-                if e.errno == errno.EAGAIN:
-                    output = ''
-                
-                else:
-                    raise
-                
-            frame_index = re.findall('frame=\s*(\d+)', output)
-            try:
-                frame_index = int(frame_index[-1])
-            
-            except (IndexError, ValueError):
-                return
-
-            _timelapse_process.progress = max(0.01, float(frame_index) / len(pictures))
-            
-            logging.debug('timelapse progress: %s' % int(100 * _timelapse_process.progress))
-
-        else: # finished
-            exit_code = _timelapse_process.poll()
-            _timelapse_process = None
-            
-            if exit_code != 0:
-                logging.error('ffmpeg process failed')
-                _timelapse_data = None
-
-                try:
-                    os.remove(tmp_filename)
-
-                except:
-                    pass
+    if not isinstance(value, (int, long, float)) or not isinstance(path, basestring):
+        raise ValueError('invalid cursor')
 
-            else:
-                logging.debug('reading timelapse movie file "%s" into memory' % tmp_filename)
-    
-                try:
-                    with open(tmp_filename, mode='r') as f:
-                        _timelapse_data = f.read()
-    
-                    logging.debug('timelapse movie process has returned %d bytes' % len(_timelapse_data))
-    
-                except Exception as e:
-                    logging.error('failed to read timelapse movie file "%s": %s' % (tmp_filename, e))
-    
-                finally:
-                    try:
-                        os.remove(tmp_filename)
+    return (value, path)
 
-                    except:
-                        pass
 
-    poll_media_list_process()
+def get_media_path(camera_config, path):
+    # returns the full path of a media file, or None if the path points outside of the target dir
+    target_dir = os.path.realpath(camera_config.get('target_dir'))
+    full_path = os.path.realpath(os.path.join(target_dir, path))
+    if not full_path.startswith(target_dir + '/'):
+        logging.warning('refusing to access %(path)s outside of %(dir)s' % {'path': full_path, 'dir': target_dir})
 
+        return None
 
-def check_timelapse_movie():
-    if _timelapse_process:
-        if ((hasattr(_timelapse_process, 'poll') and _timelapse_process.poll() is None) or
-            (hasattr(_timelapse_process, 'is_alive') and _timelapse_process.is_alive())):
-        
-            return {'progress': _timelapse_process.progress, 'data': None}
-        
-        else:
-            return {'progress': _timelapse_process.progress, 'data': _timelapse_data}
+    return full_path
 
-    else:
-        return {'progress': -1, 'data': _timelapse_data}
+
+def get_zipped_content(camera_config, media_type, group, callback):
+    # calls back with the list of (full_path, name, size, timestamp) entries to be zipped;
+    # the archive itself is built while being sent out (see zipstream)
+    target_dir = camera_config.get('target_dir')
+
+    def iter_zip_entries():
+        # this will be executed in a separate subprocess
+        for batch in _iter_media_files(camera_config, media_type, prefix=group):
+            yield [(p, p[len(target_dir):].lstrip('/'), size, timestamp) for (p, timestamp, size) in batch]
+
+    logging.debug('starting zip listing process...')
+
+    entries = []
+
+    def on_done(error):
+        if error:
+            logging.error('zip listing failed: %(msg)s' % {'msg': error})
+            return callback(None)
+
+        logging.debug('zip listing process has returned %(count)s files' % {'count': len(entries)})
+        callback(entries)
+
+    mediascan.run(iter_zip_entries, on_batch=entries.extend, on_done=on_done, timeout=settings.ZIP_TIMEOUT)
 
 
-def get_media_preview(camera_config, path, media_type, width, height):
+def get_media_preview(camera_config, path, media_type, width, height, callback):
+    # calls back with the preview of a media file, or with None if there's no preview (yet)
     target_dir = camera_config.get('target_dir')
     full_path = os.path.join(target_dir, path)
     
     if media_type == 'movie':
         if not os.path.exists(full_path + '.thumb'):
-            # at this point we expect the thumb to
-            # have already been created by the thumbnailer task;
-            # if, for some reason that's not the case,
-            # we create it right away 
-            if not make_movie_preview(camera_config, full_path):
-                return None
+            # at this point we expect the thumb to have already been created in the background;
+            # if, for some reason that's not the case, it's created ahead of the others
+            # and will be available for the next request
+            if os.path.exists(full_path):
+                moviepreview.add(camera_config, full_path, priority=moviepreview.PRIORITY_INTERACTIVE)
+
+            return callback(None)
         
         full_path += '.thumb'
     
-    try:
-        with open(full_path) as f:
-            content = f.read()
-    
-    except Exception as e:
-        logging.error('failed to read file %(path)s: %(msg)s' % {
-                'path': full_path, 'msg': unicode(e)})
-        
-        return None
-    
     if width is height is None:
-        return content
-    
-    sio = StringIO.StringIO(content)
-    try:
-        image = Image.open(sio)
-    
-    except Exception as e:
-        logging.error('failed to open media preview image file: %s' % e)
-        return None
-    
-    width = width and int(width) or image.size[0]
-    height = height and int(height) or image.size[1]
-    
-    image.thumbnail((width, height), Image.LINEAR)
+        try:
+            with open(full_path) as f:
+                return callback(f.read())
 
-    sio = StringIO.StringIO()
-    image.save(sio, format='JPEG')
+        except Exception as e:
+            logging.error('failed to read file %(path)s: %(msg)s' % {
+                    'path': full_path, 'msg': unicode(e)})
+
+            return callback(None)
+
+    thumbcache.get(camera_config, full_path, width and int(width), height and int(height), callback=callback)
+
+
+def get_media_previews(camera_config, paths, media_type, width, height, on_preview, callback):
+    # calls on_preview(path, content) for each of the given media files as soon as its preview is ready,
+    # and then callback(); media files without a preview (such as movies not processed yet) are skipped
+    target_dir = os.path.normpath(camera_config.get('target_dir'))
+
+    full_paths = {}
+    for path in paths:
+        if not isinstance(path, basestring):
+            continue
+
+        # the links are followed when checking, but the thumbnails are kept under the path as given
+        if get_media_path(camera_config, path.lstrip('/')) is None:
+            continue # outside of the target dir
+
+        full_path = os.path.normpath(os.path.join(target_dir, path.lstrip('/')))
+
+        if media_type == 'movie':
+            if not os.path.exists(full_path + '.thumb') and os.path.exists(full_path):
+                moviepreview.add(camera_config, full_path, priority=moviepreview.PRIORITY_INTERACTIVE)
+                continue
+
+            full_path += '.thumb'
+
+        full_paths[full_path] = path
+
+    def on_thumb(full_path, content):
+        on_preview(full_paths[full_path], content)
 
-    return sio.getvalue()
+    thumbcache.get_many(camera_config, full_paths.keys(), width, height, on_thumb, callback)
 
 
 def del_media_content(camera_config, path, media_type):
@@ -751,7 +742,9 @@ def del_media_content(camera_config, path, media_type):
     try:
         # remove the file itself
         os.remove(full_path)
-        
+        mediaindex.remove(camera_config, full_path)
+        thumbcache.remove(camera_config, [full_path, full_path + '.thumb'])
+
         # remove the thumb file
         try:
             os.remove(full_path + '.thumb')
@@ -801,8 +794,19 @@ def del_media_group(camera_config, group, media_type):
             logging.error('failed to remove file %(path)s: %(msg)s' % {
                     'path': full_path, 'msg': unicode(e)})
 
+            # some of the files have been removed, the group needs to be scanned again
+            mediaindex.invalidate(camera_config)
+
             raise
 
+    mediaindex.remove_group(camera_config, group, media_type)
+
+    paths = [p for (p, st) in mf]  # @UnusedVariable
+    if media_type == 'movie':
+        paths += [p + '.thumb' for p in paths]
+
+    thumbcache.remove(camera_config, paths)
+
     # remove the group directory if empty or contains only thumb files
     listing = os.listdir(full_path)
     thumbs = [l for l in listing if l.endswith('.thumb')]
@@ -816,6 +820,26 @@ def del_media_group(camera_config, group, media_type):
         os.removedirs(full_path)
 
 
+def get_current_picture_etag(camera_config, width, height, profile=None):
+    import mjpgclient
+
+    camera_id = camera_config['@id']
+    
+    # this also counts as an access to the mjpg client, keeping it alive
+    if mjpgclient.get_jpg(camera_id) is None:
+        return None
+
+    seq = mjpgclient.get_jpg_seq(camera_id)
+    if seq is None:
+        return None
+
+    # frame sequences start over when motionEye is restarted
+    if profile:
+        return '"%x-%x-%s"' % (_start_time, seq, profile)
+
+    return '"%x-%x-%s-%s"' % (_start_time, seq, width or '', height or '')
+
+
 def get_current_picture(camera_config, width, height):
     import mjpgclient
 
@@ -838,7 +862,7 @@ def get_current_picture(camera_config, width, height):
     width = width and int(width) or image.size[0]
     height = height and int(height) or image.size[1]
     
-    webcam_resolution = camera_config['@webcam_resolution']
+    webcam_resolution = camera_config.get('@webcam_resolution', 100) # simple mjpeg cameras have no such setting
     max_width = image.size[0] * webcam_resolution / 100
     max_height = image.size[1] * webcam_resolution / 100
     
@@ -848,33 +872,70 @@ def get_current_picture(camera_config, width, height):
     if width >= image.size[0] and height >= image.size[1]:
         return jpg # no enlarging of the picture on the server side
     
+    camera_id = camera_config['@id']
+    seq = mjpgclient.get_jpg_seq(camera_id)
+    cached = _get_current_picture_cache(camera_id, seq, (width, height))
+    if cached is not None:
+        return cached
+
     image.thumbnail((width, height), Image.CUBIC)
 
     sio = StringIO.StringIO()
     image.save(sio, format='JPEG')
+    
+    data = sio.getvalue()
+    _set_current_picture_cache(camera_id, seq, (width, height), data)
 
-    return sio.getvalue()
+    return data
 
 
-def get_prepared_cache(key):
-    return _prepared_files.pop(key, None)
+def get_profile_picture(camera_config, profile):
+    import mjpgclient
 
+    camera_id = camera_config['@id']
+    jpg = mjpgclient.get_jpg(camera_id)
+    if jpg is None or profile == 'full':
+        return jpg
 
-def set_prepared_cache(data):
-    key = hashlib.sha1(str(time.time())).hexdigest()
+    # the rendition of a profile is shared by all the viewers of that profile
+    seq = mjpgclient.get_jpg_seq(camera_id)
+    cached = _get_current_picture_cache(camera_id, seq, ('profile', profile))
+    if cached is not None:
+        return cached
 
-    if key in _prepared_files:
-        logging.warn('key "%s" already present in prepared cache' % key)
-        
-    _prepared_files[key] = data
-    
-    def clear():
-        if _prepared_files.pop(key, None) is not None:
-            logging.warn('key "%s" was still present in the prepared cache, removed' % key)
+    width, quality = config.get_stream_profiles(camera_config)[profile]
 
-    timeout = 3600 # the user has 1 hour to download the file after creation
-    
-    io_loop = IOLoop.instance()
-    io_loop.add_timeout(datetime.timedelta(seconds=timeout), clear)
+    image = Image.open(StringIO.StringIO(jpg))
+    if width < image.size[0]:
+        image.thumbnail((width, image.size[1] * width / image.size[0]), Image.CUBIC)
+
+    sio = StringIO.StringIO()
+    image.save(sio, format='JPEG', quality=quality)
+
+    data = sio.getvalue()
+    _set_current_picture_cache(camera_id, seq, ('profile', profile), data)
+
+    return data
+
+
+def _get_current_picture_cache(camera_id, seq, key):
+    entry = _current_picture_cache.get(camera_id)
+    if entry is None or entry[0] != seq:
+        return None
+
+    return entry[1].get(key)
+
+
+def _set_current_picture_cache(camera_id, seq, key, data):
+    if seq is None:
+        return
+
+    entry = _current_picture_cache.get(camera_id)
+    if entry is None or entry[0] != seq: # a new frame has arrived, drop the old renditions
+        entry = _current_picture_cache[camera_id] = (seq, {})
+
+    renditions = entry[1]
+    if len(renditions) >= _MAX_CURRENT_PICTURE_RENDITIONS:
+        renditions.clear()
 
-    return key
+    renditions[key] = data
@@ -0,0 +1,487 @@
+
+# Copyright (c) 2013 Calin Crisan
+# This file is part of motionEye.
+#
+# motionEye is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import logging
+import os.path
+import sqlite3
+import thread
+
+import settings
+
+
+_INDEX_FILE_NAME = '.media-index-%(id)s.db'
+_SORT_COLUMNS = {'time': 'timestamp', 'size': 'size'}
+_TIMEOUT = 10 # seconds to wait for other processes to release the database
+_MAX_QUERY_ARGS = 500 # sqlite limits the number of arguments of a statement
+
+_SCHEMA = [
+    'CREATE TABLE IF NOT EXISTS media (path TEXT PRIMARY KEY, grp TEXT, media_type TEXT, timestamp REAL, size INTEGER)',
+    'CREATE INDEX IF NOT EXISTS media_by_type_timestamp ON media (media_type, timestamp)',
+    'CREATE INDEX IF NOT EXISTS media_by_type_group ON media (media_type, grp, timestamp)',
+    'CREATE INDEX IF NOT EXISTS media_by_type_size ON media (media_type, size)',
+    'CREATE INDEX IF NOT EXISTS media_by_timestamp ON media (timestamp)',
+    'CREATE TABLE IF NOT EXISTS meta (name TEXT PRIMARY KEY, value TEXT)',
+    'CREATE TABLE IF NOT EXISTS dirs (grp TEXT PRIMARY KEY, mtime REAL)',
+
+    # a summary of each group, kept up to date by triggers as files are added and removed
+    'CREATE TABLE IF NOT EXISTS media_groups (grp TEXT, media_type TEXT, count INTEGER, size INTEGER, '
+            'first REAL, last REAL, last_path TEXT, PRIMARY KEY (grp, media_type))',
+
+    'CREATE TRIGGER IF NOT EXISTS media_groups_insert AFTER INSERT ON media BEGIN '
+        # a conflicting insert would take the conflict policy of the triggering statement, hence the explicit check
+        'INSERT INTO media_groups SELECT new.grp, new.media_type, 0, 0, new.timestamp, new.timestamp, new.path '
+            'WHERE NOT EXISTS (SELECT 1 FROM media_groups WHERE grp = new.grp AND media_type = new.media_type); '
+        'UPDATE media_groups SET count = count + 1, size = size + new.size, first = MIN(first, new.timestamp), '
+            'last_path = CASE WHEN new.timestamp >= last THEN new.path ELSE last_path END, last = MAX(last, new.timestamp) '
+            'WHERE grp = new.grp AND media_type = new.media_type; '
+    'END',
+
+    'CREATE TRIGGER IF NOT EXISTS media_groups_delete AFTER DELETE ON media BEGIN '
+        'UPDATE media_groups SET count = count - 1, size = size - old.size '
+            'WHERE grp = old.grp AND media_type = old.media_type; '
+        'DELETE FROM media_groups WHERE grp = old.grp AND media_type = old.media_type AND count <= 0; '
+        'UPDATE media_groups SET '
+            'first = (SELECT MIN(timestamp) FROM media WHERE media_type = old.media_type AND grp = old.grp), '
+            'last = (SELECT MAX(timestamp) FROM media WHERE media_type = old.media_type AND grp = old.grp), '
+            'last_path = (SELECT path FROM media WHERE media_type = old.media_type AND grp = old.grp '
+                'ORDER BY timestamp DESC LIMIT 1) '
+            'WHERE grp = old.grp AND media_type = old.media_type AND (old.timestamp <= first OR old.timestamp >= last); '
+    'END'
+]
+
+# incremented whenever existing databases need to be migrated
+_SCHEMA_VERSION = 1
+
+# database connections indexed by camera id, along with the process and thread that opened them,
+# since the connections must not be shared with the forked subprocesses or other threads
+_connections = {}
+
+# the (full paths of files, full paths of dirs) whose entries were changed by this process
+# while being tracked, indexed by camera id (see track_changes())
+_tracked = {}
+
+
+def _connect(camera_config):
+    camera_id = camera_config['@id']
+    owner = (os.getpid(), thread.get_ident())
+    (conn_owner, conn) = _connections.get(camera_id, (None, None))
+    if conn is not None and conn_owner == owner:
+        return conn
+
+    path = os.path.join(settings.MEDIA_PATH, _INDEX_FILE_NAME % {'id': camera_id})
+    conn = sqlite3.connect(path, timeout=_TIMEOUT)
+    conn.text_factory = str
+
+    try:
+        conn.execute('PRAGMA journal_mode=WAL') # readers don't block the writer
+
+    except sqlite3.Error:
+        pass # not supported by older sqlite versions
+
+    # replaced rows must go through the delete trigger as well
+    conn.execute('PRAGMA recursive_triggers = ON')
+
+    for statement in _SCHEMA:
+        conn.execute(statement)
+
+    version = conn.execute('PRAGMA user_version').fetchone()[0]
+    if version < 1: # the group summary was added to an existing index
+        conn.execute('DELETE FROM media_groups')
+        conn.execute('INSERT INTO media_groups SELECT grp, media_type, COUNT(*), SUM(size), MIN(timestamp), MAX(timestamp), '
+                '(SELECT path FROM media m WHERE m.media_type = media.media_type AND m.grp = media.grp '
+                'ORDER BY timestamp DESC LIMIT 1) FROM media GROUP BY grp, media_type')
+
+    if version < _SCHEMA_VERSION:
+        conn.execute('PRAGMA user_version = %s' % _SCHEMA_VERSION)
+
+    conn.commit()
+    _connections[camera_id] = (owner, conn)
+
+    return conn
+
+
+def _relative_path(camera_config, full_path):
+    target_dir = camera_config.get('target_dir').rstrip('/')
+    if not full_path.startswith(target_dir + '/'):
+        return None
+
+    return full_path[len(target_dir):]
+
+
+def _group(path):
+    return os.path.dirname(path)[1:]
+
+
+def _group_condition(group):
+    # matches the group itself and all its subgroups
+    return ('(grp = ? OR substr(grp, 1, ?) = ?)', (group, len(group) + 1, group + '/'))
+
+
+def _execute(camera_config, statements):
+    try:
+        conn = _connect(camera_config)
+        with conn: # commits or rolls back
+            for (statement, args) in statements:
+                conn.execute(statement, args)
+
+        return True
+
+    except sqlite3.Error as e:
+        logging.error('media index of camera %(id)s failed: %(msg)s' % {
+                'id': camera_config['@id'], 'msg': unicode(e)})
+
+        return False
+
+
+def track_changes(camera_config):
+    # starts recording the files and dirs whose entries are changed by this process,
+    # so that they can be checked again once a scan running in another process has replaced the entries
+    _tracked[camera_config['@id']] = (set(), set())
+
+
+def pop_tracked_changes(camera_config):
+    # stops recording the changes and returns the (full paths of files, full paths of dirs) that were changed
+    return _tracked.pop(camera_config['@id'], (set(), set()))
+
+
+def _track(camera_config, full_paths=(), dir_paths=()):
+    tracked = _tracked.get(camera_config['@id'])
+    if tracked is not None:
+        tracked[0].update(full_paths)
+        tracked[1].update(dir_paths)
+
+
+def is_complete(camera_config):
+    try:
+        conn = _connect(camera_config)
+        rows = conn.execute('SELECT name, value FROM meta').fetchall()
+
+    except sqlite3.Error as e:
+        logging.error('media index of camera %(id)s failed: %(msg)s' % {
+                'id': camera_config['@id'], 'msg': unicode(e)})
+
+        return False
+
+    meta = dict(rows)
+
+    # the index is no longer valid when the target dir changes
+    return meta.get('complete') == '1' and meta.get('target_dir') == camera_config.get('target_dir')
+
+
+def list_media(camera_config, media_type, prefix=None):
+    # returns a list of (path, timestamp, size) tuples,
+    # or None if the index cannot be used and the media files must be listed from disk
+    return query_media(camera_config, media_type, prefix=prefix)
+
+
+def query_media(camera_config, media_type, prefix=None, sort=None, since=None, until=None, after=None, limit=None):
+    # like list_media, but sorted according to sort ('time', '-time', 'size' or '-size'),
+    # restricted to the files modified between since and until,
+    # starting right after the (sort value, path) position given by after and returning at most limit files
+    if not is_complete(camera_config):
+        return None
+
+    query = 'SELECT path, timestamp, size FROM media WHERE media_type = ?'
+    args = [media_type]
+    if prefix is not None:
+        if prefix == 'ungrouped':
+            prefix = ''
+
+        query += ' AND grp = ?'
+        args.append(prefix.strip('/'))
+
+    if since is not None:
+        query += ' AND timestamp >= ?'
+        args.append(since)
+
+    if until is not None:
+        query += ' AND timestamp <= ?'
+        args.append(until)
+
+    if sort:
+        column = _SORT_COLUMNS[sort.lstrip('-')]
+        (op, order) = ('<', 'DESC') if sort.startswith('-') else ('>', 'ASC')
+
+        if after is not None:
+            # the path breaks the ties, so that no file is skipped or repeated between pages
+            query += ' AND (%(column)s %(op)s ? OR (%(column)s = ? AND path %(op)s ?))' % {'column': column, 'op': op}
+            args += [after[0], after[0], after[1]]
+
+        query += ' ORDER BY %(column)s %(order)s, path %(order)s' % {'column': column, 'order': order}
+
+    if limit is not None:
+        query += ' LIMIT ?'
+        args.append(limit)
+
+    try:
+        return _connect(camera_config).execute(query, args).fetchall()
+
+    except sqlite3.Error as e:
+        logging.error('media index of camera %(id)s failed: %(msg)s' % {
+                'id': camera_config['@id'], 'msg': unicode(e)})
+
+        return None
+
+
+def get_timestamps(camera_config, media_type, prefix=None, since=None, until=None):
+    # returns the (id, timestamp) tuples of the files modified between since and until, sorted by timestamp,
+    # or None if the index cannot be used; the ids can be turned into paths with get_paths()
+    if not is_complete(camera_config):
+        return None
+
+    # the timestamp index alone answers this query, without reading the table
+    query = 'SELECT rowid, timestamp FROM media WHERE media_type = ?'
+    args = [media_type]
+    if prefix is not None:
+        if prefix == 'ungrouped':
+            prefix = ''
+
+        query += ' AND grp = ?'
+        args.append(prefix.strip('/'))
+
+    if since is not None:
+        query += ' AND timestamp >= ?'
+        args.append(since)
+
+    if until is not None:
+        query += ' AND timestamp <= ?'
+        args.append(until)
+
+    query += ' ORDER BY timestamp'
+
+    try:
+        return _connect(camera_config).execute(query, args).fetchall()
+
+    except sqlite3.Error as e:
+        logging.error('media index of camera %(id)s failed: %(msg)s' % {
+                'id': camera_config['@id'], 'msg': unicode(e)})
+
+        return None
+
+
+def get_paths(camera_config, ids):
+    # returns the paths of the files with the given ids, in the same order;
+    # files removed in the meantime are left out
+    paths = {}
+    try:
+        conn = _connect(camera_config)
+        for i in xrange(0, len(ids), _MAX_QUERY_ARGS):
+            batch = ids[i:i + _MAX_QUERY_ARGS]
+            query = 'SELECT rowid, path FROM media WHERE rowid IN (%s)' % ', '.join(['?'] * len(batch))
+            paths.update(conn.execute(query, batch).fetchall())
+
+    except sqlite3.Error as e:
+        logging.error('media index of camera %(id)s failed: %(msg)s' % {
+                'id': camera_config['@id'], 'msg': unicode(e)})
+
+        return None
+
+    return [paths[i] for i in ids if i in paths]
+
+
+def get_oldest(camera_config, after=None, limit=None):
+    # returns the (path, timestamp, size) tuples of the files of all media types, the oldest first,
+    # starting right after the (timestamp, path) position given by after and returning at most limit files,
+    # or None if the index cannot be used
+    if not is_complete(camera_config):
+        return None
+
+    query = 'SELECT path, timestamp, size FROM media'
+    args = []
+    if after is not None:
+        query += ' WHERE timestamp > ? OR (timestamp = ? AND path > ?)'
+        args += [after[0], after[0], after[1]]
+
+    query += ' ORDER BY timestamp, path'
+
+    if limit is not None:
+        query += ' LIMIT ?'
+        args.append(limit)
+
+    try:
+        return _connect(camera_config).execute(query, args).fetchall()
+
+    except sqlite3.Error as e:
+        logging.error('media index of camera %(id)s failed: %(msg)s' % {
+                'id': camera_config['@id'], 'msg': unicode(e)})
+
+        return None
+
+
+def get_total_size(camera_config):
+    # returns the total size of the media files, or None if the index cannot be used
+    if not is_complete(camera_config):
+        return None
+
+    try:
+        return _connect(camera_config).execute('SELECT SUM(size) FROM media_groups').fetchone()[0] or 0
+
+    except sqlite3.Error as e:
+        logging.error('media index of camera %(id)s failed: %(msg)s' % {
+                'id': camera_config['@id'], 'msg': unicode(e)})
+
+        return None
+
+
+def get_groups(camera_config, media_type):
+    # returns a list of (group, count, size, first timestamp, last timestamp, last path) tuples,
+    # or None if the index cannot be used
+    if not is_complete(camera_config):
+        return None
+
+    try:
+        return _connect(camera_config).execute('SELECT grp, count, size, first, last, last_path FROM media_groups '
+                'WHERE media_type = ? ORDER BY grp', (media_type,)).fetchall()
+
+    except sqlite3.Error as e:
+        logging.error('media index of camera %(id)s failed: %(msg)s' % {
+                'id': camera_config['@id'], 'msg': unicode(e)})
+
+        return None
+
+
+def add(camera_config, full_path, media_type, timestamp, size):
+    path = _relative_path(camera_config, full_path)
+    if path is None:
+        return
+
+    logging.debug('adding %(path)s to the media index of camera %(id)s' % {
+            'path': path, 'id': camera_config['@id']})
+
+    _track(camera_config, [full_path])
+
+    _execute(camera_config, [('INSERT OR REPLACE INTO media VALUES (?, ?, ?, ?, ?)',
+            (path, _group(path), media_type, timestamp, size))])
+
+
+def remove(camera_config, full_path):
+    path = _relative_path(camera_config, full_path)
+    if path is None:
+        return
+
+    logging.debug('removing %(path)s from the media index of camera %(id)s' % {
+            'path': path, 'id': camera_config['@id']})
+
+    _track(camera_config, [full_path])
+
+    _execute(camera_config, [('DELETE FROM media WHERE path = ?', (path,))])
+
+
+def update(camera_config, added, removed, removed_dirs=()):
+    # added is a list of (full_path, media_type, timestamp, size) tuples,
+    # removed and removed_dirs are lists of full paths
+    statements = []
+    for (full_path, media_type, timestamp, size) in added:
+        path = _relative_path(camera_config, full_path)
+        if path is not None:
+            statements.append(('INSERT OR REPLACE INTO media VALUES (?, ?, ?, ?, ?)',
+                    (path, _group(path), media_type, timestamp, size)))
+
+    for full_path in removed:
+        path = _relative_path(camera_config, full_path)
+        if path is not None:
+            statements.append(('DELETE FROM media WHERE path = ?', (path,)))
+
+    for full_path in removed_dirs:
+        path = _relative_path(camera_config, full_path)
+        if path is not None:
+            (condition, args) = _group_condition(path.strip('/'))
+            statements.append(('DELETE FROM media WHERE ' + condition, args))
+            statements.append(('DELETE FROM dirs WHERE ' + condition, args))
+
+    if not statements:
+        return
+
+    _track(camera_config, [a[0] for a in added] + list(removed), removed_dirs)
+
+    logging.debug('updating the media index of camera %(id)s: %(added)s added, %(removed)s removed' % {
+            'id': camera_config['@id'], 'added': len(added), 'removed': len(removed) + len(removed_dirs)})
+
+    _execute(camera_config, statements)
+
+
+def get_dirs(camera_config):
+    # returns the modification times of the scanned dirs, indexed by group;
+    # nothing is known about the dirs of an incomplete index
+    if not is_complete(camera_config):
+        return {}
+
+    try:
+        return dict(_connect(camera_config).execute('SELECT grp, mtime FROM dirs').fetchall())
+
+    except sqlite3.Error as e:
+        logging.error('media index of camera %(id)s failed: %(msg)s' % {
+                'id': camera_config['@id'], 'msg': unicode(e)})
+
+        return {}
+
+
+def update_dirs(camera_config, scanned, removed_groups, full):
+    # scanned is a dictionary indexed by group, with (mtime, media_files) values,
+    # media_files being a list of (full_path, media_type, timestamp, size) tuples;
+    # a full scan replaces the entire index
+    try:
+        conn = _connect(camera_config)
+        with conn:
+            if full:
+                conn.execute('DELETE FROM media')
+                conn.execute('DELETE FROM dirs')
+
+            for group in removed_groups:
+                conn.execute('DELETE FROM media WHERE grp = ?', (group,))
+                conn.execute('DELETE FROM dirs WHERE grp = ?', (group,))
+
+            for group, (mtime, media_files) in scanned.iteritems():
+                rows = []
+                for (full_path, media_type, timestamp, size) in media_files:
+                    path = _relative_path(camera_config, full_path)
+                    if path is not None:
+                        rows.append((path, group, media_type, timestamp, size))
+
+                conn.execute('DELETE FROM media WHERE grp = ?', (group,))
+                conn.executemany('INSERT OR REPLACE INTO media VALUES (?, ?, ?, ?, ?)', rows)
+                conn.execute('INSERT OR REPLACE INTO dirs VALUES (?, ?)', (group, mtime))
+
+            if full:
+                conn.execute('INSERT OR REPLACE INTO meta VALUES (?, ?)', ('target_dir', camera_config.get('target_dir')))
+                conn.execute('INSERT OR REPLACE INTO meta VALUES (?, ?)', ('complete', '1'))
+
+        return True
+
+    except sqlite3.Error as e:
+        logging.error('failed to update the media index of camera %(id)s: %(msg)s' % {
+                'id': camera_config['@id'], 'msg': unicode(e)})
+
+        return False
+
+
+def remove_group(camera_config, group, media_type):
+    if group == 'ungrouped':
+        group = ''
+
+    logging.debug('removing group "%(group)s" from the media index of camera %(id)s' % {
+            'group': group, 'id': camera_config['@id']})
+
+    _track(camera_config, dir_paths=[os.path.join(camera_config.get('target_dir'), group.strip('/'))])
+
+    _execute(camera_config, [('DELETE FROM media WHERE media_type = ? AND grp = ?', (media_type, group.strip('/')))])
+
+
+def invalidate(camera_config):
+    logging.debug('invalidating the media index of camera %(id)s' % {'id': camera_config['@id']})
+
+    _execute(camera_config, [('INSERT OR REPLACE INTO meta VALUES (?, ?)', ('complete', '0'))])
@@ -0,0 +1,262 @@
+
+# Copyright (c) 2013 Calin Crisan
+# This file is part of motionEye.
+#
+# motionEye is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import datetime
+import logging
+import multiprocessing
+import os
+import Queue
+import signal
+import stat
+import sys
+import threading
+
+from tornado.ioloop import IOLoop
+
+# scandir is a dependency (see setup.py), but motionEye may also be run from a source tree without it;
+# the dirs are then listed with listdir() and every entry is stat-ed, which is noticeably slower
+try:
+    from scandir import scandir
+
+except ImportError:
+    scandir = None
+
+
+WORKERS = 4 # directories listed at once; the workers are threads, as they mostly wait for the file system
+BATCH_SIZE = 1000 # files sent back at once
+
+_KILL_DELAY = 5 # seconds to wait for a terminated subprocess before killing it
+
+
+class _Failure(object):
+    # sent through the pipe instead of a batch when the generator fails
+
+    def __init__(self, msg):
+        self.msg = msg
+
+
+def walk(path, accept=None, workers=WORKERS, batch_size=BATCH_SIZE):
+    # yields lists of (full_path, stat) tuples for the regular files found under path,
+    # skipping hidden files and dirs; accept(name) may be given to filter the files by name
+    batch = []
+    for (dir_path, files, subdirs) in walk_dirs(path, accept=accept, workers=workers):  # @UnusedVariable
+        batch.extend(files)
+        while len(batch) >= batch_size:
+            yield batch[:batch_size]
+            batch = batch[batch_size:]
+
+    if batch:
+        yield batch
+
+
+def walk_dirs(path, accept=None, workers=WORKERS, lister=None):
+    # yields a (dir_path, files, subdirs) tuple for path and for each dir found under it, in no particular order,
+    # as returned by list_dir(dir_path, accept); the dirs that cannot be listed are logged and yielded empty;
+    # lister(dir_path) may be given to list the dirs instead, e.g. to skip the dirs known to be unchanged
+    # by returning only their subdirs; it is called from the worker threads
+    if lister is None:
+        lister = lambda dir_path: list_dir(dir_path, accept)
+
+    dirs = Queue.Queue()
+    results = Queue.Queue()
+    stopped = threading.Event()
+
+    def work():
+        while True:
+            dir_path = dirs.get()
+            if dir_path is None:
+                return
+
+            if stopped.is_set():
+                continue # the walk has been abandoned, the remaining dirs are not listed anymore
+
+            try:
+                (files, subdirs) = lister(dir_path)
+
+            except OSError as e:
+                logging.error('failed to list %(path)s: %(msg)s' % {'path': dir_path, 'msg': unicode(e)})
+
+                (files, subdirs) = ([], [])
+
+            except Exception as e:
+                logging.error('failed to list %(path)s: %(msg)s' % {'path': dir_path, 'msg': unicode(e)}, exc_info=True)
+
+                (files, subdirs) = ([], [])
+
+            results.put((dir_path, files, subdirs))
+
+    threads = [threading.Thread(target=work) for i in xrange(max(1, workers))]  # @UnusedVariable
+    for thread in threads:
+        thread.daemon = True
+        thread.start()
+
+    dirs.put(path)
+    pending = 1
+
+    try:
+        while pending:
+            (dir_path, files, subdirs) = results.get()
+            pending -= 1
+
+            for subdir_path in subdirs:
+                dirs.put(subdir_path)
+                pending += 1
+
+            yield (dir_path, files, subdirs)
+
+    finally:
+        stopped.set()
+        for thread in threads:
+            dirs.put(None)
+
+        for thread in threads:
+            thread.join()
+
+
+def list_dir(dir_path, accept=None):
+    # returns the (full_path, stat) tuples of the regular files directly under a dir and the paths of its subdirs,
+    # skipping hidden files and dirs; accept(name) may be given to filter the files by name;
+    # raises OSError if the dir cannot be listed
+    files = []
+    subdirs = []
+
+    if scandir:
+        # directory entries tell dirs apart without stat-ing every file
+        for entry in scandir(dir_path):
+            name = entry.name
+            if name.startswith('.') or name == 'lastsnap.jpg':
+                continue
+
+            try:
+                if entry.is_dir(follow_symlinks=False):
+                    subdirs.append(entry.path)
+
+                elif entry.is_file(follow_symlinks=False) and (accept is None or accept(name)):
+                    files.append((entry.path, entry.stat(follow_symlinks=False)))
+
+            except OSError as e: # e.g. removed in the meantime
+                logging.debug('failed to stat %(path)s: %(msg)s' % {'path': entry.path, 'msg': unicode(e)})
+
+    else:
+        for name in os.listdir(dir_path):
+            if name.startswith('.') or name == 'lastsnap.jpg':
+                continue
+
+            full_path = os.path.join(dir_path, name)
+            try:
+                st = os.lstat(full_path)
+
+            except OSError as e: # e.g. removed in the meantime
+                logging.debug('failed to stat %(path)s: %(msg)s' % {'path': full_path, 'msg': unicode(e)})
+                continue
+
+            if stat.S_ISDIR(st.st_mode):
+                subdirs.append(full_path)
+
+            elif stat.S_ISREG(st.st_mode) and (accept is None or accept(name)):
+                files.append((full_path, st))
+
+    return (files, subdirs)
+
+
+def run(generator, on_batch, on_done, timeout=None):
+    # runs generator in a subprocess and calls on_batch with each of the (picklable) items it yields,
+    # as soon as they arrive; on_done is called at the end, with an error message if the generator
+    # or the subprocess failed
+    def do_run(pipe):
+        # this will be executed in a separate subprocess
+        try:
+            for batch in generator():
+                pipe.send(batch)
+
+        except Exception as e:
+            logging.error('media scan failed: %(msg)s' % {'msg': unicode(e)}, exc_info=True)
+
+            pipe.send(_Failure(unicode(e)))
+            pipe.close()
+            sys.exit(1)
+
+        pipe.close()
+
+    (parent_pipe, child_pipe) = multiprocessing.Pipe(duplex=False)
+    process = multiprocessing.Process(target=do_run, args=(child_pipe, ))
+    process.start()
+    child_pipe.close() # so that the end of the subprocess is seen as the end of the pipe
+
+    io_loop = IOLoop.instance()
+    state = {'timeout': None, 'error': None}
+
+    def finish(error=None):
+        io_loop.remove_handler(parent_pipe.fileno())
+        if state['timeout']:
+            io_loop.remove_timeout(state['timeout'])
+
+        parent_pipe.close()
+        on_done(error)
+
+    def on_readable(fd, events):
+        try:
+            batch = parent_pipe.recv()
+
+        except (EOFError, IOError): # the subprocess has finished
+            process.join()
+            if state['error'] is None and process.exitcode != 0:
+                state['error'] = 'media scan process exited with code %s' % process.exitcode
+
+            finish(state['error'])
+
+            return
+
+        if isinstance(batch, _Failure):
+            state['error'] = batch.msg
+
+        else:
+            on_batch(batch)
+
+    def on_timeout():
+        state['timeout'] = None
+        logging.error('timeout waiting for the media scan process to finish')
+
+        try:
+            os.kill(process.pid, signal.SIGTERM)
+
+        except:
+            pass # nevermind
+
+        finish('timeout')
+        reap(_KILL_DELAY)
+
+    def reap(attempts):
+        # is_alive() collects the exit status of a finished subprocess, which join() then returns right away
+        if not process.is_alive():
+            process.join()
+            return
+
+        if not attempts:
+            logging.error('media scan process did not terminate, killing it')
+
+            try:
+                os.kill(process.pid, signal.SIGKILL)
+
+            except:
+                pass # nevermind
+
+        io_loop.add_timeout(datetime.timedelta(seconds=1), reap, max(0, attempts - 1))
+
+    io_loop.add_handler(parent_pipe.fileno(), on_readable, IOLoop.READ)
+    if timeout:
+        state['timeout'] = io_loop.add_timeout(datetime.timedelta(seconds=timeout), on_timeout)
@@ -0,0 +1,535 @@
+
+# Copyright (c) 2013 Calin Crisan
+# This file is part of motionEye.
+#
+# motionEye is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import collections
+import ctypes
+import ctypes.util
+import datetime
+import errno
+import logging
+import multiprocessing
+import os
+import stat
+import struct
+import threading
+import time
+
+from tornado.ioloop import IOLoop
+
+import config
+import mediafiles
+import mediaindex
+import mediascan
+import settings
+import utils
+
+
+_SYNC_INTERVAL = 10 # seconds
+_BATCH_DELAY = 1 # seconds during which changes are gathered before updating the media index
+_MAX_LAG = 30 # seconds behind the file system after which a warning is logged
+
+_IN_CLOSE_WRITE = 0x00000008
+_IN_MOVED_FROM = 0x00000040
+_IN_MOVED_TO = 0x00000080
+_IN_CREATE = 0x00000100
+_IN_DELETE = 0x00000200
+_IN_Q_OVERFLOW = 0x00004000
+_IN_IGNORED = 0x00008000
+_IN_ONLYDIR = 0x01000000
+_IN_ISDIR = 0x40000000
+_IN_NONBLOCK = 0x00000800
+_IN_CLOEXEC = 0x00080000
+
+_WATCH_MASK = _IN_CLOSE_WRITE | _IN_MOVED_FROM | _IN_MOVED_TO | _IN_CREATE | _IN_DELETE | _IN_ONLYDIR
+_EVENT_HEADER = struct.Struct('iIII')
+
+_libc = None
+_fd = None
+
+# watched dirs indexed by watch descriptor, and the other way around
+_watches = {}
+_watch_descriptors = {}
+
+# target dirs of the cameras whose media is followed using inotify,
+# and of those whose media is periodically scanned instead, indexed by camera id
+_watched_cameras = {}
+_scanned_cameras = {}
+
+# changes waiting to be applied to the media index, indexed by full path
+_pending = collections.OrderedDict()
+_pending_since = None
+_flush_timeout = None
+
+# (process, start time) of the scans in progress, and the start time of the last completed scans,
+# indexed by camera id
+_scans = {}
+_last_scans = {}
+
+
+def start():
+    global _libc
+    global _fd
+
+    try:
+        _libc = ctypes.CDLL(ctypes.util.find_library('c') or 'libc.so.6', use_errno=True)
+        _fd = _libc.inotify_init1(_IN_NONBLOCK | _IN_CLOEXEC)
+        if _fd < 0:
+            raise OSError(ctypes.get_errno(), os.strerror(ctypes.get_errno()))
+
+    except (OSError, AttributeError) as e:
+        logging.warning('inotify is not available (%(msg)s), media dirs will be periodically scanned instead' % {
+                'msg': unicode(e)})
+
+        _fd = None
+
+    io_loop = IOLoop.instance()
+    if _fd is not None:
+        io_loop.add_handler(_fd, _on_inotify_events, IOLoop.READ)
+
+    io_loop.add_timeout(datetime.timedelta(seconds=1), _sync)
+
+
+def stop():
+    global _fd
+
+    for camera_id, (process, started) in _scans.items():  # @UnusedVariable
+        if process.is_alive():
+            logging.debug('terminating media scan of camera %(id)s' % {'id': camera_id})
+            process.terminate()
+
+    _scans.clear()
+
+    if _fd is not None:
+        IOLoop.instance().remove_handler(_fd)
+        os.close(_fd)
+        _fd = None
+
+
+def _sync():
+    # schedule the next call
+    io_loop = IOLoop.instance()
+    io_loop.add_timeout(datetime.timedelta(seconds=_SYNC_INTERVAL), _sync)
+
+    _check_scans()
+
+    wanted = {}
+    for camera_id in config.get_camera_ids():
+        camera_config = config.get_camera(camera_id)
+        if utils.local_motion_camera(camera_config) and camera_config['@enabled']:
+            wanted[camera_id] = camera_config
+
+    # forget the cameras that were removed or whose target dir has changed
+    for camera_id, target_dir in _watched_cameras.items():
+        if camera_id not in wanted or wanted[camera_id]['target_dir'] != target_dir:
+            logging.debug('no longer watching media of camera %(id)s' % {'id': camera_id})
+
+            del _watched_cameras[camera_id]
+            if target_dir not in _watched_cameras.values():
+                _unwatch_tree(target_dir)
+
+    for camera_id, target_dir in _scanned_cameras.items():
+        if camera_id not in wanted or wanted[camera_id]['target_dir'] != target_dir:
+            logging.debug('no longer scanning media of camera %(id)s' % {'id': camera_id})
+
+            del _scanned_cameras[camera_id]
+            _last_scans.pop(camera_id, None)
+
+    now = time.time()
+    for camera_id, camera_config in wanted.items():
+        target_dir = camera_config['target_dir']
+
+        if camera_id in _scanned_cameras:
+            if settings.MEDIA_RESCAN_INTERVAL and now - _last_scans.get(camera_id, now) >= settings.MEDIA_RESCAN_INTERVAL:
+                _start_scan(camera_config)
+
+            continue
+
+        if camera_id in _watched_cameras or not os.path.isdir(target_dir):
+            continue
+
+        # inotify does not report the changes made by other hosts to network shares
+        if _fd is not None and camera_config.get('@storage_device') != 'network-share':
+            _watched_cameras[camera_id] = target_dir
+            _watch_tree(target_dir, callback=lambda ok, camera_config=camera_config: _on_camera_watched(camera_config, ok))
+
+        else:
+            logging.debug('periodically scanning media of camera %(id)s in %(dir)s' % {
+                    'id': camera_id, 'dir': target_dir})
+
+            _scanned_cameras[camera_id] = target_dir
+
+            # catch up with the changes made while the camera was not followed
+            _start_scan(camera_config)
+
+
+def _on_camera_watched(camera_config, ok):
+    camera_id = camera_config['@id']
+    target_dir = camera_config['target_dir']
+    if _watched_cameras.get(camera_id) != target_dir:
+        return # no longer wanted in the meantime
+
+    if ok:
+        logging.debug('watching media of camera %(id)s in %(dir)s' % {'id': camera_id, 'dir': target_dir})
+
+    else:
+        logging.debug('periodically scanning media of camera %(id)s in %(dir)s' % {
+                'id': camera_id, 'dir': target_dir})
+
+        del _watched_cameras[camera_id]
+        _scanned_cameras[camera_id] = target_dir
+
+    # catch up with the changes made while the camera was not followed
+    _start_scan(camera_config)
+
+
+def _watch_tree(path, queue_files=False, callback=None):
+    # large trees take a while to walk, so the watches are added by a separate thread;
+    # the changes made to the dirs already watched are reported meanwhile, as usual;
+    # callback(ok) is called on the IO loop once done
+    io_loop = IOLoop.instance()
+
+    if queue_files:
+        accept = lambda name: mediafiles.get_media_type(name) or name.endswith('.thumb')
+
+    else:
+        accept = lambda name: False
+
+    def do_watch():
+        file_paths = []
+        err = None
+        for (dir_path, files, subdirs) in mediascan.walk_dirs(path, accept=accept):  # @UnusedVariable
+            wd = _libc.inotify_add_watch(_fd, dir_path, _WATCH_MASK)
+            if wd < 0:
+                err = ctypes.get_errno()
+                if err == errno.ENOENT:
+                    err = None
+                    continue # removed in the meantime
+
+                logging.error('failed to watch %(path)s: %(msg)s' % {'path': dir_path, 'msg': os.strerror(err)})
+
+                if err == errno.ENOSPC:
+                    logging.error('the inotify watch limit has been reached, consider raising fs.inotify.max_user_watches')
+
+                break
+
+            _watches[wd] = dir_path
+            _watch_descriptors[dir_path] = wd
+
+            if queue_files:
+                # files may have been added before the watch was in place
+                file_paths += [full_path for (full_path, st) in files]  # @UnusedVariable
+
+        io_loop.add_callback(on_watched, err is None, file_paths)
+
+    def on_watched(ok, file_paths):
+        if not ok:
+            _unwatch_tree(path)
+
+        else:
+            for file_path in file_paths:
+                _queue(file_path, 'file')
+
+        if callback:
+            callback(ok)
+
+    thread = threading.Thread(target=do_watch)
+    thread.daemon = True
+    thread.start()
+
+
+def _unwatch_tree(path):
+    prefix = path.rstrip('/') + '/'
+    for dir_path, wd in _watch_descriptors.items():
+        if dir_path == path or dir_path.startswith(prefix):
+            _libc.inotify_rm_watch(_fd, wd)
+            _watches.pop(wd, None)
+            del _watch_descriptors[dir_path]
+
+
+def _on_inotify_events(fd, events):
+    try:
+        data = os.read(_fd, 65536)
+
+    except OSError as e:
+        if e.errno not in [errno.EAGAIN, errno.EINTR]:
+            logging.error('failed to read inotify events: %(msg)s' % {'msg': unicode(e)})
+
+        return
+
+    offset = 0
+    while offset + _EVENT_HEADER.size <= len(data):
+        (wd, mask, cookie, length) = _EVENT_HEADER.unpack_from(data, offset)  # @UnusedVariable
+        name = data[offset + _EVENT_HEADER.size:offset + _EVENT_HEADER.size + length].rstrip('\0')
+        offset += _EVENT_HEADER.size + length
+
+        if mask & _IN_Q_OVERFLOW:
+            logging.warning('inotify event queue overflowed, scanning all the watched media dirs')
+
+            for camera_id in _watched_cameras:
+                camera_config = config.get_camera(camera_id)
+                mediaindex.invalidate(camera_config)
+                _start_scan(camera_config)
+
+            continue
+
+        dir_path = _watches.get(wd)
+        if dir_path is None:
+            continue
+
+        if mask & _IN_IGNORED: # the dir was removed
+            del _watches[wd]
+            _watch_descriptors.pop(dir_path, None)
+            continue
+
+        if not name or name.startswith('.') or name == 'lastsnap.jpg':
+            continue
+
+        path = os.path.join(dir_path, name)
+        if mask & _IN_ISDIR:
+            if mask & (_IN_CREATE | _IN_MOVED_TO): # e.g. a new date dir
+                _watch_tree(path, queue_files=True)
+
+            elif mask & (_IN_DELETE | _IN_MOVED_FROM):
+                _unwatch_tree(path)
+                _queue(path, 'remove_dir')
+
+        elif mask & (_IN_CLOSE_WRITE | _IN_MOVED_TO):
+            _queue(path, 'file')
+
+        elif mask & (_IN_DELETE | _IN_MOVED_FROM):
+            _queue(path, 'remove')
+
+
+def _queue(path, action):
+    global _pending_since
+    global _flush_timeout
+
+    _pending.pop(path, None) # keeps the order of the changes
+    _pending[path] = action
+
+    if _pending_since is None:
+        _pending_since = time.time()
+
+    if _flush_timeout is None:
+        io_loop = IOLoop.instance()
+        _flush_timeout = io_loop.add_timeout(datetime.timedelta(seconds=_BATCH_DELAY), _flush)
+
+
+def _flush():
+    global _pending_since
+    global _flush_timeout
+
+    pending = _pending.items()
+    pending_since = _pending_since
+
+    _pending.clear()
+    _pending_since = None
+    _flush_timeout = None
+
+    for camera_id, target_dir in _watched_cameras.items():
+        prefix = target_dir.rstrip('/') + '/'
+        added = []
+        removed = []
+        removed_dirs = []
+        for path, action in pending:
+            if not path.startswith(prefix):
+                continue
+
+            if action == 'remove_dir':
+                removed_dirs.append(path)
+                continue
+
+            media_type = mediafiles.get_media_type(path)
+            if not media_type:
+                continue
+
+            if action == 'remove':
+                removed.append(path)
+                continue
+
+            try:
+                st = os.stat(path)
+
+            except OSError: # removed in the meantime
+                removed.append(path)
+                continue
+
+            if stat.S_ISREG(st.st_mode):
+                added.append((path, media_type, st.st_mtime, st.st_size))
+
+        if not (added or removed or removed_dirs):
+            continue
+
+        mediaindex.update(config.get_camera(camera_id), added, removed, removed_dirs)
+
+        lag = time.time() - pending_since
+        if lag > _MAX_LAG:
+            logging.warning('media index of camera %(id)s is %(lag)d seconds behind' % {'id': camera_id, 'lag': lag})
+
+        else:
+            logging.debug('media index of camera %(id)s updated, %(lag).1f seconds behind' % {'id': camera_id, 'lag': lag})
+
+
+def _start_scan(camera_config):
+    camera_id = camera_config['@id']
+    if camera_id in _scans:
+        return # already scanning
+
+    logging.debug('starting media scan of camera %(id)s...' % {'id': camera_id})
+
+    # the scan replaces the entries with what it finds, so the changes made meanwhile are applied again afterwards
+    mediaindex.track_changes(camera_config)
+
+    process = multiprocessing.Process(target=_do_scan, args=(camera_config, ))
+    process.start()
+
+    _scans[camera_id] = (process, time.time())
+
+
+def _check_scans():
+    now = time.time()
+    for camera_id, (process, started) in _scans.items():
+        if process.is_alive():
+            continue
+
+        del _scans[camera_id]
+        _last_scans[camera_id] = started
+
+        camera_config = config.get_camera(camera_id)
+        if camera_config:
+            (full_paths, dir_paths) = mediaindex.pop_tracked_changes(camera_config)
+            if full_paths or dir_paths:
+                _replay(camera_config, full_paths, dir_paths)
+
+        if camera_id in _scanned_cameras and settings.MEDIA_RESCAN_INTERVAL and now - started > settings.MEDIA_RESCAN_INTERVAL:
+            logging.warning('media scan of camera %(id)s took %(duration)d seconds, longer than the rescan interval' % {
+                    'id': camera_id, 'duration': now - started})
+
+        else:
+            logging.debug('media scan of camera %(id)s done in %(duration)d seconds' % {
+                    'id': camera_id, 'duration': now - started})
+
+
+def _replay(camera_config, full_paths, dir_paths):
+    # checks again the files and dirs whose entries were changed while the camera was being scanned
+    logging.debug('checking %(count)s media changes made during the scan of camera %(id)s' % {
+            'count': len(full_paths) + len(dir_paths), 'id': camera_config['@id']})
+
+    target_dir = camera_config['target_dir']
+    listed = {}
+    removed_dirs = []
+    for dir_path in dir_paths:
+        if os.path.isdir(dir_path):
+            group = os.path.relpath(dir_path, target_dir)
+            if group == '.':
+                group = ''
+
+            try:
+                (files, subdirs) = mediascan.list_dir(dir_path, accept=mediafiles.get_media_type)  # @UnusedVariable
+
+            except OSError as e:
+                logging.error('failed to list %(path)s: %(msg)s' % {'path': dir_path, 'msg': unicode(e)})
+                continue
+
+            # listed again at the next scan
+            listed[group] = (0, [(p, mediafiles.get_media_type(p), st.st_mtime, st.st_size) for (p, st) in files])
+
+        else:
+            removed_dirs.append(dir_path)
+
+    if listed:
+        mediaindex.update_dirs(camera_config, listed, [], False)
+
+    added = []
+    removed = []
+    for full_path in full_paths:
+        media_type = mediafiles.get_media_type(full_path)
+        if not media_type:
+            continue
+
+        try:
+            st = os.lstat(full_path)
+
+        except OSError:
+            removed.append(full_path)
+            continue
+
+        if stat.S_ISREG(st.st_mode):
+            added.append((full_path, media_type, st.st_mtime, st.st_size))
+
+    mediaindex.update(camera_config, added, removed, removed_dirs)
+
+
+def _do_scan(camera_config):
+    # this will be executed in a separate subprocess;
+    # only the dirs whose modification time has changed since the previous scan are listed
+    target_dir = camera_config['target_dir']
+    started = time.time()
+
+    known = mediaindex.get_dirs(camera_config)
+    full = not known
+    scanned = {}
+    seen = set()
+
+    subgroups = {}
+    for group in known:
+        if group:
+            subgroups.setdefault(os.path.dirname(group), []).append(group)
+
+    def get_group(dir_path):
+        group = os.path.relpath(dir_path, target_dir)
+        if group == '.':
+            group = ''
+
+        return group
+
+    def list_dir(dir_path):
+        # called from the threads of the walk
+        try:
+            st = os.stat(dir_path)
+
+        except OSError:
+            return ([], []) # removed in the meantime
+
+        group = get_group(dir_path)
+        seen.add(group)
+
+        if not full and known.get(group) == st.st_mtime:
+            # an unchanged dir still contains the same files and subdirs
+            return ([], [os.path.join(target_dir, subgroup) for subgroup in subgroups.get(group, [])])
+
+        (files, subdirs) = mediascan.list_dir(dir_path, accept=mediafiles.get_media_type)
+
+        # changes made within the mtime granularity of a recently modified dir would go unnoticed,
+        # so such dirs are listed again at the next scan
+        mtime = st.st_mtime
+        if mtime >= started - 2:
+            mtime = 0
+
+        media_files = [(p, mediafiles.get_media_type(p), file_st.st_mtime, file_st.st_size) for (p, file_st) in files]
+        scanned[group] = (mtime, media_files)
+
+        return ([], subdirs)
+
+    for entry in mediascan.walk_dirs(target_dir, lister=list_dir):  # @UnusedVariable
+        pass
+
+    removed_groups = [group for group in known if group not in seen]
+    mediaindex.update_dirs(camera_config, scanned, removed_groups, full)
+
+    logging.debug('media scan of camera %(id)s: %(scanned)s dirs listed, %(removed)s dirs removed' % {
+            'id': camera_config['@id'], 'scanned': len(scanned), 'removed': len(removed_groups)})
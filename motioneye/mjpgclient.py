@@ -15,15 +15,19 @@
 # You should have received a copy of the GNU General Public License
 # along with this program.  If not, see <http://www.gnu.org/licenses/>. 
 
+import collections
 import datetime
 import errno
+import functools
 import logging
 import re
 import socket
+import ssl
 import time
+import urlparse
 
 from tornado.ioloop import IOLoop
-from tornado.iostream import IOStream
+from tornado.iostream import IOStream, SSLIOStream, StreamClosedError
 
 import config
 import motionctl
@@ -31,51 +35,309 @@ import settings
 import utils
 
 
+# callbacks to be notified about each new frame, indexed by camera id;
+# they outlive the mjpg clients, which come and go with motion restarts
+_subscribers = {}
+
+# the sequence number of the last frame received for each camera,
+# kept across client reconnects so that it only ever increases
+_last_seqs = {}
+
+# the health of the connection to each camera's stream, indexed by camera id:
+# the number of consecutive failures and the time of the next reconnection attempt
+_health = {}
+
+# the authentication details learned from each camera's stream server, indexed by camera id;
+# they are reused by the next clients, as some servers close the connection after a 401
+_auth_states = {}
+
+# the time when motion was last restarted because of failing mjpg clients
+_last_motion_restart_time = 0
+
+# the number of consecutive failures after which the motion thread of a camera is restarted
+_THREAD_RESTART_FAILURES = 3
+
+# the number of consecutive failures after which motion itself is restarted
+_MOTION_RESTART_FAILURES = 6
+
+
+class FrameBuffer(object):
+    def __init__(self, max_frames, max_size):
+        self._max_frames = max_frames
+        self._max_size = max_size
+        self._frames = collections.deque()
+        self._size = 0
+
+    def add(self, seq, timestamp, jpg):
+        if not self._max_frames or len(jpg) > self._max_size:
+            return
+
+        self._frames.append((seq, timestamp, jpg))
+        self._size += len(jpg)
+
+        while len(self._frames) > self._max_frames or self._size > self._max_size:
+            self._size -= len(self._frames.popleft()[2])
+
+    def get_since(self, seq=None, timestamp=None):
+        frames = []
+        for frame in reversed(self._frames): # frames are looked up from the newest one
+            if seq is not None and frame[0] <= seq:
+                break
+
+            if timestamp is not None and frame[1] < timestamp:
+                break
+
+            frames.append(frame)
+
+        frames.reverse()
+
+        return frames
+
+
+class MjpgParser(object):
+    # reads the frames of a multipart response from a stream, following its HTTP status line;
+    # as long as the parts give their length, each frame is read straight out of the stream buffer;
+    # otherwise the data is gathered into a buffer of our own, searched for the end of each frame,
+    # each search resuming where the previous one stopped
+
+    _MAX_HEADERS_SIZE = 65536
+    _MAX_FRAME_SIZE = 16 * 1024 * 1024
+    _READ_CHUNK_SIZE = 65536
+
+    _BOUNDARY_REGEX = re.compile('boundary="?([^";\r\n]+)', re.IGNORECASE)
+    _PART_HEADERS_REGEX = re.compile('[^\r\n][\s\S]*?\r\n\r\n') # skipping the line breaks that precede them
+    _CONTENT_LENGTH_REGEX = re.compile('content-length:\s*(\d+)', re.IGNORECASE)
+
+    _JPEG_SOI = '\xff\xd8'
+    _JPEG_EOI = '\xff\xd9'
+
+    def __init__(self, stream, on_jpg, on_error):
+        self._stream = stream
+        self._on_jpg = on_jpg
+        self._on_error = on_error
+        self._boundary = None
+
+        # used only once a part without length is met
+        self._buffer = None
+        self._pos = 0 # the start of the unparsed data in the buffer
+        self._scanned = 0 # the offset at which the current search resumes
+        self._in_part = False # between the headers of a part and the end of its frame
+        self._length = None # the length of the current frame, if given in the part headers
+        self._frame_start = None # the offset of the current frame, once its start is known
+
+    def start(self):
+        self._read(self._stream.read_until, '\r\n\r\n', self._on_response_headers, max_bytes=self._MAX_HEADERS_SIZE)
+
+    def _read(self, method, *args, **kwargs):
+        try:
+            method(*args, **kwargs)
+
+        except StreamClosedError:
+            pass # the close callback takes care of the rest
+
+    def _on_response_headers(self, data):
+        m = self._BOUNDARY_REGEX.search(data)
+        if m:
+            boundary = m.group(1).strip()
+            if not boundary.startswith('--'):
+                boundary = '--' + boundary
+
+            self._boundary = boundary
+
+        self._read_part_headers()
+
+    def _read_part_headers(self):
+        self._read(self._stream.read_until_regex, self._PART_HEADERS_REGEX, self._on_part_headers,
+                max_bytes=self._MAX_HEADERS_SIZE)
+
+    def _on_part_headers(self, data):
+        m = self._CONTENT_LENGTH_REGEX.search(data)
+        if m and int(m.group(1)) <= self._MAX_FRAME_SIZE:
+            self._read(self._stream.read_bytes, int(m.group(1)), self._on_frame)
+
+        elif m:
+            self._on_error('mjpg frame too large')
+
+        else:
+            self._buffer = bytearray()
+            self._in_part = True
+            self._read_data()
+
+    def _on_frame(self, data):
+        self._on_jpg(data)
+        self._read_part_headers()
+
+    def _read_data(self):
+        self._read(self._stream.read_bytes, self._READ_CHUNK_SIZE, self._on_data, partial=True)
+
+    def _on_data(self, data):
+        self._buffer += data
+
+        try:
+            while self._parse():
+                pass
+
+            if len(self._buffer) - self._pos > self._MAX_FRAME_SIZE:
+                raise Exception('mjpg frame too large')
+
+        except Exception as e:
+            return self._on_error(e)
+
+        # the parsed data is dropped only once it outweighs the rest, which is cheaper than after each frame
+        if self._pos > len(self._buffer) - self._pos:
+            del self._buffer[:self._pos]
+            self._scanned -= self._pos
+            if self._frame_start is not None:
+                self._frame_start -= self._pos
+
+            self._pos = 0
+
+        self._read_data()
+
+    def _parse(self):
+        if not self._in_part:
+            return self._parse_part_headers()
+
+        if self._length is not None:
+            end = self._frame_start + self._length
+            if end > len(self._buffer):
+                return False
+
+        else:
+            end = self._find_frame_end()
+            if end < 0:
+                return False
+
+        jpg = memoryview(self._buffer)[self._frame_start:end].tobytes()
+
+        self._pos = self._scanned = end
+        self._frame_start = None
+        self._in_part = False
+        self._on_jpg(jpg)
+
+        return True
+
+    def _parse_part_headers(self):
+        # skip the line breaks that separate a frame from the next part
+        while self._buffer.startswith('\r\n', self._pos):
+            self._pos += 2
+
+        end = self._find('\r\n\r\n', self._pos)
+        if end < 0:
+            if len(self._buffer) - self._pos > self._MAX_HEADERS_SIZE:
+                raise Exception('mjpg headers too long')
+
+            return False
+
+        m = self._CONTENT_LENGTH_REGEX.search(str(self._buffer[self._pos:end]))
+        self._pos = self._scanned = self._frame_start = end + 4
+
+        if m:
+            self._length = int(m.group(1))
+            if self._length > self._MAX_FRAME_SIZE:
+                raise Exception('mjpg frame too large')
+
+        else:
+            self._length = None
+            self._frame_start = None # known once the start of image marker is found
+
+        self._in_part = True
+        
+        return True
+
+    def _find(self, sub, start):
+        # finds sub at or after start, remembering how far the buffer has been searched in case it's not there yet
+        start = max(start, self._scanned)
+        pos = self._buffer.find(sub, start)
+        if pos < 0:
+            self._scanned = max(start, len(self._buffer) - len(sub) + 1)
+
+        return pos
+
+    def _find_frame_end(self):
+        # no content length, look for the end of the jpeg data instead;
+        # any garbage preceding the start of image marker is skipped
+        if self._frame_start is None:
+            start = self._find(self._JPEG_SOI, self._pos)
+            if start < 0:
+                return -1
+
+            self._pos = self._frame_start = start
+            self._scanned = start + 2
+
+        if self._boundary:
+            end = self._find(self._boundary, self._frame_start)
+            if end < 0:
+                return -1
+            
+            while end > self._frame_start + 2 and self._buffer.startswith('\r\n', end - 2):
+                end -= 2
+
+            return end
+
+        end = self._find(self._JPEG_EOI, self._frame_start + 2)
+        if end < 0:
+            return -1
+
+        return end + 2
+
+
 class MjpgClient(IOStream):
     _FPS_LEN = 4
+    _READ_CHUNK_SIZE = 65536
     
     clients = {} # dictionary of clients indexed by camera id
-    _last_erroneous_close_time = 0 # helps detecting erroneous connections and restart motion
 
-    def __init__(self, camera_id, port, username, password, auth_mode):
+    def __init__(self, camera_id, url, username, password, auth_mode, **kwargs):
+        parts = urlparse.urlparse(url)
+
         self._camera_id = camera_id
-        self._port = port
+        self._host = parts.hostname
+        self._port = parts.port or (443 if parts.scheme == 'https' else 80)
+        self._path = (parts.path or '/') + ('?' + parts.query if parts.query else '')
         self._username = (username or '').encode('utf8')
         self._password = (password or '').encode('utf8')
         self._auth_mode = auth_mode
-        self._auth_digest_state = {}
+        self._auth_state = _auth_states.setdefault(camera_id, {})
+        self._auth_sent = False
         
+        self._failed = False
         self._last_access = None
         self._last_jpg = None
+        self._last_jpg_seq = None
         self._last_jpg_times = []
         self._fps = 0
+        self._frame_buffer = FrameBuffer(settings.MJPG_CLIENT_BUFFER_FRAMES, settings.MJPG_CLIENT_BUFFER_SIZE)
         
         s = socket.socket(socket.AF_INET, socket.SOCK_STREAM, 0)
-        IOStream.__init__(self, s)
+        super(MjpgClient, self).__init__(s, read_chunk_size=self._READ_CHUNK_SIZE, **kwargs)
         
         self.set_close_callback(self.on_close)
         
     def connect(self):
-        IOStream.connect(self, ('localhost', self._port), self._on_connect)
+        IOStream.connect(self, (self._host, self._port), self._on_connect)
     
     def on_close(self):
         logging.debug('connection closed for mjpg client for camera %(camera_id)s on port %(port)s' % {
                 'port': self._port, 'camera_id': self._camera_id})
         
-        if MjpgClient.clients.pop(self._camera_id, None):
+        if MjpgClient.clients.get(self._camera_id) is self:
+            del MjpgClient.clients[self._camera_id]
             logging.debug('mjpg client for camera %(camera_id)s on port %(port)s removed' % {
                     'port': self._port, 'camera_id': self._camera_id})
 
-        if getattr(self, 'error', None) and self.error.errno != errno.ECONNREFUSED:
-            now = time.time()
-            if now - MjpgClient._last_erroneous_close_time < settings.MJPG_CLIENT_TIMEOUT:
-                logging.error('connection problem detected for mjpg client for camera %(camera_id)s on port %(port)s' % {
-                        'port': self._port, 'camera_id': self._camera_id})
- 
-                motionctl.stop(invalidate=True) # this will close all the mjpg clients
-                motionctl.start(deferred=True)
- 
-            MjpgClient._last_erroneous_close_time = now
+        error = getattr(self, 'error', None)
+        if error or self._failed:
+            # a refused connection usually means that motion is (re)starting,
+            # so it only delays the reconnection, without escalating
+            _on_client_failure(self._camera_id, escalate=getattr(error, 'errno', None) != errno.ECONNREFUSED)
+
+        if has_subscribers(self._camera_id):
+            # don't make the viewers wait for the garbage collector to reconnect
+            health = _health.get(self._camera_id)
+            delay = max(0, health['next_attempt'] - time.time()) if health else 0
+            io_loop = IOLoop.instance()
+            io_loop.add_timeout(datetime.timedelta(seconds=delay), functools.partial(_reconnect, self._camera_id))
         
     def _check_error(self):
         if self.socket is None:
@@ -98,6 +360,8 @@ class MjpgClient(IOStream):
         logging.error('mjpg client for camera %(camera_id)s on port %(port)s error: %(msg)s' % {
                 'port': self._port, 'camera_id': self._camera_id, 'msg': unicode(error)})
         
+        self._failed = True
+
         try:
             self.close()
         
@@ -108,16 +372,30 @@ class MjpgClient(IOStream):
         logging.debug('mjpg client for camera %(camera_id)s connected on port %(port)s' % {
                 'port': self._port, 'camera_id': self._camera_id})
 
-        if self._auth_mode == 'basic':
+        self._write_request()
+        self._seek_http()
+
+    def _write_request(self):
+        auth_mode = self._auth_state.get('mode') or self._auth_mode
+        auth_header = None
+
+        if auth_mode == 'basic':
             logging.debug('mjpg client using basic authentication')
 
             auth_header = utils.build_basic_header(self._username, self._password)
-            self.write('GET / HTTP/1.0\r\n\r\nAuthorization: %s\r\n\r\n' % auth_header)
-            
-        else: # in digest auth mode, the header is built upon receiving 401
-            self.write('GET / HTTP/1.0\r\n\r\n')
 
-        self._seek_http()
+        elif auth_mode == 'digest' and self._auth_state.get('nonce'):
+            logging.debug('mjpg client using digest authentication')
+
+            auth_header = utils.build_digest_header('GET', self._path, self._username, self._password, self._auth_state)
+
+        # in digest auth mode, the header can only be built upon receiving 401
+        request = 'GET %(path)s HTTP/1.0\r\nHost: %(host)s\r\n' % {'path': self._path, 'host': self._host}
+        if auth_header:
+            request += 'Authorization: %s\r\n' % auth_header
+            self._auth_sent = True
+
+        self.write(request + '\r\n')
 
     def _seek_http(self):
         if self._check_error():
@@ -126,92 +404,99 @@ class MjpgClient(IOStream):
         self.read_until_regex('HTTP/1.\d \d+ ', self._on_http)
 
     def _on_http(self, data):
-        if data.endswith('401 '):
+        status = int(data.split()[-1])
+        if status == 401:
+            if self._auth_sent:
+                self._auth_state.pop('nonce', None) # could be stale, learn a new one upon reconnecting
+                
+                return self._error('authentication failed')
+
             self._seek_www_authenticate()
 
-        else: # no authorization required, skip to content length
-            self._seek_content_length()
+        elif status / 100 != 2:
+            self._error('unexpected HTTP status %s' % status)
+
+        else: # no authorization required, skip to the frames
+            self._seek_frames()
 
     def _seek_www_authenticate(self):
-        if self._check_error():
-            return
-        
-        self.read_until('WWW-Authenticate:', self._on_before_www_authenticate)
+        # many servers close the connection right after a 401 response,
+        # which can however still be read from the buffer
+        try:
+            self.read_until_regex('(?i)WWW-Authenticate:', self._on_before_www_authenticate)
+
+        except StreamClosedError:
+            self._error('connection closed before authentication')
 
     def _on_before_www_authenticate(self, data):
-        if self._check_error():
-            return
-        
-        self.read_until('\r\n', self._on_www_authenticate)
+        try:
+            self.read_until('\r\n', self._on_www_authenticate)
+
+        except StreamClosedError:
+            self._error('connection closed before authentication')
     
     def _on_www_authenticate(self, data):
-        if self._check_error():
-            return
-        
-        m = re.match('Basic\s*realm="([a-zA-Z0-9\-\s]+)"', data.strip())
+        m = re.match('(Basic|Digest)\s+(.*)', data.strip(), re.IGNORECASE)
         if m:
-            logging.debug('mjpg client using basic authentication')
-            
-            auth_header = utils.build_basic_header(self._username, self._password)
-            self.write('GET / HTTP/1.0\r\n\r\nAuthorization: %s\r\n\r\n' % auth_header)
-            self._seek_http()
+            mode, params = m.groups()
+            params = dict(re.findall('(\w+)="?([^",]*)"?', params))
 
-            return
+            self._auth_state['mode'] = mode.lower()
+            for name in ['realm', 'nonce', 'qop', 'opaque', 'algorithm']:
+                self._auth_state[name] = params.get(name)
 
-        m = re.match('Digest\s*realm="([a-zA-Z0-9\-\s]+)",\s*nonce="([a-zA-Z0-9]+)"', data.strip())
-        if m:
-            logging.debug('mjpg client using digest authentication')
+            if self.closed():
+                # the next client will authenticate right away
+                self.close()
+                IOLoop.instance().add_callback(get_jpg, self._camera_id)
 
-            realm, nonce = m.groups()
-            self._auth_digest_state['realm'] = realm
-            self._auth_digest_state['nonce'] = nonce
-    
-            auth_header = utils.build_digest_header('GET', '/', self._username, self._password, self._auth_digest_state)
-            self.write('GET / HTTP/1.0\r\n\r\nAuthorization: %s\r\n\r\n' % auth_header)
+                return
+
+            self._write_request()
             self._seek_http()
-            
+
             return
 
         logging.error('mjpg client unknown authentication header: "%s"' % data)
-        self._seek_content_length()
+        self._seek_frames()
 
-    def _seek_content_length(self):
-        if self._check_error():
-            return
-        
-        self.read_until('Content-Length:', self._on_before_content_length)
-    
-    def _on_before_content_length(self, data):
-        if self._check_error():
-            return
-        
-        self.read_until('\r\n\r\n', self._on_content_length)
-    
-    def _on_content_length(self, data):
+    def _seek_frames(self):
         if self._check_error():
             return
         
-        matches = re.findall('(\d+)', data)
-        if not matches:
-            self._error('could not find content length in mjpg header line "%(header)s"' % {
-                    'header': data})
-            
-            return
-        
-        length = int(matches[0])
-        
-        self.read_bytes(length, self._on_jpg)
-    
+        MjpgParser(self, self._on_jpg, self._error).start()
+
     def _on_jpg(self, data):
+        if self._camera_id in _health:
+            logging.debug('mjpg client for camera %(camera_id)s on port %(port)s recovered' % {
+                    'port': self._port, 'camera_id': self._camera_id})
+
+            del _health[self._camera_id]
+
         self._last_jpg = data
+        self._last_jpg_seq = _last_seqs[self._camera_id] = _last_seqs.get(self._camera_id, 0) + 1
         self._last_jpg_times.append(time.time())
+        self._frame_buffer.add(self._last_jpg_seq, self._last_jpg_times[-1], data)
         while len(self._last_jpg_times) > self._FPS_LEN:
             self._last_jpg_times.pop(0)
             
         if len(self._last_jpg_times) == self._FPS_LEN:
             self._fps = (len(self._last_jpg_times) - 1) / (self._last_jpg_times[-1] - self._last_jpg_times[0])
 
-        self._seek_content_length()
+        for callback in list(_subscribers.get(self._camera_id, [])):
+            try:
+                callback(data)
+
+            except Exception as e:
+                logging.error('mjpg client subscriber for camera %(camera_id)s failed: %(msg)s' % {
+                        'camera_id': self._camera_id, 'msg': unicode(e)}, exc_info=True)
+
+                unsubscribe(self._camera_id, callback)
+
+
+class SSLMjpgClient(MjpgClient, SSLIOStream):
+    def connect(self):
+        SSLIOStream.connect(self, (self._host, self._port), self._on_connect, server_hostname=self._host)
 
 
 def start():
@@ -224,24 +509,54 @@ def get_jpg(camera_id):
     if camera_id not in MjpgClient.clients:
         # mjpg client not started yet for this camera
         
+        health = _health.get(camera_id)
+        if health and time.time() < health['next_attempt']:
+            return None # waiting before reconnecting
+
         logging.debug('creating mjpg client for camera %(camera_id)s' % {
                 'camera_id': camera_id})
         
         camera_config = config.get_camera(camera_id)
-        if not camera_config['@enabled'] or not utils.local_motion_camera(camera_config):
-            logging.error('could not start mjpg client for camera id %(camera_id)s: not enabled or not local' % {
+        if not camera_config['@enabled']:
+            logging.error('could not start mjpg client for camera id %(camera_id)s: not enabled' % {
                     'camera_id': camera_id})
             
             return None
         
-        port = camera_config['stream_port']
-        username, password = None, None
-        auth_mode = None
-        if camera_config.get('stream_auth_method') > 0:
-            username, password = camera_config.get('stream_authentication', ':').split(':')
-            auth_mode = 'digest' if camera_config.get('stream_auth_method') > 1 else 'basic'
-
-        client = MjpgClient(camera_id, port, username, password, auth_mode)
+        if utils.local_motion_camera(camera_config):
+            url = 'http://localhost:%s/' % camera_config['stream_port']
+            username, password = None, None
+            auth_mode = None
+            if camera_config.get('stream_auth_method') > 0:
+                username, password = camera_config.get('stream_authentication', ':').split(':')
+                auth_mode = 'digest' if camera_config.get('stream_auth_method') > 1 else 'basic'
+
+        elif utils.simple_mjpeg_camera(camera_config):
+            # the credentials are part of the url; the auth mode is learned from the 401 response
+            parts = urlparse.urlparse(camera_config['@url'])
+            netloc = parts.hostname + (':%s' % parts.port if parts.port else '')
+            url = urlparse.urlunparse((parts.scheme, netloc, parts.path, parts.params, parts.query, ''))
+            username, password = parts.username, parts.password
+            auth_mode = None
+
+        else:
+            logging.error('could not start mjpg client for camera id %(camera_id)s: not local or simple mjpeg' % {
+                    'camera_id': camera_id})
+
+            return None
+
+        if url.startswith('https'):
+            if settings.VALIDATE_CERTS:
+                ssl_options = ssl.create_default_context()
+
+            else:
+                ssl_options = {'cert_reqs': ssl.CERT_NONE}
+
+            client = SSLMjpgClient(camera_id, url, username, password, auth_mode, ssl_options=ssl_options)
+
+        else:
+            client = MjpgClient(camera_id, url, username, password, auth_mode)
+
         client.connect()
         
         MjpgClient.clients[camera_id] = client
@@ -252,13 +567,56 @@ def get_jpg(camera_id):
     return client._last_jpg
 
 
+def get_jpgs_since(camera_id, seq=None, timestamp=None):
+    # also creates the mjpg client, if needed, and keeps it alive
+    get_jpg(camera_id)
+
+    client = MjpgClient.clients.get(camera_id)
+    if client is None:
+        return []
+
+    return client._frame_buffer.get_since(seq=seq, timestamp=timestamp)
+
+
+def get_jpg_seq(camera_id):
+    client = MjpgClient.clients.get(camera_id)
+    if client is None:
+        return None
+
+    return client._last_jpg_seq
+
+
 def get_fps(camera_id):
     client = MjpgClient.clients.get(camera_id)
     if client is None:
         return 0
     
     return client._fps
-    
+
+
+def subscribe(camera_id, callback):
+    logging.debug('adding mjpg subscriber for camera %(camera_id)s' % {
+            'camera_id': camera_id})
+
+    _subscribers.setdefault(camera_id, []).append(callback)
+
+
+def unsubscribe(camera_id, callback):
+    callbacks = _subscribers.get(camera_id, [])
+    if callback not in callbacks:
+        return
+
+    logging.debug('removing mjpg subscriber for camera %(camera_id)s' % {
+            'camera_id': camera_id})
+
+    callbacks.remove(callback)
+    if not callbacks:
+        del _subscribers[camera_id]
+
+
+def has_subscribers(camera_id):
+    return bool(_subscribers.get(camera_id))
+
 
 def close_all(invalidate=False):
     for client in MjpgClient.clients.values():
@@ -266,7 +624,53 @@ def close_all(invalidate=False):
     
     if invalidate:
         MjpgClient.clients = {}
-        MjpgClient._last_erroneous_close_time = 0
+        _health.clear()
+        _auth_states.clear()
+
+
+def _reconnect(camera_id):
+    if camera_id not in MjpgClient.clients and has_subscribers(camera_id):
+        get_jpg(camera_id)
+
+
+def _on_client_failure(camera_id, escalate=True):
+    global _last_motion_restart_time
+
+    health = _health.setdefault(camera_id, {'failures': 0, 'next_attempt': 0})
+    health['failures'] += 1
+    failures = health['failures']
+
+    delay = min(2 ** (failures - 1), settings.MJPG_CLIENT_MAX_RECONNECT_DELAY)
+    health['next_attempt'] = time.time() + delay
+
+    logging.warning('mjpg client for camera %(camera_id)s failed %(failures)s time(s) in a row, reconnecting in %(delay)s seconds' % {
+            'camera_id': camera_id, 'failures': failures, 'delay': delay})
+
+    if not escalate:
+        return
+
+    camera_config = config.get_camera(camera_id)
+    if not camera_config or not utils.local_motion_camera(camera_config):
+        return # only the streams of local cameras depend on motion
+
+    if failures == _THREAD_RESTART_FAILURES:
+        logging.error('connection problem detected for mjpg client for camera %(camera_id)s, restarting its motion thread' % {
+                'camera_id': camera_id})
+
+        motionctl.restart_thread(camera_id)
+
+    elif failures >= _MOTION_RESTART_FAILURES and settings.MJPG_CLIENT_MOTION_RESTART_INTERVAL:
+        now = time.time()
+        if now - _last_motion_restart_time < settings.MJPG_CLIENT_MOTION_RESTART_INTERVAL:
+            return # motion has been restarted recently, keep trying to reconnect
+
+        logging.error('connection problem persists for mjpg client for camera %(camera_id)s, restarting motion' % {
+                'camera_id': camera_id})
+
+        _last_motion_restart_time = now
+
+        motionctl.stop(invalidate=True) # this will close all the mjpg clients
+        motionctl.start(deferred=True)
 
 
 def _garbage_collector():
@@ -275,6 +679,11 @@ def _garbage_collector():
     io_loop = IOLoop.instance()
     io_loop.add_timeout(datetime.timedelta(seconds=settings.MJPG_CLIENT_TIMEOUT), _garbage_collector)
 
+    # (re)create the clients of cameras that are still being streamed
+    for camera_id in _subscribers.keys():
+        if camera_id not in MjpgClient.clients:
+            get_jpg(camera_id)
+
     now = time.time()
     for camera_id, client in MjpgClient.clients.items():
         port = client._port
@@ -293,13 +702,13 @@ def _garbage_collector():
             logging.error('mjpg client timed out receiving data for camera %(camera_id)s on port %(port)s' % {
                     'camera_id': camera_id, 'port': port})
             
-            motionctl.stop(invalidate=True) # this will close all the mjpg clients
-            motionctl.start(deferred=True)
-            
-            break
+            client._failed = True
+            client.close() # the failure is accounted for by the close callback
+
+            continue
 
         # check for last access timeout
-        if client._last_access is None:
+        if client._last_access is None or has_subscribers(camera_id):
             continue
 
         delta = now - client._last_access
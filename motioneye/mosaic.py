@@ -0,0 +1,230 @@
+
+# Copyright (c) 2013 Calin Crisan
+# This file is part of motionEye.
+#
+# motionEye is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import datetime
+import logging
+import math
+import StringIO
+
+from PIL import Image
+from tornado.ioloop import IOLoop
+
+import config
+import mjpgclient
+import utils
+
+
+DEFAULT_WIDTH = 1280
+DEFAULT_HEIGHT = 720
+DEFAULT_FRAMERATE = 5 # frames per second, for streamed mosaics
+MAX_FRAMERATE = 30
+MAX_WIDTH = 3840
+MAX_HEIGHT = 2160
+MAX_COLUMNS = 16
+
+_JPEG_QUALITY = 85
+_MAX_MOSAICS = 8
+
+# mosaics indexed by their layout, shared by all the viewers asking for the same one
+_mosaics = {}
+
+# resized tiles indexed by (camera_id, width, height),
+# along with the sequence number of the frame they were made of
+_tiles = {}
+
+
+class Mosaic(object):
+    def __init__(self, camera_ids, columns, width, height):
+        self._camera_ids = camera_ids
+        self._columns = columns
+        self._rows = int(math.ceil(len(camera_ids) / float(columns)))
+        self._width = width
+        self._height = height
+        self._tile_width = width / columns
+        self._tile_height = height / self._rows
+
+        self._seqs = None
+        self._jpg = None
+        self._subscribers = []
+        self._framerates = {} # the framerate asked for by each subscriber
+        self._framerate = DEFAULT_FRAMERATE
+        self._timeout = None
+
+    def get_jpg(self):
+        seqs = []
+        for camera_id in self._camera_ids:
+            mjpgclient.get_jpg(camera_id) # keeps the mjpg client alive
+            seqs.append(mjpgclient.get_jpg_seq(camera_id))
+
+        if seqs != self._seqs:
+            self._jpg = self._compose()
+            self._seqs = seqs
+
+        return self._jpg
+
+    def subscribe(self, callback, framerate):
+        self._subscribers.append(callback)
+        self._framerates[callback] = framerate
+
+        # the fastest viewer dictates the pace
+        self._framerate = max(self._framerates.values())
+        if self._timeout is None:
+            self._tick()
+
+    def unsubscribe(self, callback):
+        if callback not in self._subscribers:
+            return
+
+        self._subscribers.remove(callback)
+        self._framerates.pop(callback, None)
+
+        if self._subscribers:
+            self._framerate = max(self._framerates.values())
+
+        else:
+            _drop(self)
+
+    def _tick(self):
+        self._timeout = None
+        if not self._subscribers:
+            return
+
+        seqs = self._seqs
+        jpg = self.get_jpg()
+        if self._seqs != seqs:
+            for callback in list(self._subscribers):
+                try:
+                    callback(jpg)
+
+                except Exception as e:
+                    logging.error('mosaic subscriber failed: %(msg)s' % {'msg': unicode(e)}, exc_info=True)
+
+                    self.unsubscribe(callback)
+
+        io_loop = IOLoop.instance()
+        self._timeout = io_loop.add_timeout(datetime.timedelta(seconds=1.0 / self._framerate), self._tick)
+
+    def _compose(self):
+        image = Image.new('RGB', (self._width, self._height))
+
+        for i, camera_id in enumerate(self._camera_ids):
+            tile = _get_tile(camera_id, self._tile_width, self._tile_height)
+            if tile is None:
+                continue # leave the tile black until the camera delivers frames
+
+            # center the tile in its cell, as the aspect ratio is preserved
+            x = (i % self._columns) * self._tile_width + (self._tile_width - tile.size[0]) / 2
+            y = (i / self._columns) * self._tile_height + (self._tile_height - tile.size[1]) / 2
+            image.paste(tile, (x, y))
+
+        sio = StringIO.StringIO()
+        image.save(sio, format='JPEG', quality=_JPEG_QUALITY)
+
+        return sio.getvalue()
+
+
+def get(camera_ids=None, columns=None, width=None, height=None):
+    known_ids = config.get_camera_ids()
+    if not camera_ids:
+        camera_ids = known_ids
+
+    camera_ids = [camera_id for camera_id in camera_ids if camera_id in known_ids and _streamable(camera_id)]
+    if not camera_ids:
+        return None
+
+    columns = min(columns or int(math.ceil(math.sqrt(len(camera_ids)))), len(camera_ids))
+    width = width or DEFAULT_WIDTH
+    height = height or DEFAULT_HEIGHT
+
+    key = (tuple(camera_ids), columns, width, height)
+    mosaic = _mosaics.get(key)
+    if mosaic is None:
+        if len(_mosaics) >= _MAX_MOSAICS:
+            logging.debug('too many mosaics, dropping the unused ones')
+            _drop_unused()
+
+        logging.debug('creating mosaic of cameras %(ids)s, %(columns)s columns, %(width)sx%(height)s' % {
+                'ids': ', '.join([str(i) for i in camera_ids]), 'columns': columns, 'width': width, 'height': height})
+
+        mosaic = _mosaics[key] = Mosaic(camera_ids, columns, width, height)
+
+    return mosaic
+
+
+def _streamable(camera_id):
+    camera_config = config.get_camera(camera_id)
+    if not camera_config or not camera_config['@enabled']:
+        return False
+
+    return utils.local_motion_camera(camera_config) or utils.simple_mjpeg_camera(camera_config)
+
+
+def _drop(mosaic):
+    logging.debug('dropping mosaic of cameras %(ids)s, no longer watched' % {
+            'ids': ', '.join([str(i) for i in mosaic._camera_ids])})
+
+    for key, m in _mosaics.items():
+        if m is mosaic:
+            del _mosaics[key]
+
+    if mosaic._timeout is not None:
+        IOLoop.instance().remove_timeout(mosaic._timeout)
+        mosaic._timeout = None
+
+    _drop_unused_tiles()
+
+
+def _drop_unused():
+    for key, mosaic in _mosaics.items():
+        if not mosaic._subscribers:
+            del _mosaics[key]
+
+    _drop_unused_tiles()
+
+
+def _drop_unused_tiles():
+    used = set()
+    for m in _mosaics.itervalues():
+        used.update((camera_id, m._tile_width, m._tile_height) for camera_id in m._camera_ids)
+
+    for key in _tiles.keys():
+        if key not in used:
+            del _tiles[key]
+
+
+def _get_tile(camera_id, width, height):
+    seq = mjpgclient.get_jpg_seq(camera_id)
+    if seq is None:
+        return None
+
+    key = (camera_id, width, height)
+    entry = _tiles.get(key)
+    if entry and entry[0] == seq:
+        return entry[1] # the same tile is shared by all the mosaics of this size
+
+    jpg = mjpgclient.get_jpg(camera_id)
+    if jpg is None:
+        return None
+
+    tile = Image.open(StringIO.StringIO(jpg))
+    tile.thumbnail((width, height), Image.CUBIC) # takes advantage of jpeg draft mode
+    if tile.mode != 'RGB':
+        tile = tile.convert('RGB')
+
+    _tiles[key] = (seq, tile)
+
+    return tile
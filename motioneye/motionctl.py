@@ -280,6 +280,32 @@ def set_motion_detection(camera_id, enabled):
     http_client.fetch(request, on_response)
 
 
+def restart_thread(camera_id):
+    from tornado.httpclient import HTTPRequest, AsyncHTTPClient
+
+    thread_id = camera_id_to_thread_id(camera_id)
+    if thread_id is None:
+        return logging.error('could not find thread id for camera with id %s' % camera_id)
+
+    logging.debug('restarting motion thread for camera with id %s' % camera_id)
+
+    url = 'http://127.0.0.1:7999/%(id)s/action/restart' % {'id': thread_id}
+
+    def on_response(response):
+        if response.error:
+            logging.error('failed to restart motion thread for camera with id %(id)s: %(msg)s' % {
+                    'id': camera_id,
+                    'msg': utils.pretty_http_error(response)})
+
+        else:
+            logging.debug('successfully restarted motion thread for camera with id %(id)s' % {
+                    'id': camera_id})
+
+    request = HTTPRequest(url, connect_timeout=_MOTION_CONTROL_TIMEOUT, request_timeout=_MOTION_CONTROL_TIMEOUT)
+    http_client = AsyncHTTPClient()
+    http_client.fetch(request, on_response)
+
+
 def is_motion_detected(camera_id):
     return _motion_detected.get(camera_id, False)
 
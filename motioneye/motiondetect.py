@@ -0,0 +1,184 @@
+
+# Copyright (c) 2013 Calin Crisan
+# This file is part of motionEye.
+#
+# motionEye is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import datetime
+import logging
+import StringIO
+import time
+
+from PIL import Image
+from tornado.ioloop import IOLoop
+
+import config
+import mjpgclient
+import motionctl
+import utils
+
+try:
+    import numpy
+
+except ImportError:
+    numpy = None
+
+
+_SYNC_INTERVAL = 10 # seconds
+_ANALYSIS_WIDTH = 160 # frames are analyzed at (about) this width
+_BACKGROUND_RATE = 0.05 # how fast the background follows the scene
+_PIXEL_THRESHOLD = 25 # the difference from the background above which a pixel is considered changed
+_MOTION_SAMPLES = 2 # the number of consecutive samples with motion that start an event
+
+# motion detectors of simple mjpeg cameras, indexed by camera id
+_detectors = {}
+
+
+class MotionDetector(object):
+    def __init__(self, camera_id, rate, cpu_budget, threshold, event_gap):
+        self._camera_id = camera_id
+        self._interval = 1.0 / rate
+        self._cpu_budget = cpu_budget / 100.0
+        self._threshold = threshold / 100.0
+        self._event_gap = event_gap
+
+        self._background = None
+        self._next_sample_time = 0
+        self._motion_samples = 0
+        self._last_motion_time = 0
+        self._motion_detected = False
+
+    def settings(self):
+        return (self._interval, self._cpu_budget, self._threshold, self._event_gap)
+
+    def start(self):
+        logging.debug('starting motion detector for camera %(id)s' % {'id': self._camera_id})
+
+        mjpgclient.subscribe(self._camera_id, self.on_jpg)
+        mjpgclient.get_jpg(self._camera_id) # connects the mjpg client right away
+
+    def stop(self):
+        logging.debug('stopping motion detector for camera %(id)s' % {'id': self._camera_id})
+
+        mjpgclient.unsubscribe(self._camera_id, self.on_jpg)
+        if self._motion_detected:
+            self._set_motion_detected(False)
+
+    def on_jpg(self, jpg):
+        now = time.time()
+        if now < self._next_sample_time:
+            return
+
+        changed = self._analyze(jpg)
+
+        # keep the time spent analyzing within the cpu budget
+        duration = time.time() - now
+        self._next_sample_time = now + max(self._interval, duration / self._cpu_budget)
+
+        if changed is None:
+            return
+
+        if changed > self._threshold:
+            self._motion_samples += 1
+            if self._motion_samples >= _MOTION_SAMPLES:
+                self._last_motion_time = now
+                if not self._motion_detected:
+                    self._set_motion_detected(True)
+
+        else:
+            self._motion_samples = 0
+            if self._motion_detected and now - self._last_motion_time > self._event_gap:
+                self._set_motion_detected(False)
+
+    def _analyze(self, jpg):
+        # returns the changed fraction of the frame, or None if there's nothing to compare it with (yet)
+        try:
+            image = Image.open(StringIO.StringIO(jpg))
+            width = _ANALYSIS_WIDTH
+            height = image.size[1] * width / image.size[0]
+
+            # decode at reduced scale, which is much cheaper than decoding and resizing
+            image.draft('L', (width, height))
+            image = image.convert('L')
+            if image.size[0] > width:
+                image = image.resize((width, height))
+
+        except (IOError, ValueError) as e:
+            # a truncated or corrupt frame is skipped, the next ones are still analyzed
+            logging.warning('failed to decode frame of camera %(id)s: %(msg)s' % {
+                    'id': self._camera_id, 'msg': unicode(e)})
+
+            return None
+
+        frame = numpy.asarray(image, dtype=numpy.float32)
+        if self._background is None or self._background.shape != frame.shape:
+            self._background = frame
+
+            return None
+
+        diff = numpy.abs(frame - self._background)
+        changed = float(numpy.count_nonzero(diff > _PIXEL_THRESHOLD)) / diff.size
+
+        self._background += (frame - self._background) * _BACKGROUND_RATE
+
+        return changed
+
+    def _set_motion_detected(self, motion_detected):
+        # the same as a start/stop event relayed by motion
+        logging.debug('motion %(what)s for camera %(id)s' % {
+                'what': ['stopped', 'started'][motion_detected], 'id': self._camera_id})
+
+        self._motion_detected = motion_detected
+        motionctl.set_motion_detected(self._camera_id, motion_detected)
+
+
+def start():
+    if numpy is None:
+        logging.warning('numpy is not installed, motion detection for simple mjpeg cameras is unavailable')
+        return
+
+    io_loop = IOLoop.instance()
+    io_loop.add_timeout(datetime.timedelta(seconds=1), _sync_detectors)
+
+
+def _sync_detectors():
+    # schedule the next call
+    io_loop = IOLoop.instance()
+    io_loop.add_timeout(datetime.timedelta(seconds=_SYNC_INTERVAL), _sync_detectors)
+
+    # (re)create the detectors according to the current configuration
+    wanted = {}
+    for camera_id in config.get_camera_ids():
+        camera_config = config.get_camera(camera_id)
+        if not utils.simple_mjpeg_camera(camera_config):
+            continue
+
+        if not camera_config['@enabled'] or not camera_config.get('@motion_detection'):
+            continue
+
+        wanted[camera_id] = MotionDetector(camera_id,
+                rate=max(0.1, float(camera_config.get('@motion_detection_rate', 2))),
+                cpu_budget=max(1, min(100, int(camera_config.get('@motion_detection_cpu', 10)))),
+                threshold=float(camera_config.get('@motion_detection_threshold', 1.5)),
+                event_gap=int(camera_config.get('@motion_detection_event_gap', 10)))
+
+    for camera_id, detector in _detectors.items():
+        if camera_id not in wanted or wanted[camera_id].settings() != detector.settings():
+            detector.stop()
+            del _detectors[camera_id]
+
+    for camera_id, detector in wanted.items():
+        if camera_id not in _detectors:
+            _detectors[camera_id] = detector
+            detector.start()
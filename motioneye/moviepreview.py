@@ -0,0 +1,152 @@
+
+# Copyright (c) 2013 Calin Crisan
+# This file is part of motionEye.
+#
+# motionEye is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import datetime
+import heapq
+import itertools
+import logging
+
+from tornado.ioloop import IOLoop
+
+import settings
+import utils
+
+
+PRIORITY_INTERACTIVE = 0 # someone is waiting for the preview
+PRIORITY_BACKGROUND = 1 # new movies
+
+_BACKGROUND_DELAY = 5 # seconds to wait before creating the preview of a new movie
+_MAKE_TIMEOUT = 120 # seconds to wait for a preview to be created
+
+# the movies waiting for their previews or having them created, indexed by full path;
+# values are dicts with camera_config, priority, running and callbacks
+_requests = {}
+
+# (priority, sequence, full_path) entries of the movies not started yet, in order;
+# entries that no longer match the priority of their request are skipped
+_queue = []
+_sequence = itertools.count()
+
+_running = 0
+_pool = None
+
+
+def start():
+    global _pool
+
+    _pool = utils.ProcessPool(settings.MOVIE_PREVIEW_WORKERS)
+
+
+def stop():
+    global _pool
+
+    if _pool is not None:
+        _pool.terminate()
+        _pool = None
+
+
+def add(camera_config, full_path, callback=None, priority=PRIORITY_BACKGROUND):
+    # schedules the creation of the preview of a movie, unless already scheduled;
+    # callback(thumb_path) is called when done, with None if the preview could not be created
+    request = _requests.get(full_path)
+    if request is None:
+        request = _requests[full_path] = {
+            'camera_config': camera_config,
+            'priority': priority,
+            'running': False,
+            'callbacks': [callback] if callback else []
+        }
+
+        if priority == PRIORITY_BACKGROUND:
+            # gives an interactive request the chance to arrive and run first
+            io_loop = IOLoop.instance()
+            io_loop.add_timeout(datetime.timedelta(seconds=_BACKGROUND_DELAY), _enqueue, full_path, priority)
+
+        else:
+            _enqueue(full_path, priority)
+
+    elif priority < request['priority'] and not request['running']:
+        logging.debug('raising the priority of the preview of movie %(path)s' % {'path': full_path})
+
+        request['priority'] = priority
+        if callback:
+            request['callbacks'].append(callback)
+
+        _enqueue(full_path, priority)
+
+    elif callback:
+        request['callbacks'].append(callback)
+
+
+def _enqueue(full_path, priority):
+    request = _requests.get(full_path)
+    if request is None or request['running'] or request['priority'] != priority:
+        return # already started or enqueued with a higher priority
+
+    heapq.heappush(_queue, (priority, next(_sequence), full_path))
+    _run_next()
+
+
+def _run_next():
+    global _running
+
+    while _queue and _running < settings.MOVIE_PREVIEW_WORKERS:
+        (priority, sequence, full_path) = heapq.heappop(_queue)  # @UnusedVariable
+        request = _requests.get(full_path)
+        if request is None or request['running'] or request['priority'] != priority:
+            continue # stale entry
+
+        request['running'] = True
+        _running += 1
+
+        logging.debug('creating preview of movie %(path)s (%(running)s running, %(queued)s queued)' % {
+                'path': full_path, 'running': _running, 'queued': len(_queue)})
+
+        if _pool is not None:
+            _pool.apply(_make_preview, (request['camera_config'], full_path),
+                    callback=lambda thumb_path, full_path=full_path: _on_done(full_path, thumb_path),
+                    timeout=_MAKE_TIMEOUT)
+
+        else:
+            _on_done(full_path, _make_preview(request['camera_config'], full_path))
+
+
+def _make_preview(camera_config, full_path):
+    import mediafiles
+
+    try:
+        return mediafiles.make_movie_preview(camera_config, full_path)
+
+    except Exception as e:
+        logging.error('failed to create preview of movie %(path)s: %(msg)s' % {'path': full_path, 'msg': unicode(e)})
+
+        return None
+
+
+def _on_done(full_path, thumb_path):
+    global _running
+
+    _running -= 1
+    request = _requests.pop(full_path)
+    for callback in request['callbacks']:
+        try:
+            callback(thumb_path)
+
+        except Exception as e:
+            logging.error('movie preview callback failed: %(msg)s' % {'msg': unicode(e)}, exc_info=True)
+
+    _run_next()
@@ -0,0 +1,326 @@
+
+# Copyright (c) 2013 Calin Crisan
+# This file is part of motionEye.
+#
+# motionEye is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+# Recorded movies are played back as HLS: the playlist lists segments that start at keyframes,
+# each one being remuxed (stream copy, no transcoding) into MPEG-TS by ffmpeg only when requested.
+# The segments and the keyframe-based segment lists are kept on disk, the least recently used ones being
+# removed when the cache grows too big.
+
+import json
+import logging
+import os
+import subprocess
+
+import preparedcache
+import settings
+import utils
+
+
+_DIR_NAME = '.remux'
+_SEGMENTS_FILE_NAME = 'segments.json'
+_SEGMENT_DURATION = 4 # seconds, the minimum duration of a segment
+_SEEK_MARGIN = 0.001 # seconds, covering the rounding of the keyframe times printed by ffprobe
+_PREFETCH_SEGMENTS = 1 # the number of segments remuxed in advance, following a requested one
+_MAKE_TIMEOUT = 120 # seconds to wait for the keyframes of a movie to be found or for a segment to be remuxed
+_CODECS = ['h264', 'hevc'] # the video codecs that can be carried by MPEG-TS and played back with HLS
+
+UNSUPPORTED_CODEC = 'unsupported video codec'
+
+# the segment lists and the segments, laid out as <camera id>/<movie path>.<mtime>-<size>/<file name>
+_cache = None
+
+# the callbacks of the files being made, indexed by path
+_requests = {}
+
+_pool = None
+
+
+def start():
+    global _pool
+    global _cache
+
+    _pool = utils.ProcessPool(settings.MOVIE_REMUX_WORKERS)
+
+    _cache = preparedcache.DiskCache(_DIR_NAME, settings.MOVIE_REMUX_CACHE_SIZE, what='remuxed movie')
+    _cache.load()
+
+
+def stop():
+    global _pool
+
+    if _pool is not None:
+        _pool.terminate()
+        _pool = None
+
+
+def get_segments(camera_config, full_path, callback):
+    # calls back with the list of (start, duration) segments of a movie, or with an error,
+    # UNSUPPORTED_CODEC meaning that the movie can only be played back as it is
+    segments_path = os.path.join(_get_movie_dir(camera_config, full_path), _SEGMENTS_FILE_NAME)
+    segments = None
+    if _cache.touch(segments_path):
+        try:
+            with open(segments_path) as f:
+                segments = json.load(f)
+
+        except (IOError, ValueError) as e:
+            logging.error('failed to read segments file %(path)s: %(msg)s' % {'path': segments_path, 'msg': unicode(e)})
+
+            _cache.forget(segments_path)
+
+    if segments is None:
+        return _make(segments_path, _probe, (full_path, segments_path), callback)
+
+    callback(segments)
+
+
+def get_segment(camera_config, full_path, index, callback):
+    # calls back with the path of the given MPEG-TS segment of a movie, or with an error
+    def on_segments(segments, error=None):
+        if error:
+            return callback(error=error)
+
+        if index < 0 or index >= len(segments):
+            return callback(error='no such segment')
+
+        movie_dir = _get_movie_dir(camera_config, full_path)
+        for i in xrange(index, min(index + _PREFETCH_SEGMENTS + 1, len(segments))):
+            segment_path = os.path.join(movie_dir, '%s.ts' % i)
+            (start, duration) = segments[i]
+            if i == index:
+                if _cache.touch(segment_path):
+                    callback(segment_path)
+
+                else:
+                    _cache.forget(segment_path)
+                    _make(segment_path, _remux, (full_path, start, duration, segment_path), callback)
+
+            elif segment_path not in _cache:
+                logging.debug('remuxing segment %(index)s of movie %(path)s in advance' % {'index': i, 'path': full_path})
+
+                _make(segment_path, _remux, (full_path, start, duration, segment_path), None)
+
+    get_segments(camera_config, full_path, on_segments)
+
+
+def make_playlist(segments, make_uri):
+    # returns the HLS playlist of the given segments, make_uri(index) giving the URI of each segment
+    lines = [
+        '#EXTM3U',
+        '#EXT-X-VERSION:3',
+        '#EXT-X-PLAYLIST-TYPE:VOD',
+        '#EXT-X-TARGETDURATION:%d' % max([int(round(d)) for (s, d) in segments] or [_SEGMENT_DURATION]),
+        '#EXT-X-MEDIA-SEQUENCE:0'
+    ]
+
+    for (index, (start, duration)) in enumerate(segments):  # @UnusedVariable
+        lines.append('#EXTINF:%.3f,' % duration)
+        lines.append(make_uri(index))
+
+    lines.append('#EXT-X-ENDLIST')
+
+    return '\n'.join(lines) + '\n'
+
+
+def parse_playlist(content):
+    # returns the list of (start, duration) segments of a playlist made by make_playlist();
+    # the start times are only as precise as the durations in the playlist
+    segments = []
+    start = 0
+    for line in content.split('\n'):
+        if line.startswith('#EXTINF:'):
+            duration = float(line[8:].split(',')[0])
+            segments.append((start, duration))
+            start += duration
+
+    return segments
+
+
+def _get_movie_dir(camera_config, full_path):
+    # the files of a movie that has changed are not reused, being left to the eviction
+    st = os.stat(full_path)
+    rel_path = os.path.relpath(full_path, camera_config.get('target_dir'))
+
+    return os.path.join(_cache.get_dir(), str(camera_config['@id']), '%(path)s.%(mtime)d-%(size)d' % {
+            'path': rel_path, 'mtime': st.st_mtime, 'size': st.st_size})
+
+
+def _make(path, func, args, callback):
+    # runs func(*args) in the pool to make the file at path and calls back with its result;
+    # requests for a file that's already being made just wait for it
+    callbacks = _requests.get(path)
+    if callbacks is not None:
+        if callback:
+            callbacks.append(callback)
+
+        return
+
+    _requests[path] = [callback] if callback else []
+
+    if _pool is not None:
+        _pool.apply(func, args, callback=lambda result: _on_made(path, result or (None, 'failed to remux movie')),
+                timeout=_MAKE_TIMEOUT)
+
+    else:
+        _on_made(path, func(*args))
+
+
+def _on_made(path, result):
+    (value, error) = result
+    if not error:
+        try:
+            _cache.add(path)
+
+        except OSError as e:
+            error = unicode(e)
+
+    for callback in _requests.pop(path):
+        try:
+            if error:
+                callback(error=error)
+
+            else:
+                callback(value)
+
+        except Exception as e:
+            logging.error('movie remux callback failed: %(msg)s' % {'msg': unicode(e)}, exc_info=True)
+
+
+def _probe(full_path, segments_path):
+    # finds the keyframes of a movie with ffprobe and groups them into segments of about _SEGMENT_DURATION;
+    # returns (segments, error)
+    cmd = ['ffprobe', '-v', 'error', '-select_streams', 'v:0', '-show_entries',
+            'stream=codec_name:packet=pts_time,dts_time,flags:format=duration', '-of', 'compact', full_path]
+
+    try:
+        output = subprocess.check_output(cmd, stderr=utils.DEV_NULL)
+
+    except (OSError, subprocess.CalledProcessError) as e:
+        logging.error('failed to find the keyframes of movie %(path)s: %(msg)s' % {'path': full_path, 'msg': unicode(e)})
+
+        return (None, 'failed to read movie')
+
+    keyframes = []
+    duration = 0
+    codec = None
+    for line in output.split('\n'):
+        fields = dict(f.split('=', 1) for f in line.strip().split('|')[1:] if '=' in f)
+        if line.startswith('stream|'):
+            codec = fields.get('codec_name')
+
+        elif line.startswith('packet|'):
+            time_str = fields.get('pts_time')
+            if time_str in [None, 'N/A']:
+                time_str = fields.get('dts_time')
+
+            try:
+                t = float(time_str)
+
+            except (TypeError, ValueError):
+                continue
+
+            duration = max(duration, t)
+            if 'K' in fields.get('flags', ''):
+                keyframes.append(t)
+
+        elif line.startswith('format|'):
+            try:
+                duration = max(duration, float(fields.get('duration')))
+
+            except (TypeError, ValueError):
+                pass
+
+    if codec not in _CODECS:
+        logging.debug('movie %(path)s cannot be remuxed, its video codec is %(codec)s' % {
+                'path': full_path, 'codec': codec})
+
+        return (None, UNSUPPORTED_CODEC)
+
+    starts = []
+    for t in sorted(keyframes):
+        if not starts or t - starts[-1] >= _SEGMENT_DURATION:
+            starts.append(t)
+
+    while starts and starts[-1] >= duration: # no frames in the last segment
+        starts.pop()
+
+    if not starts:
+        logging.error('no keyframes found in movie %(path)s' % {'path': full_path})
+
+        return (None, 'failed to read movie')
+
+    segments = [(s, e - s) for (s, e) in zip(starts, starts[1:] + [duration])]
+
+    try:
+        _write_file(segments_path, json.dumps(segments))
+
+    except (IOError, OSError) as e:
+        logging.error('failed to write segments file %(path)s: %(msg)s' % {'path': segments_path, 'msg': unicode(e)})
+
+        return (None, 'failed to write segments file')
+
+    logging.debug('movie %(path)s has %(count)s segments' % {'path': full_path, 'count': len(segments)})
+
+    return (segments, None)
+
+
+def _remux(full_path, start, duration, segment_path):
+    # copies the streams of a movie between start and start + duration into an MPEG-TS file;
+    # the original timestamps are kept so that the segments follow each other seamlessly;
+    # returns (segment_path, error)
+    tmp_path = '%s.%s.tmp' % (segment_path, os.getpid())
+    cmd = ['ffmpeg', '-nostdin', '-loglevel', 'error',
+            '-ss', '%.6f' % (start + _SEEK_MARGIN), '-t', '%.6f' % (duration - _SEEK_MARGIN), '-copyts', '-i', full_path,
+            '-map', '0:v', '-map', '0:a?', '-c', 'copy', '-muxdelay', '0', '-f', 'mpegts', '-y', tmp_path]
+
+    try:
+        if not os.path.isdir(os.path.dirname(segment_path)):
+            os.makedirs(os.path.dirname(segment_path))
+
+        subprocess.check_output(cmd, stderr=subprocess.STDOUT)
+        os.rename(tmp_path, segment_path)
+
+    except (OSError, subprocess.CalledProcessError) as e:
+        output = getattr(e, 'output', None)
+        logging.error('failed to remux movie %(path)s at %(start)s: %(msg)s' % {
+                'path': full_path, 'start': start, 'msg': (output or unicode(e)).strip()})
+
+        if os.path.exists(tmp_path):
+            _remove_file(tmp_path)
+
+        return (None, 'failed to remux movie')
+
+    return (segment_path, None)
+
+
+def _write_file(path, data):
+    if not os.path.isdir(os.path.dirname(path)):
+        os.makedirs(os.path.dirname(path))
+
+    tmp_path = '%s.%s.tmp' % (path, os.getpid())
+    with open(tmp_path, 'w') as f:
+        f.write(data)
+
+    os.rename(tmp_path, path)
+
+
+def _remove_file(path):
+    try:
+        os.remove(path)
+
+    except OSError as e:
+        logging.error('failed to remove remuxed movie file %(path)s: %(msg)s' % {'path': path, 'msg': unicode(e)})
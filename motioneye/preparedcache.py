@@ -0,0 +1,246 @@
+
+# Copyright (c) 2013 Calin Crisan
+# This file is part of motionEye.
+#
+# motionEye is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import binascii
+import collections
+import datetime
+import logging
+import os
+import re
+import time
+
+from tornado.ioloop import IOLoop
+
+import settings
+
+
+_DIR_NAME = '.prepared'
+_TMP_SUFFIX = '.tmp'
+_KEY_REGEX = re.compile('^[0-9a-f]{40}$')
+_SWEEP_INTERVAL = 60 # seconds
+
+# the prepared files (zip file lists, timelapse movies) waiting to be downloaded, named after their keys
+_cache = None
+
+
+class DiskCache(object):
+    # files kept in a dir of the media path, the least recently used ones being removed
+    # once their total size exceeds max_size or, if ttl is given, once unused for ttl seconds;
+    # the files are given by their full paths, and may be laid out in subdirs
+
+    def __init__(self, dir_name, max_size, ttl=None, what='cached'):
+        self._dir = os.path.join(settings.MEDIA_PATH, dir_name)
+        self._max_size = max_size
+        self._ttl = ttl
+        self._what = what
+
+        # [size, last_used] lists, indexed by path, in the order of their last use
+        self._entries = collections.OrderedDict()
+
+    def get_dir(self):
+        return self._dir
+
+    def load(self):
+        # files left behind by a previous run are kept, unless incomplete (see make_temp_path())
+        if not os.path.isdir(self._dir):
+            try:
+                os.makedirs(self._dir)
+
+            except OSError as e:
+                logging.error('failed to create %(what)s files dir %(dir)s: %(msg)s' % {
+                        'what': self._what, 'dir': self._dir, 'msg': unicode(e)})
+
+                return
+
+        found = []
+        for (dir_path, dir_names, file_names) in os.walk(self._dir):  # @UnusedVariable
+            for name in file_names:
+                path = os.path.join(dir_path, name)
+                if name.endswith(_TMP_SUFFIX):
+                    logging.debug('removing incomplete %(what)s file %(path)s' % {'what': self._what, 'path': path})
+                    self._remove_file(path)
+                    continue
+
+                try:
+                    st = os.stat(path)
+
+                except OSError:
+                    continue
+
+                found.append((st.st_mtime, path, st.st_size))
+
+        self._entries.clear()
+        for (mtime, path, size) in sorted(found):
+            self._entries[path] = [size, mtime]
+
+        logging.debug('found %(count)s %(what)s files' % {'count': len(self._entries), 'what': self._what})
+
+        self.evict()
+
+    def add(self, path):
+        # adds a file made at path, which has to be in the dir of the cache
+        self._entries.pop(path, None)
+        self._entries[path] = [os.path.getsize(path), time.time()]
+        self.evict(keep=path)
+
+    def touch(self, path):
+        # marks a file as used, so it will be among the last ones to be removed;
+        # returns False if there's no such file
+        entry = self._entries.pop(path, None)
+        if entry is None:
+            return False
+
+        entry[1] = time.time()
+
+        try:
+            os.utime(path, (entry[1], entry[1])) # remembers the order of use across restarts
+
+        except OSError as e:
+            logging.error('%(what)s file %(path)s has vanished: %(msg)s' % {
+                    'what': self._what, 'path': path, 'msg': unicode(e)})
+
+            return False
+
+        self._entries[path] = entry
+
+        return True
+
+    def forget(self, path):
+        if self._entries.pop(path, None) is not None and os.path.exists(path):
+            self._remove_file(path)
+
+    def __contains__(self, path):
+        return path in self._entries
+
+    def evict(self, keep=None):
+        # removes the expired files and then the least recently used ones, until the total size fits the budget,
+        # as well as the dirs left empty; files being sent out can be safely removed, as they remain readable
+        # until closed
+        expired = time.time() - self._ttl if self._ttl else 0
+        total_size = sum(entry[0] for entry in self._entries.itervalues())
+
+        for path, (size, last_used) in self._entries.items():
+            if last_used >= expired and total_size <= self._max_size:
+                break
+
+            if path == keep:
+                continue
+
+            logging.debug('removing %(what)s file %(path)s' % {'what': self._what, 'path': path})
+
+            self._remove_file(path)
+            del self._entries[path]
+            total_size -= size
+
+            dir_path = os.path.dirname(path)
+            while dir_path.startswith(self._dir + '/'):
+                try:
+                    os.rmdir(dir_path)
+
+                except OSError:
+                    break # not empty
+
+                dir_path = os.path.dirname(dir_path)
+
+    def _remove_file(self, path):
+        try:
+            os.remove(path)
+
+        except OSError as e:
+            logging.error('failed to remove %(what)s file %(path)s: %(msg)s' % {
+                    'what': self._what, 'path': path, 'msg': unicode(e)})
+
+
+def start():
+    global _cache
+
+    _cache = DiskCache(_DIR_NAME, settings.PREPARED_CACHE_SIZE, ttl=settings.PREPARED_CACHE_TTL, what='prepared')
+    _cache.load()
+
+    _sweep()
+
+
+def make_temp_path():
+    # returns a path where a file can be prepared before being added with add_file();
+    # such files are removed at startup if a crash prevented them from being added
+    return os.path.join(_cache.get_dir(), _make_key() + _TMP_SUFFIX)
+
+
+def add_file(path):
+    # moves a prepared file into the cache and returns its key
+    key = _make_key()
+    cache_path = os.path.join(_cache.get_dir(), key)
+    os.rename(path, cache_path)
+    _cache.add(cache_path)
+
+    logging.debug('added prepared file with key %(key)s' % {'key': key})
+
+    return key
+
+
+def add_data(data):
+    path = make_temp_path()
+    try:
+        with open(path, 'w') as f:
+            f.write(data)
+
+    except:
+        _remove_file(path)
+        raise
+
+    return add_file(path)
+
+
+def get_path(key):
+    # returns the path of the prepared file, or None if there's no such key;
+    # the file is considered used, so it will be among the last ones to be removed
+    if not _KEY_REGEX.match(key or ''):
+        return None
+
+    path = os.path.join(_cache.get_dir(), key)
+    if not _cache.touch(path):
+        return None
+
+    return path
+
+
+def get_data(key):
+    path = get_path(key)
+    if path is None:
+        return None
+
+    with open(path) as f:
+        return f.read()
+
+
+def _make_key():
+    return binascii.hexlify(os.urandom(20))
+
+
+def _remove_file(path):
+    try:
+        os.remove(path)
+
+    except OSError as e:
+        logging.error('failed to remove prepared file %(path)s: %(msg)s' % {'path': path, 'msg': unicode(e)})
+
+
+def _sweep():
+    io_loop = IOLoop.instance()
+    io_loop.add_timeout(datetime.timedelta(seconds=_SWEEP_INTERVAL), _sweep)
+
+    _cache.evict()
@@ -15,6 +15,7 @@
 # You should have received a copy of the GNU General Public License
 # along with this program.  If not, see <http://www.gnu.org/licenses/>. 
 
+import collections
 import functools
 import json
 import logging
@@ -22,13 +23,24 @@ import re
 
 from tornado.httpclient import AsyncHTTPClient, HTTPRequest
 
+import movieremux
 import settings
 import utils
 
 _DOUBLE_SLASH_REGEX = re.compile('//+')
 
+# bytes of a proxied stream kept in memory before the remote transfer is paused
+_STREAM_BUFFER_SIZE = 1024 * 1024
 
-def _make_request(scheme, host, port, username, password, path, method='GET', data=None, query=None, timeout=None, content_type=None):
+# the last current picture received for each remote camera and size,
+# together with its etag, used to answer "304 Not Modified" responses;
+# indexed by camera and then by size, keeping only the most recently requested sizes of a camera
+_current_picture_cache = {}
+_MAX_CURRENT_PICTURE_RENDITIONS = 8
+
+
+def _make_request(scheme, host, port, username, password, path, method='GET', data=None, query=None, timeout=None, content_type=None, headers=None,
+        request_timeout=None):
     path = _DOUBLE_SLASH_REGEX.sub('/', path)
     url = '%(scheme)s://%(host)s%(port)s%(path)s' % {
             'scheme': scheme,
@@ -51,12 +63,15 @@ def _make_request(scheme, host, port, username, password, path, method='GET', da
 
     if timeout is None:
         timeout = settings.REMOTE_REQUEST_TIMEOUT
+
+    if request_timeout is None:
+        request_timeout = timeout
     
-    headers = {}
+    headers = dict(headers or {})
     if content_type:
         headers['Content-Type'] = content_type
 
-    return HTTPRequest(url, method, body=data, connect_timeout=timeout, request_timeout=timeout, headers=headers,
+    return HTTPRequest(url, method, body=data, connect_timeout=timeout, request_timeout=request_timeout, headers=headers,
             validate_cert=settings.VALIDATE_CERTS)
 
 
@@ -124,6 +139,111 @@ def _remote_params(local_config):
     return params
 
 
+def _stream(request, on_headers, on_chunk, callback, on_error):
+    # streams the response to request: on_headers is called with the status code and the relevant headers
+    # before the first chunk, on_chunk(chunk, done) with each chunk of the body, done() having to be called
+    # once the chunk has been passed on; callback is called with an error, if any, at the end,
+    # after on_error(error) has been called
+    state = {'code': None, 'headers': {}, 'streaming': False, 'body': [], 'buffered': 0, 'curl': None,
+            'paused': False, 'done': False}
+
+    def on_header(line):
+        line = line.strip()
+        if line.startswith('HTTP/'): # (a new) status line
+            state['code'] = int(line.split()[1])
+            state['headers'] = {}
+
+        elif ':' in line:
+            (name, value) = line.split(':', 1)
+            state['headers'][name.strip().lower()] = value.strip()
+
+    def start_streaming():
+        headers = state['headers']
+        state['streaming'] = True
+        on_headers({
+            'code': state['code'],
+            'content_type': headers.get('content-type'),
+            'content_disposition': headers.get('content-disposition'),
+            'content_length': headers.get('content-length'),
+            'content_range': headers.get('content-range'),
+            'accept_ranges': headers.get('accept-ranges'),
+            'etag': headers.get('etag'),
+            'last_modified': headers.get('last-modified')
+        })
+
+    def on_data(chunk):
+        if not state['streaming']:
+            if state['code'] not in [200, 206] or state['headers'].get('content-type', '').startswith('application/json'):
+                state['body'].append(chunk) # an error, handled at the end
+                return
+
+            start_streaming()
+
+        # don't let the remote side send faster than the local client can take
+        state['buffered'] += len(chunk)
+        if state['buffered'] > _STREAM_BUFFER_SIZE:
+            pause(True)
+
+        on_chunk(chunk, functools.partial(on_chunk_done, len(chunk)))
+
+    def on_chunk_done(size):
+        state['buffered'] -= size
+        if state['buffered'] <= _STREAM_BUFFER_SIZE / 2:
+            pause(False)
+
+    def pause(paused):
+        if state['curl'] is None or state['done'] or state['paused'] == paused:
+            return
+
+        import pycurl
+
+        try:
+            state['curl'].pause(pycurl.PAUSE_RECV if paused else pycurl.PAUSE_CONT)
+            state['paused'] = paused
+
+        except pycurl.error as e:
+            logging.error('failed to %(what)s download: %(msg)s' % {
+                    'what': ['resume', 'pause'][paused], 'msg': unicode(e)})
+
+    def prepare_curl(curl):
+        state['curl'] = curl
+
+    request.header_callback = on_header
+    request.streaming_callback = on_data
+    request.prepare_curl_callback = prepare_curl
+
+    def on_response(response):
+        state['done'] = True
+        error = None
+        if state['code'] in [304, 416] and not state['streaming']:
+            # answers to conditional and range requests, passed on as they are
+            start_streaming()
+
+        elif state['code'] == 200 and not state['streaming'] and not state['body'] and not response.error:
+            # an empty file
+            start_streaming()
+
+        elif response.error:
+            error = utils.pretty_http_error(response)
+
+        elif not state['streaming']:
+            try:
+                error = json.loads(''.join(state['body']))['error'] or 'no data'
+
+            except Exception:
+                error = 'no data'
+
+        if error:
+            on_error(error)
+
+            return callback(error=error)
+
+        callback()
+
+    http_client = AsyncHTTPClient()
+    http_client.fetch(request, on_response)
+
+
 def list(local_config, callback):
     scheme, host, port, username, password, path, _ = _remote_params(local_config)
     
@@ -299,7 +419,7 @@ def test(local_config, data, callback):
     http_client.fetch(request, _callback_wrapper(on_response))
 
 
-def get_current_picture(local_config, width, height, callback):
+def get_current_picture(local_config, width, height, callback, profile=None):
     scheme, host, port, username, password, path, camera_id = _remote_params(local_config)
     
 #     logging.debug('getting current picture for remote camera %(id)s on %(url)s' % {
@@ -314,9 +434,21 @@ def get_current_picture(local_config, width, height, callback):
     if height:
         query['height'] = str(height)
     
+    if profile:
+        query['profile'] = profile
+
+    renditions = _current_picture_cache.setdefault((scheme, host, port, path, camera_id), collections.OrderedDict())
+    cache_key = (width, height, profile)
+    cached = renditions.pop(cache_key, None)
+    if cached:
+        renditions[cache_key] = cached # the most recently used one
+    headers = {}
+    if cached:
+        headers['If-None-Match'] = cached[0]
+
     request = _make_request(scheme, host, port, username, password,
             path + '/picture/%(id)s/current/' % {'id': camera_id},
-            query=query)
+            query=query, headers=headers)
     
     def on_response(response):
         cookies = utils.parse_cookies(response.headers.get_list('Set-Cookie'))
@@ -325,6 +457,9 @@ def get_current_picture(local_config, width, height, callback):
         capture_fps = float(capture_fps) if capture_fps else 0
         monitor_info = cookies.get('monitor_info_' + str(camera_id))
 
+        if response.code == 304 and cached:
+            return callback(motion_detected, capture_fps, monitor_info, cached[1], cached[0])
+
         if response.error:
             logging.error('failed to get current picture for remote camera %(id)s on %(url)s: %(msg)s' % {
                     'id': camera_id,
@@ -333,13 +468,20 @@ def get_current_picture(local_config, width, height, callback):
             
             return callback(error=utils.pretty_http_error(response))
 
-        callback(motion_detected, capture_fps, monitor_info, response.body)
+        etag = response.headers.get('Etag')
+        renditions.pop(cache_key, None)
+        if etag:
+            renditions[cache_key] = (etag, response.body)
+            while len(renditions) > _MAX_CURRENT_PICTURE_RENDITIONS:
+                renditions.popitem(last=False)
+
+        callback(motion_detected, capture_fps, monitor_info, response.body, etag)
     
     http_client = AsyncHTTPClient()
     http_client.fetch(request, _callback_wrapper(on_response))
 
 
-def list_media(local_config, media_type, prefix, callback):
+def list_media(local_config, media_type, prefix, callback, sort=None, since=None, until=None, cursor=None, limit=None):
     scheme, host, port, username, password, path, camera_id = _remote_params(local_config)
     
     logging.debug('getting media list for remote camera %(id)s on %(url)s' % {
@@ -349,7 +491,12 @@ def list_media(local_config, media_type, prefix, callback):
     query = {}
     if prefix is not None:
         query['prefix'] = prefix
-    
+
+    # pagination parameters
+    for name, value in [('sort', sort), ('since', since), ('until', until), ('cursor', cursor), ('limit', limit)]:
+        if value is not None:
+            query[name] = str(value)
+
     # timeout here is 10 times larger than usual - we expect a big delay when fetching the media list
     request = _make_request(scheme, host, port, username, password,
             path + '/%(media_type)s/%(id)s/list/' % {
@@ -381,7 +528,45 @@ def list_media(local_config, media_type, prefix, callback):
     http_client.fetch(request, _callback_wrapper(on_response))
 
 
-def get_media_content(local_config, filename, media_type, callback):
+def get_media_summary(local_config, media_type, callback):
+    scheme, host, port, username, password, path, camera_id = _remote_params(local_config)
+
+    logging.debug('getting media summary for remote camera %(id)s on %(url)s' % {
+            'id': camera_id,
+            'url': pretty_camera_url(local_config)})
+
+    request = _make_request(scheme, host, port, username, password,
+            path + '/%(media_type)s/%(id)s/summary/' % {
+            'id': camera_id, 'media_type': media_type},
+            timeout=10 * settings.REMOTE_REQUEST_TIMEOUT)
+
+    def on_response(response):
+        if response.error:
+            logging.error('failed to get media summary for remote camera %(id)s on %(url)s: %(msg)s' % {
+                    'id': camera_id,
+                    'url': pretty_camera_url(local_config),
+                    'msg': utils.pretty_http_error(response)})
+
+            return callback(error=utils.pretty_http_error(response))
+
+        try:
+            response = json.loads(response.body)
+
+        except Exception as e:
+            logging.error('failed to decode json answer from %(url)s: %(msg)s' % {
+                    'url': pretty_camera_url(local_config),
+                    'msg': unicode(e)})
+
+            return callback(error=unicode(e))
+
+        return callback(response)
+
+    http_client = AsyncHTTPClient()
+    http_client.fetch(request, _callback_wrapper(on_response))
+
+
+def get_media_content(local_config, filename, media_type, on_headers, on_chunk, callback, headers=None):
+    # streams the media file, see _stream(); headers may contain a Range to be passed on
     scheme, host, port, username, password, path, camera_id = _remote_params(local_config)
     
     logging.debug('downloading file %(filename)s of remote camera %(id)s on %(url)s' % {
@@ -394,26 +579,93 @@ def get_media_content(local_config, filename, media_type, callback):
             'id': camera_id,
             'filename': filename}
     
-    # timeout here is 10 times larger than usual - we expect a big delay when fetching the media list
+    # movies can be big, so only the connection is subject to the usual timeout
+    request = _make_request(scheme, host, port, username, password,
+            path, headers=headers, request_timeout=0)
+
+    def on_error(error):
+        logging.error('failed to download file %(filename)s of remote camera %(id)s on %(url)s: %(msg)s' % {
+                'filename': filename,
+                'id': camera_id,
+                'url': pretty_camera_url(local_config),
+                'msg': error})
+
+    _stream(request, on_headers, on_chunk, callback, on_error)
+
+
+def get_movie_playlist(local_config, filename, callback):
+    # calls back with the list of (start, duration) segments of the movie, as found in its playlist
+    scheme, host, port, username, password, path, camera_id = _remote_params(local_config)
+
+    logging.debug('getting playlist of movie %(filename)s of remote camera %(id)s on %(url)s' % {
+            'filename': filename,
+            'id': camera_id,
+            'url': pretty_camera_url(local_config)})
+
+    path += '/movie/%(id)s/playback/%(filename)s' % {
+            'id': camera_id,
+            'filename': filename}
+
+    # the keyframes of the whole movie have to be found first
     request = _make_request(scheme, host, port, username, password,
             path, timeout=10 * settings.REMOTE_REQUEST_TIMEOUT)
-    
+
     def on_response(response):
+        error = None
         if response.error:
-            logging.error('failed to download file %(filename)s of remote camera %(id)s on %(url)s: %(msg)s' % {
+            error = utils.pretty_http_error(response)
+
+        elif response.headers.get('Content-Type', '').startswith('application/json'):
+            try:
+                error = json.loads(response.body)['error'] or 'no playlist'
+
+            except Exception:
+                error = 'no playlist'
+
+        if error:
+            logging.error('failed to get playlist of movie %(filename)s of remote camera %(id)s on %(url)s: %(msg)s' % {
                     'filename': filename,
                     'id': camera_id,
                     'url': pretty_camera_url(local_config),
-                    'msg': utils.pretty_http_error(response)})
-            
-            return callback(error=utils.pretty_http_error(response))
-        
-        return callback(response.body)
+                    'msg': error})
+
+            return callback(error=error)
+
+        callback(movieremux.parse_playlist(response.body))
 
     http_client = AsyncHTTPClient()
     http_client.fetch(request, _callback_wrapper(on_response))
 
 
+def get_movie_segment(local_config, filename, segment, on_headers, on_chunk, callback, headers=None):
+    # streams a segment of the movie, see _stream()
+    scheme, host, port, username, password, path, camera_id = _remote_params(local_config)
+
+    logging.debug('getting segment %(segment)s of movie %(filename)s of remote camera %(id)s on %(url)s' % {
+            'segment': segment,
+            'filename': filename,
+            'id': camera_id,
+            'url': pretty_camera_url(local_config)})
+
+    path += '/movie/%(id)s/playback/%(filename)s' % {
+            'id': camera_id,
+            'filename': filename}
+
+    # the segment may have to be remuxed first
+    request = _make_request(scheme, host, port, username, password,
+            path, query={'segment': str(segment)}, headers=headers, request_timeout=0)
+
+    def on_error(error):
+        logging.error('failed to get segment %(segment)s of movie %(filename)s of remote camera %(id)s on %(url)s: %(msg)s' % {
+                'segment': segment,
+                'filename': filename,
+                'id': camera_id,
+                'url': pretty_camera_url(local_config),
+                'msg': error})
+
+    _stream(request, on_headers, on_chunk, callback, on_error)
+
+
 def make_zipped_content(local_config, media_type, group, callback):
     scheme, host, port, username, password, path, camera_id = _remote_params(local_config)
     
@@ -457,41 +709,33 @@ def make_zipped_content(local_config, media_type, group, callback):
     http_client.fetch(request, _callback_wrapper(on_response))
 
 
-def get_zipped_content(local_config, media_type, key, group, callback):
+def get_zipped_content(local_config, media_type, key, group, on_headers, on_chunk, callback):
+    # streams the zip file, see _stream()
     scheme, host, port, username, password, path, camera_id = _remote_params(local_config)
     
     logging.debug('downloading zip file for remote camera %(id)s on %(url)s' % {
             'id': camera_id,
             'url': pretty_camera_url(local_config)})
-    
+
+    # the zip file can be big, so only the connection is subject to the usual timeout
     request = _make_request(scheme, host, port, username, password,
             path + '/%(media_type)s/%(id)s/zipped/%(group)s/?key=%(key)s' % {
                     'media_type': media_type,
                     'group': group,
                     'id': camera_id,
                     'key': key},
-            timeout=10 * settings.REMOTE_REQUEST_TIMEOUT)
+            request_timeout=0)
 
-    def on_response(response):
-        if response.error:
-            logging.error('failed to download zip file for remote camera %(id)s on %(url)s: %(msg)s' % {
-                    'id': camera_id,
-                    'url': pretty_camera_url(local_config),
-                    'msg': utils.pretty_http_error(response)})
-
-            return callback(error=utils.pretty_http_error(response))
-
-        callback({
-            'data': response.body,
-            'content_type': response.headers.get('Content-Type'),
-            'content_disposition': response.headers.get('Content-Disposition')
-        })
+    def on_error(error):
+        logging.error('failed to download zip file for remote camera %(id)s on %(url)s: %(msg)s' % {
+                'id': camera_id,
+                'url': pretty_camera_url(local_config),
+                'msg': error})
 
-    http_client = AsyncHTTPClient()
-    http_client.fetch(request, _callback_wrapper(on_response))
+    _stream(request, on_headers, on_chunk, callback, on_error)
 
 
-def make_timelapse_movie(local_config, framerate, interval, group, callback):
+def make_timelapse_movie(local_config, framerate, interval, group, callback, since=None, until=None):
     scheme, host, port, username, password, path, camera_id = _remote_params(local_config)
 
     logging.debug('making timelapse movie for group "%(group)s" of remote camera %(id)s with rate %(framerate)s/%(int)s on %(url)s' % {
@@ -501,14 +745,19 @@ def make_timelapse_movie(local_config, framerate, interval, group, callback):
             'int': interval,
             'url': pretty_camera_url(local_config)})
 
-    path += '/picture/%(id)s/timelapse/%(group)s/?interval=%(int)s&framerate=%(framerate)s' % {
+    path += '/picture/%(id)s/timelapse/%(group)s/' % {
             'id': camera_id,
-            'int': interval,
-            'framerate': framerate,
             'group': group}
-    
+
+    query = {'interval': str(interval), 'framerate': str(framerate)}
+    if since is not None:
+        query['since'] = str(since)
+
+    if until is not None:
+        query['until'] = str(until)
+
     request = _make_request(scheme, host, port, username, password,
-            path, timeout=100 * settings.REMOTE_REQUEST_TIMEOUT)
+            path, query=query, timeout=100 * settings.REMOTE_REQUEST_TIMEOUT)
 
     def on_response(response):
         if response.error:
@@ -538,17 +787,21 @@ def make_timelapse_movie(local_config, framerate, interval, group, callback):
     http_client.fetch(request, _callback_wrapper(on_response))
 
 
-def check_timelapse_movie(local_config, group, callback):
+def check_timelapse_movie(local_config, group, callback, job=None):
     scheme, host, port, username, password, path, camera_id = _remote_params(local_config)
     
     logging.debug('checking timelapse movie status for remote camera %(id)s on %(url)s' % {
             'id': camera_id,
             'url': pretty_camera_url(local_config)})
-    
+
+    query = {'check': 'true'}
+    if job:
+        query['job'] = job
+
     request = _make_request(scheme, host, port, username, password,
-            path + '/picture/%(id)s/timelapse/%(group)s/?check=true' % {
+            path + '/picture/%(id)s/timelapse/%(group)s/' % {
                     'id': camera_id,
-                    'group': group})
+                    'group': group}, query=query)
     
     def on_response(response):
         if response.error:
@@ -575,7 +828,8 @@ def check_timelapse_movie(local_config, group, callback):
     http_client.fetch(request, _callback_wrapper(on_response))
 
 
-def get_timelapse_movie(local_config, key, group, callback):
+def get_timelapse_movie(local_config, key, group, on_headers, on_chunk, callback, headers=None):
+    # streams the timelapse movie, see _stream(); headers may contain a Range to be passed on
     scheme, host, port, username, password, path, camera_id = _remote_params(local_config)
     
     logging.debug('downloading timelapse movie for remote camera %(id)s on %(url)s' % {
@@ -587,25 +841,15 @@ def get_timelapse_movie(local_config, key, group, callback):
                 'id': camera_id,
                 'group': group,
                 'key': key},
-            timeout=10 * settings.REMOTE_REQUEST_TIMEOUT)
-
-    def on_response(response):
-        if response.error:
-            logging.error('failed to download timelapse movie for remote camera %(id)s on %(url)s: %(msg)s' % {
-                    'id': camera_id,
-                    'url': pretty_camera_url(local_config),
-                    'msg': utils.pretty_http_error(response)})
-
-            return callback(error=utils.pretty_http_error(response))
+            headers=headers, request_timeout=0)
 
-        callback({
-            'data': response.body,
-            'content_type': response.headers.get('Content-Type'),
-            'content_disposition': response.headers.get('Content-Disposition')
-        })
+    def on_error(error):
+        logging.error('failed to download timelapse movie for remote camera %(id)s on %(url)s: %(msg)s' % {
+                'id': camera_id,
+                'url': pretty_camera_url(local_config),
+                'msg': error})
 
-    http_client = AsyncHTTPClient()
-    http_client.fetch(request, _callback_wrapper(on_response))
+    _stream(request, on_headers, on_chunk, callback, on_error)
 
 
 def get_media_preview(local_config, filename, media_type, width, height, callback):
@@ -648,6 +892,41 @@ def get_media_preview(local_config, filename, media_type, width, height, callbac
     http_client.fetch(request, _callback_wrapper(on_response))
 
 
+def get_media_previews(local_config, media_type, data, callback):
+    scheme, host, port, username, password, path, camera_id = _remote_params(local_config)
+
+    logging.debug('getting file previews of remote camera %(id)s on %(url)s' % {
+            'id': camera_id,
+            'url': pretty_camera_url(local_config)})
+
+    path += '/%(media_type)s/%(id)s/previews/' % {
+            'media_type': media_type,
+            'id': camera_id}
+
+    # the thumbnails that are missing on the remote side need to be created first
+    request = _make_request(scheme, host, port, username, password,
+            path, method='POST', data=json.dumps(data),
+            request_timeout=10 * settings.REMOTE_REQUEST_TIMEOUT, content_type='application/json')
+
+    def on_response(response):
+        if response.error:
+            logging.error('failed to get file previews of remote camera %(id)s on %(url)s: %(msg)s' % {
+                    'id': camera_id,
+                    'url': pretty_camera_url(local_config),
+                    'msg': utils.pretty_http_error(response)})
+
+            return callback(error=utils.pretty_http_error(response))
+
+        callback({
+            'content_type': response.headers.get('Content-Type'),
+            'cursor': response.headers.get('X-Cursor'),
+            'data': response.body
+        })
+
+    http_client = AsyncHTTPClient()
+    http_client.fetch(request, _callback_wrapper(on_response))
+
+
 def del_media_content(local_config, filename, media_type, callback):
     scheme, host, port, username, password, path, camera_id = _remote_params(local_config)
     
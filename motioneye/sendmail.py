@@ -87,7 +87,7 @@ def make_message(subject, message, camera_id, moment, timespan, callback):
     # we must start the IO loop for the media list subprocess polling
     io_loop = IOLoop.instance()
 
-    def on_media_files(media_files):
+    def on_media_files(media_files, cursor=None):  # @UnusedVariable
         io_loop.stop()
         
         timestamp = time.mktime(moment.timetuple())
@@ -128,7 +128,9 @@ def make_message(subject, message, camera_id, moment, timespan, callback):
     time.sleep(timespan) # give motion some time to create motion pictures
     
     logging.debug('creating email message')
-    mediafiles.list_media(camera_config, media_type='picture', callback=on_media_files)
+    timestamp = time.mktime(moment.timetuple())
+    mediafiles.list_media_page(camera_config, 'picture', callback=on_media_files,
+            since=timestamp - timespan, until=timestamp + timespan)
     
     io_loop.start()
 
@@ -170,11 +170,12 @@ handler_mapping = [
     (r'^/config/main/(?P<op>set|get)/?$', handlers.ConfigHandler),
     (r'^/config/(?P<camera_id>\d+)/(?P<op>get|set|rem|set_preview|test|authorize)/?$', handlers.ConfigHandler),
     (r'^/config/(?P<op>add|list|backup|restore)/?$', handlers.ConfigHandler),
-    (r'^/picture/(?P<camera_id>\d+)/(?P<op>current|list|frame)/?$', handlers.PictureHandler),
+    (r'^/picture/(?P<camera_id>\d+)/(?P<op>current|stream|recent|list|summary|previews|frame)/?$', handlers.PictureHandler),
+    (r'^/picture/mosaic/(?P<op>current|stream)/?$', handlers.MosaicHandler),
     (r'^/picture/(?P<camera_id>\d+)/(?P<op>download|preview|delete)/(?P<filename>.+?)/?$', handlers.PictureHandler),
     (r'^/picture/(?P<camera_id>\d+)/(?P<op>zipped|timelapse|delete_all)/(?P<group>.*?)/?$', handlers.PictureHandler),
-    (r'^/movie/(?P<camera_id>\d+)/(?P<op>list)/?$', handlers.MovieHandler),
-    (r'^/movie/(?P<camera_id>\d+)/(?P<op>download|preview|delete)/(?P<filename>.+?)/?$', handlers.MovieHandler),
+    (r'^/movie/(?P<camera_id>\d+)/(?P<op>list|summary|previews)/?$', handlers.MovieHandler),
+    (r'^/movie/(?P<camera_id>\d+)/(?P<op>download|preview|playback|delete)/(?P<filename>.+?)/?$', handlers.MovieHandler),
     (r'^/movie/(?P<camera_id>\d+)/(?P<op>delete_all)/(?P<group>.*?)/?$', handlers.MovieHandler),
     (r'^/action/(?P<camera_id>\d+)/(?P<action>\w+)/?$', handlers.ActionHandler),
     (r'^/prefs/(?P<key>\w+)?/?$', handlers.PrefsHandler),
@@ -345,11 +346,17 @@ def parse_options(parser, args):
 
 def run():
     import cleanup
+    import mediawatch
     import mjpgclient
     import motionctl
+    import motiondetect
     import motioneye
+    import moviepreview
+    import movieremux
+    import preparedcache
     import smbctl
     import tasks
+    import thumbcache
     import wsswitch
 
     configure_signals()
@@ -366,10 +373,24 @@ def run():
     else:
         start_motion()
 
-    if settings.CLEANUP_INTERVAL:
-        cleanup.start()
-        logging.info('cleanup started')
-        
+    cleanup.start()
+    logging.info('cleanup started')
+
+    mediawatch.start()
+    logging.info('media watcher started')
+
+    preparedcache.start()
+    logging.info('prepared files cache started')
+
+    thumbcache.start()
+    logging.info('thumbnail pool started')
+
+    moviepreview.start()
+    logging.info('movie preview pool started')
+
+    movieremux.start()
+    logging.info('movie remux pool started')
+
     wsswitch.start()
     logging.info('wsswitch started')
 
@@ -380,6 +401,9 @@ def run():
         mjpgclient.start()
         logging.info('mjpg client garbage collector started')
 
+    motiondetect.start()
+    logging.info('motion detection for simple mjpeg cameras started')
+
     if settings.SMB_SHARES:
         smbctl.start()
         logging.info('smb mounts started')
@@ -400,6 +424,18 @@ def run():
     tasks.stop()
     logging.info('tasks stopped')
 
+    thumbcache.stop()
+    logging.info('thumbnail pool stopped')
+
+    moviepreview.stop()
+    logging.info('movie preview pool stopped')
+
+    movieremux.stop()
+    logging.info('movie remux pool stopped')
+
+    mediawatch.stop()
+    logging.info('media watcher stopped')
+
     if cleanup.running():
         cleanup.stop()
         logging.info('cleanup stopped')
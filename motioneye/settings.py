@@ -75,6 +75,15 @@ MOTION_CHECK_INTERVAL = 10
 # to remove old pictures and movies
 CLEANUP_INTERVAL = 43200
 
+# the minimum free space in bytes kept on the storage devices of the cameras
+# by removing their oldest pictures and movies (0 disables it, as does a 0 cleanup interval)
+CLEANUP_MIN_FREE_SPACE = 0
+
+# interval in seconds at which the media dirs that cannot be watched for changes
+# (e.g. network shares) are scanned to keep the media index up to date
+# (set to 0 to scan them only at startup)
+MEDIA_RESCAN_INTERVAL = 300
+
 # timeout in seconds to wait for response from a remote motionEye server
 REMOTE_REQUEST_TIMEOUT = 10
 
@@ -85,6 +94,20 @@ MJPG_CLIENT_TIMEOUT = 10
 # (set to 0 to disable)
 MJPG_CLIENT_IDLE_TIMEOUT = 10
 
+# the maximum number of recent frames kept in memory for each camera
+# (set to 0 to disable)
+MJPG_CLIENT_BUFFER_FRAMES = 25
+
+# the maximum size in bytes of the recent frames kept in memory for each camera
+MJPG_CLIENT_BUFFER_SIZE = 2097152
+
+# the maximum delay in seconds between two reconnection attempts of a failing mjpg client
+MJPG_CLIENT_MAX_RECONNECT_DELAY = 60
+
+# the minimum interval in seconds between two motion restarts caused by failing mjpg clients
+# (set to 0 to never restart motion because of failing mjpg clients)
+MJPG_CLIENT_MOTION_RESTART_INTERVAL = 600
+
 # enable SMB shares (requires motionEye to run as root) 
 SMB_SHARES = False
 
@@ -115,12 +138,34 @@ LIST_MEDIA_TIMEOUT = 120
 # timeout in seconds to wait for media files list, when sending emails
 LIST_MEDIA_TIMEOUT_EMAIL = 10
 
-# timeout in seconds to wait for zip file creation
+# timeout in seconds to wait for the files to be zipped to be listed
 ZIP_TIMEOUT = 500
 
 # timeout in seconds to wait for timelapse creation
 TIMELAPSE_TIMEOUT = 500
 
+# the number of timelapse movies created at once, each by an ffmpeg process
+TIMELAPSE_JOBS = 1
+
+# the maximum total size in bytes of the prepared files
+# (zip file lists, timelapse movies) kept on disk for download
+PREPARED_CACHE_SIZE = 1073741824
+
+# time in seconds after which an unused prepared file is removed
+PREPARED_CACHE_TTL = 3600
+
+# the number of processes creating the picture thumbnails requested in batches
+THUMBNAIL_WORKERS = 2
+
+# the number of movie previews created at once, each by an ffmpeg process
+MOVIE_PREVIEW_WORKERS = 2
+
+# the number of movie segments remuxed at once for playback, each by an ffmpeg process
+MOVIE_REMUX_WORKERS = 2
+
+# the maximum total size in bytes of the remuxed movie segments kept on disk
+MOVIE_REMUX_CACHE_SIZE = 536870912
+
 # enable adding and removing cameras from UI
 ADD_REMOVE_CAMERAS = True
 
@@ -337,6 +337,42 @@ function qualifyPath(path) {
     return url.substring(pos);
 }
         
+var monthNames = ['January', 'February', 'March', 'April', 'May', 'June', 'July',
+        'August', 'September', 'October', 'November', 'December'];
+
+function prettyDateTime(timestamp, short) {
+    /* matches utils.pretty_date_time() on the server side */
+    var date = new Date(timestamp * 1000);
+    var hm = ('0' + date.getHours()).slice(-2) + ':' + ('0' + date.getMinutes()).slice(-2);
+    var month = monthNames[date.getMonth()];
+    
+    if (short) {
+        return date.getDate() + ' ' + month.substring(0, 3) + ', ' + hm;
+    }
+    else {
+        return date.getDate() + ' ' + month + ' ' + date.getFullYear() + ', ' + hm;
+    }
+}
+
+function prettySize(size) {
+    /* matches utils.pretty_size() on the server side */
+    var unit = 'B';
+    if (size >= 1024 * 1024 * 1024) {
+        size /= 1024 * 1024 * 1024;
+        unit = 'GB';
+    }
+    else if (size >= 1024 * 1024) {
+        size /= 1024 * 1024;
+        unit = 'MB';
+    }
+    else if (size >= 1024) {
+        size /= 1024;
+        unit = 'kB';
+    }
+    
+    return size.toFixed(1) + ' ' + unit;
+}
+
 function computeSignature(method, path, body) {
     path = qualifyPath(path);
     
@@ -1491,6 +1527,7 @@ function cameraUi2Dict() {
         'network_username': $('#networkUsernameEntry').val(),
         'network_password': $('#networkPasswordEntry').val(),
         'root_directory': $('#rootDirectoryEntry').val(),
+        'max_media_size': $('#maxMediaSizeEntry').val(),
         'upload_enabled': $('#uploadEnabledSwitch')[0].checked,
         'upload_picture': $('#uploadPictureSwitch')[0].checked,
         'upload_movie': $('#uploadMovieSwitch')[0].checked,
@@ -1522,6 +1559,7 @@ function cameraUi2Dict() {
         'streaming_quality': $('#streamingQualitySlider').val(),
         'streaming_resolution': $('#streamingResolutionSlider').val(),
         'streaming_server_resize': $('#streamingServerResizeSwitch')[0].checked,
+        'streaming_profiles': $('#streamingProfilesEntry').val(),
         'streaming_port': $('#streamingPortEntry').val(),
         'streaming_auth_mode': $('#streamingAuthModeSelect').val() || 'disabled', /* compatibility with old motion */
         'streaming_motion': $('#streamingMotion')[0].checked,
@@ -1786,6 +1824,7 @@ function dict2CameraUi(dict) {
         this.setProgress(percent);
         this.setText((dict['disk_used'] / 1073741824).toFixed(1)  + '/' + (dict['disk_total'] / 1073741824).toFixed(1) + ' GB (' + percent + '%)');
     }); markHideIfNull('disk_used', 'diskUsageProgressBar');
+    $('#maxMediaSizeEntry').val(dict['max_media_size']); markHideIfNull('max_media_size', 'maxMediaSizeEntry');
     
     $('#uploadEnabledSwitch')[0].checked = dict['upload_enabled']; markHideIfNull('upload_enabled', 'uploadEnabledSwitch');
     $('#uploadPictureSwitch')[0].checked = dict['upload_picture']; markHideIfNull('upload_picture', 'uploadPictureSwitch');
@@ -1820,6 +1859,7 @@ function dict2CameraUi(dict) {
     $('#streamingQualitySlider').val(dict['streaming_quality']); markHideIfNull('streaming_quality', 'streamingQualitySlider');
     $('#streamingResolutionSlider').val(dict['streaming_resolution']); markHideIfNull('streaming_resolution', 'streamingResolutionSlider');
     $('#streamingServerResizeSwitch')[0].checked = dict['streaming_server_resize']; markHideIfNull('streaming_server_resize', 'streamingServerResizeSwitch');
+    $('#streamingProfilesEntry').val(dict['streaming_profiles']); markHideIfNull('streaming_profiles', 'streamingProfilesEntry');
     $('#streamingPortEntry').val(dict['streaming_port']); markHideIfNull('streaming_port', 'streamingPortEntry');
     $('#streamingAuthModeSelect').val(dict['streaming_auth_mode']); markHideIfNull('streaming_auth_mode', 'streamingAuthModeSelect');
     $('#streamingMotion')[0].checked = dict['streaming_motion']; markHideIfNull('streaming_motion', 'streamingMotion');
@@ -3022,9 +3062,51 @@ function runPictureDialog(entries, pos, mediaType) {
     content.append(nextArrow);
     
     var progressImg = $('<img class="picture-dialog-progress" src="' + staticPath + 'img/modal-progress.gif">');
+    var video = null;
+    
+    function stopMovie() {
+        if (video) {
+            video[0].pause();
+            video.remove();
+            video = null;
+            img.css('display', '');
+        }
+    }
+    
+    function playMovie() {
+        var entry = entries[pos];
+        var videoElement = document.createElement('video');
+        var downloadUrl = basePath + mediaType + '/' + entry.cameraId + '/download' + entry.path;
+        var url = downloadUrl; /* played as it is, if the browser can */
+        
+        stopMovie();
+        
+        /* only H.264 and HEVC movies (written in mp4 and mkv files) can be remuxed into HLS segments */
+        if (videoElement.canPlayType('application/vnd.apple.mpegurl') && entry.path.match(/\.(mp4|mkv)$/i)) {
+            /* remuxed in segments on the fly, so playback starts right away and seeking only fetches what's needed */
+            url = basePath + mediaType + '/' + entry.cameraId + '/playback' + entry.path;
+            videoElement.onerror = function () {
+                /* e.g. another codec, that can't be remuxed */
+                videoElement.onerror = null;
+                videoElement.src = addAuthParams('GET', downloadUrl);
+            };
+        }
+        
+        video = $(videoElement);
+        video.attr({'class': 'picture-dialog-content', 'controls': 'controls', 'autoplay': 'autoplay'});
+        video.width(img.width());
+        video.height(img.height());
+        video.attr('src', addAuthParams('GET', url));
+        
+        img.css('display', 'none');
+        img.after(video);
+        updateModalDialogPosition();
+    }
     
     function updatePicture() {
         var entry = entries[pos];
+        
+        stopMovie();
 
         var windowWidth = $(window).width();
         var windowHeight = $(window).height();
@@ -3099,22 +3181,33 @@ function runPictureDialog(entries, pos, mediaType) {
     
     img.load(updateModalDialogPosition);
     
+    var buttons = [
+        {caption: 'Close'},
+        {caption: 'Download', isDefault: true, click: function () {
+            var entry = entries[pos];
+            downloadFile(mediaType + '/' + entry.cameraId + '/download' + entry.path);
+            
+            return false;
+        }}
+    ];
+    
+    if (mediaType == 'movie') {
+        buttons.splice(1, 0, {caption: 'Play', click: function () {
+            playMovie();
+            
+            return false;
+        }});
+    }
+    
     runModalDialog({
         title: ' ',
         closeButton: true,
-        buttons: [
-            {caption: 'Close'},
-            {caption: 'Download', isDefault: true, click: function () {
-                var entry = entries[pos];
-                downloadFile(mediaType + '/' + entry.cameraId + '/download' + entry.path);
-                
-                return false;
-            }}
-        ],
+        buttons: buttons,
         content: content,
         stack: true,
         onShow: updatePicture,
         onClose: function () {
+            stopMovie();
             $('body').off('keydown', bodyKeyDown);
         }
     });
@@ -3441,6 +3534,16 @@ function runTimelapseDialog(cameraId, groupKey, group) {
                     '<td class="dialog-item-label"><span class="dialog-item-label">Group</span></td>' +
                     '<td class="dialog-item-value">' + groupKey + '</td>' +
                 '</tr>' +
+                '<tr>' +
+                    '<td class="dialog-item-label"><span class="dialog-item-label">From</span></td>' +
+                    '<td class="dialog-item-value"><input type="text" class="styled timelapse" id="fromEntry" placeholder="yyyy-mm-dd"></td>' +
+                    '<td><span class="help-mark" title="change the dates to include the pictures of all the groups taken between them">?</span></td>' +
+                '</tr>' +
+                '<tr>' +
+                    '<td class="dialog-item-label"><span class="dialog-item-label">To</span></td>' +
+                    '<td class="dialog-item-value"><input type="text" class="styled timelapse" id="toEntry" placeholder="yyyy-mm-dd"></td>' +
+                    '<td></td>' +
+                '</tr>' +
                 '<tr>' +
                     '<td class="dialog-item-label"><span class="dialog-item-label">Include a picture taken every</span></td>' +
                     '<td class="dialog-item-value">' +
@@ -3467,8 +3570,30 @@ function runTimelapseDialog(cameraId, groupKey, group) {
 
     var intervalSelect = content.find('#intervalSelect');
     var framerateSlider = content.find('#framerateSlider');
+    var fromEntry = content.find('#fromEntry');
+    var toEntry = content.find('#toEntry');
     var timelapseWarning = content.find('td.timelapse-warning');
     
+    function formatDate(timestamp) {
+        var date = new Date(timestamp * 1000);
+        return date.getFullYear() + '-' + ('0' + (date.getMonth() + 1)).slice(-2) + '-' + ('0' + date.getDate()).slice(-2);
+    }
+    
+    function parseDate(str) {
+        var match = str.trim().match(/^(\d{4})-(\d{1,2})-(\d{1,2})$/);
+        if (!match) {
+            return null;
+        }
+        
+        return new Date(parseInt(match[1], 10), parseInt(match[2], 10) - 1, parseInt(match[3], 10));
+    }
+    
+    var timestamps = group.map(function (e) {return e.timestamp;}).filter(function (t) {return t;});
+    var groupFrom = timestamps.length ? formatDate(Math.min.apply(null, timestamps)) : '';
+    var groupTo = timestamps.length ? formatDate(Math.max.apply(null, timestamps)) : '';
+    fromEntry.val(groupFrom);
+    toEntry.val(groupTo);
+    
     if (group.length > 1440) { /* one day worth of pictures, taken 1 minute apart */
         timelapseWarning.html('Given the large number of pictures, creating your timelapse might take a while!');
         timelapseWarning.css('display', 'table-cell');
@@ -3492,6 +3617,25 @@ function runTimelapseDialog(cameraId, groupKey, group) {
         buttons: 'okcancel',
         content: content,
         onOk: function () {
+            var url = basePath + 'picture/' + cameraId + '/timelapse/' + groupKey + '/';
+            var data = {interval: intervalSelect.val(), framerate: framerateSlider.val()};
+            
+            if (fromEntry.val() != groupFrom || toEntry.val() != groupTo) {
+                /* a range of days, spanning all groups */
+                var from = parseDate(fromEntry.val());
+                var to = parseDate(toEntry.val());
+                if (!from || !to || from > to) {
+                    showErrorMessage('Invalid timelapse dates.');
+                    return false;
+                }
+                
+                to.setDate(to.getDate() + 1);
+                data.since = from.getTime() / 1000;
+                data.until = to.getTime() / 1000 - 0.001;
+                url = basePath + 'picture/' + cameraId + '/timelapse/';
+                groupKey = '';
+            }
+            
             var progressBar = $('<div style=""></div>');
             makeProgressBar(progressBar);
             
@@ -3502,14 +3646,16 @@ function runTimelapseDialog(cameraId, groupKey, group) {
                 noKeys: true
             });
             
-            var url = basePath + 'picture/' + cameraId + '/timelapse/' + groupKey + '/';
-            var data = {interval: intervalSelect.val(), framerate: framerateSlider.val()};
             var first = true;
+            var job = null;
             
             function checkTimelapse() {
                 var actualUrl = url;
                 if (!first) {
                     actualUrl += '?check=true';
+                    if (job) {
+                        actualUrl += '&job=' + job;
+                    }
                 }
 
                 ajax('GET', actualUrl, data, function (data) {
@@ -3520,7 +3666,10 @@ function runTimelapseDialog(cameraId, groupKey, group) {
                         return;
                     }
                     
-                    if (data.progress != -1 && first) {
+                    if (data.id) {
+                        job = data.id;
+                    }
+                    else if (data.progress != -1 && first) { /* older servers create one timelapse at a time */
                         showPopupMessage('A timelapse movie is already being created.');
                     }
                     
@@ -3563,6 +3712,38 @@ function runTimelapseDialog(cameraId, groupKey, group) {
     });
 }
 
+function fetchMediaGroups(cameraId, mediaType, callback) {
+    /* older remote servers can only list all the media */
+    function summarizeMediaList() {
+        ajax('GET', basePath + mediaType + '/' + cameraId + '/list/', null, function (data) {
+            if (data == null || data.error) {
+                return callback(data);
+            }
+            
+            var groups = {};
+            data.mediaList.forEach(function (media) {
+                var key = media.path.substring(0, media.path.lastIndexOf('/')).substring(1);
+                var group = (groups[key] = groups[key] || {'group': key, 'count': 0});
+                group.count++;
+            });
+            
+            callback({
+                'groups': Object.keys(groups).map(function (key) {return groups[key];}),
+                'cameraName': data.cameraName
+            });
+        });
+    }
+    
+    ajax('GET', basePath + mediaType + '/' + cameraId + '/summary/', null, function (data) {
+        if (data && !data.error) {
+            callback(data);
+        }
+        else {
+            summarizeMediaList();
+        }
+    }, summarizeMediaList);
+}
+
 function runMediaDialog(cameraId, mediaType) {
     var dialogDiv = $('<div class="media-dialog"></div>');
     var mediaListDiv = $('<div class="media-dialog-list"></div>');
@@ -3570,6 +3751,7 @@ function runMediaDialog(cameraId, mediaType) {
     var buttonsDiv = $('<div class="media-dialog-buttons"></div>');
     
     var groups = {};
+    var loadedGroups = {};
     var groupKey = null;
     
     dialogDiv.append(groupsDiv);
@@ -3600,7 +3782,6 @@ function runMediaDialog(cameraId, mediaType) {
             }
         });
         
-        var mediaListByName = {};
         var entries = groups[key];
         
         /* cleanup the media list */
@@ -3619,6 +3800,7 @@ function runMediaDialog(cameraId, mediaType) {
                     var previewImg = $('<img class="media-list-preview" src="' + staticPath + 'img/modal-progress.gif"/>');
                     entryDiv.append(previewImg);
                     previewImg[0]._src = addAuthParams('GET', basePath + mediaType + '/' + cameraId + '/preview' + entry.path + '?height=' + height);
+                    previewImg[0]._path = entry.path;
                     
                     var downloadButton = $('<div class="media-list-download-button button">Download</div>');
                     entryDiv.append(downloadButton);
@@ -3687,15 +3869,15 @@ function runMediaDialog(cameraId, mediaType) {
             mediaListDiv.scroll();
         }
         
-        /* if details are already fetched, simply add the entries and return */
-        if (entries[0].timestamp) {
+        /* if the group is already fetched, simply add the entries and return */
+        if (loadedGroups[key]) {
             return addEntries();
         }
         
         var previewImg = $('<img class="media-list-progress" src="' + staticPath + 'img/modal-progress.gif"/>');
         mediaListDiv.append(previewImg);
         
-        var url = basePath + mediaType + '/' + cameraId + '/list/?prefix=' + (key || 'ungrouped');
+        var url = basePath + mediaType + '/' + cameraId + '/list/?prefix=' + (key || 'ungrouped') + '&sort=-time';
         ajax('GET', url, null, function (data) {
             previewImg.remove();
             
@@ -3705,28 +3887,25 @@ function runMediaDialog(cameraId, mediaType) {
                 return;
             }
             
-            /* index the media list by name */
             data.mediaList.forEach(function (media) {
-                var path = media.path;
-                var parts = path.split('/');
-                var name = parts[parts.length - 1];
+                var parts = media.path.split('/');
                 
-                mediaListByName[name] = media;
+                entries.push({
+                    'path': media.path,
+                    'group': key,
+                    'name': parts[parts.length - 1],
+                    'cameraId': cameraId,
+                    /* older remote servers return the formatted details */
+                    'momentStr': media.momentStr || prettyDateTime(media.timestamp),
+                    'momentStrShort': media.momentStrShort || prettyDateTime(media.timestamp, true),
+                    'sizeStr': media.sizeStr || prettySize(media.size),
+                    'timestamp': media.timestamp
+                });
             });
             
-            /* assign details to entries */
-                entries.forEach(function (entry) {
-                    var media = mediaListByName[entry.name];
-                    if (media) {
-                        entry.momentStr = media.momentStr;
-                        entry.momentStrShort = media.momentStrShort;
-                        entry.sizeStr = media.sizeStr;
-                        entry.timestamp = media.timestamp;
-                    }
-                });
- 
-                /* sort the entries by timestamp */
+            /* sort the entries by timestamp */
             entries.sortKey(function (e) {return e.timestamp || e.name;}, true);
+            loadedGroups[key] = true;
             
             addEntries();
         });
@@ -3827,33 +4006,18 @@ function runMediaDialog(cameraId, mediaType) {
     
     showModalDialog('<div class="modal-progress"></div>');
     
-    /* fetch the media list */
-    ajax('GET', basePath + mediaType + '/' + cameraId + '/list/', null, function (data) {
+    /* fetch the media groups */
+    fetchMediaGroups(cameraId, mediaType, function (data) {
         if (data == null || data.error) {
             hideModalDialog();
             showErrorMessage(data && data.error);
             return;
         }
         
-        /* group the media */
-        data.mediaList.forEach(function (media) {
-            var path = media.path;
-            var parts = path.split('/');
-            var keyParts = parts.splice(0, parts.length - 1);
-            var key = keyParts.join('/');
-            
-            if (key.indexOf('/') === 0) {
-                key = key.substring(1);
-            }
-            
-            var list = (groups[key] = groups[key] || []);
-            
-            list.push({
-                'path': path,
-                'group': key,
-                'name': parts[parts.length - 1],
-                'cameraId': cameraId
-            });
+        var counts = {};
+        data.groups.forEach(function (group) {
+            groups[group.group] = [];
+            counts[group.group] = group.count;
         });
         
         updateDialogSize();
@@ -3865,7 +4029,7 @@ function runMediaDialog(cameraId, mediaType) {
         if (keys.length) {
             keys.forEach(function (key) {
                 var groupButton = $('<div class="media-dialog-group-button"></div>');
-                groupButton.text((key || '(ungrouped)') + ' (' + groups[key].length + ')');
+                groupButton.text((key || '(ungrouped)') + ' (' + counts[key] + ')');
                 groupButton[0].key = key;
                 
                 groupButton.click(function () {
@@ -3919,7 +4083,8 @@ function runMediaDialog(cameraId, mediaType) {
     
     /* install the media list scroll event handler */
     mediaListDiv.scroll(function () {
-        var height = mediaListDiv.height();
+        var listHeight = mediaListDiv.height();
+        var visibleImgs = [];
         
         mediaListDiv.find('img.media-list-preview').each(function () {
             if (!this._src) {
@@ -3932,16 +4097,128 @@ function runMediaDialog(cameraId, mediaType) {
             var top1 = entryDiv.position().top;
             var top2 = top1 + entryDiv.height();
             
-            if ((top1 >= 0 && top1 <= height) ||
-                (top2 >= 0 && top2 <= height)) {
+            if ((top1 >= 0 && top1 <= listHeight) ||
+                (top2 >= 0 && top2 <= listHeight)) {
                 
-                this.src = this._src;
-                delete this._src;
+                visibleImgs.push(this);
             }
         });
+        
+        if (visibleImgs.length > 1 && !window._batchPreviewsUnsupported) {
+            loadMediaPreviews(mediaType, cameraId, height, visibleImgs);
+        }
+        else {
+            visibleImgs.forEach(function (img) {
+                img.src = img._src;
+                delete img._src;
+            });
+        }
     });
 }
 
+function loadMediaPreviews(mediaType, cameraId, height, imgs) {
+    /* fetches the previews of several media files with a single request,
+     * falling back to one request per preview for those that can't be obtained this way */
+    
+    var imgsByPath = {};
+    var srcs = [];
+    imgs.forEach(function (img) {
+        imgsByPath[img._path] = img;
+        srcs.push(img._src);
+        delete img._src; /* not to be requested again while the batch is in progress */
+    });
+    
+    function fallback() {
+        imgs.forEach(function (img, i) {
+            if (!img._loaded) {
+                img.src = srcs[i];
+            }
+        });
+    }
+    
+    var data = JSON.stringify({paths: Object.keys(imgsByPath), height: height});
+    var url = basePath + mediaType + '/' + cameraId + '/previews/';
+    
+    var request = new XMLHttpRequest();
+    request.open('POST', addAuthParams('POST', url, data));
+    request.setRequestHeader('Content-Type', 'application/json');
+    request.responseType = 'arraybuffer';
+    request.onload = function () {
+        var contentType = request.getResponseHeader('Content-Type') || '';
+        var match = contentType.match(/^multipart\/mixed; *boundary=(.+)$/);
+        if (request.status != 200 || !match) {
+            if (request.status == 404) { /* older server */
+                window._batchPreviewsUnsupported = true;
+            }
+            
+            return fallback();
+        }
+        
+        parseMultipart(request.response, match[1]).forEach(function (part) {
+            var img = imgsByPath[decodeURIComponent(part.headers['x-path'] || '')];
+            if (!img) {
+                return;
+            }
+            
+            img._loaded = true;
+            img.onload = function () {
+                URL.revokeObjectURL(this.src);
+                this.onload = null;
+            };
+            img.src = URL.createObjectURL(new Blob([part.data], {type: part.headers['content-type']}));
+        });
+        
+        fallback(); /* for the previews missing from the response */
+    };
+    request.onerror = fallback;
+    request.send(data);
+}
+
+function parseMultipart(buffer, boundary) {
+    /* returns the parts of a multipart body given as an array buffer,
+     * as a list of {headers, data} objects; each part must have a content length */
+    
+    var bytes = new Uint8Array(buffer);
+    var parts = [];
+    var pos = 0;
+    
+    function readLine() {
+        var line = '';
+        while (pos < bytes.length && !(bytes[pos] == 13 && bytes[pos + 1] == 10)) {
+            line += String.fromCharCode(bytes[pos++]);
+        }
+        pos += 2;
+        
+        return line;
+    }
+    
+    while (pos < bytes.length) {
+        var line = readLine();
+        if (line == '--' + boundary + '--') {
+            break;
+        }
+        if (line != '--' + boundary) {
+            continue;
+        }
+        
+        var headers = {};
+        while ((line = readLine())) {
+            var i = line.indexOf(':');
+            headers[line.substring(0, i).trim().toLowerCase()] = line.substring(i + 1).trim();
+        }
+        
+        var length = parseInt(headers['content-length']);
+        if (isNaN(length)) {
+            break;
+        }
+        
+        parts.push({headers: headers, data: bytes.subarray(pos, pos + length)});
+        pos += length + 2;
+    }
+    
+    return parts;
+}
+
 
     /* camera frames */
 
@@ -4517,9 +4794,9 @@ function refreshCameraFrames() {
         if (!this.img) {
             this.img = $(this).find('img.camera')[0];
             if (this.config['proto'] == 'mjpeg') {
-                var url = this.config['url'].replace('127.0.0.1', window.location.host.split(':')[0]);
-                url += (url.indexOf('?') > 0 ? '&' : '?') + '_=' + new Date().getTime();
-                this.img.src = url;
+                /* the stream is proxied by the server, so that the camera sees a single connection */
+                var path = basePath + 'picture/' + this.config['id'] + '/stream/?_=' + new Date().getTime();
+                this.img.src = addAuthParams('GET', path);
             }
         }
         
@@ -0,0 +1,306 @@
+
+# Copyright (c) 2013 Calin Crisan
+# This file is part of motionEye.
+#
+# motionEye is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import collections
+import datetime
+import errno
+import logging
+import os
+import re
+import StringIO
+
+from PIL import Image
+from tornado.ioloop import IOLoop
+
+import settings
+import tasks
+import utils
+
+
+_DIR_NAME = '.thumbs'
+_MAX_SIZES = 4 # the number of recently requested sizes that are generated in advance for new pictures
+_PREGENERATE_DELAY = 5 # seconds
+_MAKE_TIMEOUT = 30 # seconds
+
+# what follows the name of the media file in the name of its thumbnails: .<mtime>-<size>.<width>x<height>.jpg,
+# optionally with the suffix of a thumbnail that is still being written
+_THUMB_SUFFIX_REGEX = re.compile('^\.\d+-\d+\.\d*x\d*\.jpg(\.\d+\.tmp)?$')
+
+# the recently requested thumbnail sizes, indexed by camera id
+_sizes = {}
+
+# the new pictures waiting for their thumbnails to be generated, indexed by camera id
+_pending = {}
+
+# the processes that generate the thumbnails requested in batches
+_pool = None
+
+
+def start():
+    global _pool
+
+    _pool = utils.ProcessPool(settings.THUMBNAIL_WORKERS)
+
+
+def stop():
+    global _pool
+
+    if _pool is not None:
+        _pool.terminate()
+        _pool = None
+
+
+def get(camera_config, full_path, width, height, callback):
+    # calls back with the thumbnail of the given picture, creating it with the process pool if it doesn't exist;
+    # calls back with None if the picture cannot be read
+    contents = []
+
+    get_many(camera_config, [full_path], width, height, on_thumb=lambda full_path, content: contents.append(content),
+            callback=lambda: callback(contents[0] if contents else None))
+
+
+def get_many(camera_config, full_paths, width, height, on_thumb, callback):
+    # calls on_thumb(full_path, content) for each thumbnail as soon as it's ready and then callback();
+    # the missing thumbnails are created by the process pool, leaving the IO loop free
+    _remember_size(camera_config, width, height)
+
+    missing = []
+    for full_path in full_paths:
+        st = _stat(full_path)
+        if st is None:
+            continue
+
+        content = _read_thumb(camera_config, full_path, st, width, height)
+        if content is not None:
+            on_thumb(full_path, content)
+
+        elif _pool is not None:
+            missing.append((full_path, st))
+
+        else:
+            content = _make_thumb(camera_config, full_path, st, width, height)
+            if content is not None:
+                on_thumb(full_path, content)
+
+    if not missing:
+        return callback()
+
+    logging.debug('creating %(count)s thumbnails...' % {'count': len(missing)})
+
+    state = {'remaining': len(missing)}
+
+    def on_made(full_path, content):
+        state['remaining'] -= 1
+        if content is not None:
+            on_thumb(full_path, content)
+
+        if state['remaining'] == 0:
+            callback()
+
+    for (full_path, st) in missing:
+        _pool.apply(_make_thumb, (camera_config, full_path, st, width, height),
+                callback=lambda content, full_path=full_path: on_made(full_path, content), timeout=_MAKE_TIMEOUT)
+
+
+def add_pictures(camera_config, full_paths):
+    # schedules the generation of the thumbnails of new pictures, in the recently requested sizes;
+    # pictures arriving close to each other are handled together
+    sizes = _sizes.get(camera_config['@id'])
+    if not sizes:
+        return # no thumbnails requested for this camera since startup
+
+    camera_id = camera_config['@id']
+    pending = _pending.get(camera_id)
+    if pending is None:
+        pending = _pending[camera_id] = []
+
+        def schedule():
+            paths = _pending.pop(camera_id)
+            tasks.add(0, make_thumbs, tag='make_thumbs(%s files)' % len(paths),
+                    camera_config=camera_config, full_paths=paths, sizes=_sizes[camera_id].keys())
+
+        io_loop = IOLoop.instance()
+        io_loop.add_timeout(datetime.timedelta(seconds=_PREGENERATE_DELAY), schedule)
+
+    pending.extend(full_paths)
+
+
+def make_thumbs(camera_config, full_paths, sizes):
+    for full_path in full_paths:
+        try:
+            st = os.stat(full_path)
+
+        except OSError:
+            continue # removed in the meantime
+
+        for (width, height) in sizes:
+            if not os.path.exists(_get_thumb_path(camera_config, full_path, st, width, height)):
+                _make_thumb(camera_config, full_path, st, width, height)
+
+
+def remove(camera_config, full_paths):
+    # removes the thumbnails of the given media files, as well as the directories left empty
+    target_dir = camera_config.get('target_dir')
+    root = _get_camera_dir(camera_config)
+
+    names_by_dir = {}
+    for full_path in full_paths:
+        rel_path = os.path.relpath(full_path, target_dir)
+        thumb_dir = os.path.normpath(os.path.join(root, os.path.dirname(rel_path)))
+        names_by_dir.setdefault(thumb_dir, set()).add(os.path.basename(rel_path))
+
+    for thumb_dir, names in names_by_dir.iteritems():
+        try:
+            listing = os.listdir(thumb_dir)
+
+        except OSError:
+            continue # no thumbnails here
+
+        for thumb_name in listing:
+            # the media file name ends before a suffix that looks like the one of a thumbnail
+            for i in xrange(len(thumb_name)):
+                if thumb_name[i] == '.' and thumb_name[:i] in names and _THUMB_SUFFIX_REGEX.match(thumb_name[i:]):
+                    break
+
+            else:
+                continue
+
+            try:
+                os.remove(os.path.join(thumb_dir, thumb_name))
+
+            except OSError as e:
+                logging.error('failed to remove thumbnail %(path)s: %(msg)s' % {
+                        'path': os.path.join(thumb_dir, thumb_name), 'msg': unicode(e)})
+
+        # remove the dirs left empty, up to the camera dir
+        while thumb_dir.startswith(root + '/'):
+            try:
+                os.rmdir(thumb_dir)
+
+            except OSError:
+                break # not empty
+
+            thumb_dir = os.path.dirname(thumb_dir)
+
+
+def _remember_size(camera_config, width, height):
+    sizes = _sizes.setdefault(camera_config['@id'], collections.OrderedDict())
+    sizes.pop((width, height), None)
+    sizes[(width, height)] = True
+    while len(sizes) > _MAX_SIZES:
+        sizes.popitem(last=False)
+
+
+def _stat(full_path):
+    try:
+        return os.stat(full_path)
+
+    except OSError as e:
+        if e.errno == errno.ENOENT:
+            logging.debug('file %(path)s does not exist' % {'path': full_path})
+
+        else:
+            logging.error('failed to stat file %(path)s: %(msg)s' % {'path': full_path, 'msg': unicode(e)})
+
+        return None
+
+
+def _read_thumb(camera_config, full_path, st, width, height):
+    thumb_path = _get_thumb_path(camera_config, full_path, st, width, height)
+    try:
+        with open(thumb_path) as f:
+            return f.read()
+
+    except IOError as e:
+        if e.errno != errno.ENOENT:
+            logging.error('failed to read thumbnail %(path)s: %(msg)s' % {'path': thumb_path, 'msg': unicode(e)})
+
+        return None
+
+
+def _get_camera_dir(camera_config):
+    return os.path.join(settings.MEDIA_PATH, _DIR_NAME, str(camera_config['@id']))
+
+
+def _get_thumb_path(camera_config, full_path, st, width, height):
+    rel_path = os.path.relpath(full_path, camera_config.get('target_dir'))
+
+    return os.path.join(_get_camera_dir(camera_config), '%(path)s.%(mtime)d-%(size)d.%(width)sx%(height)s.jpg' % {
+            'path': rel_path, 'mtime': st.st_mtime, 'size': st.st_size, 'width': width or '', 'height': height or ''})
+
+
+def _make_thumb(camera_config, full_path, st, width, height):
+    try:
+        # thumbnail() decodes jpegs in draft mode, at the smallest scale that still covers the requested size,
+        # as long as the image hasn't been loaded before
+        image = Image.open(full_path)
+        image.thumbnail((width or image.size[0], height or image.size[1]), Image.LINEAR)
+
+        sio = StringIO.StringIO()
+        image.save(sio, format='JPEG')
+        content = sio.getvalue()
+
+    except Exception as e:
+        logging.error('failed to create thumbnail of %(path)s: %(msg)s' % {'path': full_path, 'msg': unicode(e)})
+
+        return None
+
+    thumb_path = _get_thumb_path(camera_config, full_path, st, width, height)
+    tmp_path = '%s.%s.tmp' % (thumb_path, os.getpid())
+
+    try:
+        thumb_dir = os.path.dirname(thumb_path)
+        if not os.path.isdir(thumb_dir):
+            os.makedirs(thumb_dir)
+
+        with open(tmp_path, 'w') as f:
+            f.write(content)
+
+        os.rename(tmp_path, thumb_path)
+
+    except (IOError, OSError) as e:
+        logging.error('failed to save thumbnail %(path)s: %(msg)s' % {'path': thumb_path, 'msg': unicode(e)})
+
+        return content
+
+    _remove_stale_thumbs(thumb_path, os.path.basename(full_path), st)
+
+    return content
+
+
+def _remove_stale_thumbs(thumb_path, name, st):
+    # removes the thumbnails made for a former version of a media file (i.e. with another mtime or size)
+    thumb_dir = os.path.dirname(thumb_path)
+    key = '.%d-%d.' % (st.st_mtime, st.st_size)
+    try:
+        listing = [n for n in os.listdir(thumb_dir) if n.startswith(name + '.')]
+
+    except OSError:
+        return
+
+    for thumb_name in listing:
+        suffix = thumb_name[len(name):]
+        if suffix.startswith(key) or suffix.endswith('.tmp') or not _THUMB_SUFFIX_REGEX.match(suffix):
+            continue # a current thumbnail, one still being written or the thumbnail of another file
+
+        try:
+            os.remove(os.path.join(thumb_dir, thumb_name))
+
+        except OSError as e:
+            if e.errno != errno.ENOENT: # removed by another process in the meantime
+                logging.error('failed to remove thumbnail %(path)s: %(msg)s' % {
+                        'path': os.path.join(thumb_dir, thumb_name), 'msg': unicode(e)})
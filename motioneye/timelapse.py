@@ -0,0 +1,398 @@
+
+# Copyright (c) 2013 Calin Crisan
+# This file is part of motionEye.
+#
+# motionEye is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import binascii
+import collections
+import datetime
+import errno
+import fcntl
+import logging
+import math
+import os
+import signal
+import subprocess
+import time
+
+from tornado.ioloop import IOLoop
+
+try:
+    import numpy
+
+except ImportError:
+    numpy = None
+
+import mediafiles
+import mediaindex
+import mediascan
+import preparedcache
+import settings
+
+
+_BITRATE = 9999999
+_KEEP_FINISHED = 3600 # seconds to keep the status of a finished job
+_POLL_INTERVAL = 0.5 # seconds between checks of an ffmpeg process whose output has ended
+_OUTPUT_LINES = 10 # the last lines of ffmpeg output (other than progress) logged when it fails
+_BATCH_SIZE = 10000 # selected pictures sent back at once by the selecting subprocess
+
+# the timelapse jobs, indexed by id; values are dicts with id, camera_id, group, since, until, framerate, interval,
+# progress (-1 when finished), key (set on success), error (set on failure) and started
+_jobs = {}
+
+# the ids of the jobs whose pictures are selected, waiting for ffmpeg to be started
+_waiting = collections.deque()
+
+# the running ffmpeg processes, indexed by job id
+_processes = {}
+
+
+def make_job(camera_config, framerate, interval, group=None, since=None, until=None):
+    # starts a new timelapse job and returns its id; the pictures are taken from the given group,
+    # or from all groups if group is None, and may be restricted to those taken between since and until;
+    # a job with the same parameters that's still in progress is reused instead
+    camera_id = camera_config['@id']
+    for job in _jobs.itervalues():
+        if (job['camera_id'] == camera_id and job['group'] == group and job['framerate'] == framerate and
+            job['interval'] == interval and job['since'] == since and job['until'] == until and
+            job['progress'] != -1):
+
+            logging.debug('timelapse job %(id)s is already in progress' % {'id': job['id']})
+
+            return job['id']
+
+    job_id = binascii.hexlify(os.urandom(8))
+    job = _jobs[job_id] = {
+        'id': job_id,
+        'camera_id': camera_id,
+        'group': group,
+        'since': since,
+        'until': until,
+        'framerate': framerate,
+        'interval': interval,
+        'progress': 0,
+        'key': None,
+        'error': None,
+        'started': time.time()
+    }
+
+    logging.debug('starting timelapse job %(id)s for group "%(group)s" of camera %(camera_id)s' % {
+            'id': job_id, 'group': group if group is not None else '*', 'camera_id': camera_id})
+
+    target_dir = camera_config.get('target_dir')
+    full_paths = []
+
+    def on_pictures(error=None):
+        if error:
+            return _finish(job, error='Failed to list the pictures.')
+
+        logging.debug('timelapse job %(id)s: selected %(count)s pictures' % {'id': job_id, 'count': len(full_paths)})
+
+        if not full_paths:
+            return _finish(job, error='There are no pictures to make a timelapse movie of.')
+
+        job['full_paths'] = full_paths
+        job['camera_config'] = camera_config
+
+        _waiting.append(job_id)
+        _run_next()
+
+    if mediaindex.is_complete(camera_config):
+        # the pictures are selected by a subprocess, as there may be millions of them to go through
+        def select_from_index():
+            timeline = mediaindex.get_timestamps(camera_config, 'picture', prefix=group, since=since, until=until)
+            if timeline is None:
+                raise Exception('media index query failed')
+
+            ids = [timeline[i][0] for i in _select_pictures([t for (i, t) in timeline], interval, since)]  # @UnusedVariable
+            paths = mediaindex.get_paths(camera_config, ids)
+            if paths is None:
+                raise Exception('media index query failed')
+
+            for i in xrange(0, len(paths), _BATCH_SIZE):
+                yield [os.path.join(target_dir, p.lstrip('/')) for p in paths[i:i + _BATCH_SIZE]]
+
+        mediascan.run(select_from_index, on_batch=full_paths.extend, on_done=on_pictures,
+                timeout=settings.TIMELAPSE_TIMEOUT)
+
+    else:
+        def on_media_list(media_list, cursor=None):  # @UnusedVariable
+            if media_list is None:
+                return on_pictures('media listing failed')
+
+            selected = _select_pictures([m['timestamp'] for m in media_list], interval, since)
+            full_paths.extend(os.path.join(target_dir, media_list[i]['path'].lstrip('/')) for i in selected)
+            on_pictures()
+
+        mediafiles.list_media_page(camera_config, 'picture', callback=on_media_list, prefix=group, sort='time',
+                since=since, until=until)
+
+    return job_id
+
+
+def get_job(job_id):
+    # returns a dict with the progress of the job (-1 when finished), the key of the prepared movie
+    # when ready and the error message if it failed, or None if there's no such job
+    job = _jobs.get(job_id)
+    if job is None:
+        return None
+
+    return {'id': job_id, 'progress': job['progress'], 'key': job['key'], 'error': job['error']}
+
+
+def find_job(camera_id, group):
+    # returns the id of the most recently started job for the given group, or None
+    jobs = [j for j in _jobs.itervalues() if j['camera_id'] == camera_id and j['group'] == group]
+    if not jobs:
+        return None
+
+    return max(jobs, key=lambda j: j['started'])['id']
+
+
+def _select_pictures(timestamps, interval, start=None):
+    # returns the indexes of the pictures closest to the middle of each interval, given their sorted timestamps;
+    # the intervals start at the given start time, or at the first picture
+    if not timestamps:
+        return []
+
+    if start is None:
+        start = timestamps[0]
+
+    count = int(math.ceil((timestamps[-1] - start) / float(interval))) + 1
+
+    if numpy:
+        timestamps = numpy.asarray(timestamps, dtype=numpy.float64)
+        slots = numpy.arange(count, dtype=numpy.float64) * interval + start
+        middles = slots + interval / 2.0
+
+        # the pictures right before and right after the middle of each interval
+        right = numpy.searchsorted(timestamps, middles)
+        left = numpy.maximum(right - 1, 0)
+        right = numpy.minimum(right, len(timestamps) - 1)
+        nearest = numpy.where(numpy.abs(timestamps[left] - middles) <= numpy.abs(timestamps[right] - middles),
+                left, right)
+
+        # intervals without any picture of their own are skipped
+        inside = (timestamps[nearest] >= slots) & (timestamps[nearest] < slots + interval)
+        selected = numpy.unique(nearest[inside]).tolist()
+
+    else:
+        best = {}
+        for (i, timestamp) in enumerate(timestamps):
+            slot = int((timestamp - start) // interval)
+            delta = abs(timestamp - start - (slot + 0.5) * interval)
+            if slot not in best or delta < best[slot][0]:
+                best[slot] = (delta, i)
+
+        selected = [best[slot][1] for slot in sorted(best)]
+
+    logging.debug('selected %d/%d media files' % (len(selected), len(timestamps)))
+
+    return selected
+
+
+def _write_concat_list(path, full_paths, framerate):
+    # pictures are fed to ffmpeg through its concat demuxer, so their number is not limited
+    # by the maximum length of a command line
+    duration = 1.0 / framerate
+    with open(path, 'w') as f:
+        f.write('ffconcat version 1.0\n')
+        for full_path in full_paths:
+            f.write("file '%s'\nduration %.6f\n" % (full_path.replace("'", "'\\''"), duration))
+
+        # the duration of the last file is only taken into account when followed by another entry
+        f.write("file '%s'\n" % full_paths[-1].replace("'", "'\\''"))
+
+
+def _run_next():
+    while _waiting and len(_processes) < settings.TIMELAPSE_JOBS:
+        job = _jobs.get(_waiting.popleft())
+        if job is not None:
+            _start_ffmpeg(job)
+
+
+def _start_ffmpeg(job):
+    camera_config = job.pop('camera_config')
+    full_paths = job.pop('full_paths')
+
+    codec = camera_config.get('ffmpeg_video_codec')
+    codec = mediafiles.FFMPEG_CODEC_MAPPING.get(codec, codec)
+    format = mediafiles.FFMPEG_FORMAT_MAPPING.get(codec, codec)
+
+    job['list_path'] = preparedcache.make_temp_path()
+    job['movie_path'] = preparedcache.make_temp_path()
+    job['frames'] = len(full_paths)
+    job['output'] = collections.deque(maxlen=_OUTPUT_LINES)
+    job['buffer'] = ''
+
+    try:
+        _write_concat_list(job['list_path'], full_paths, job['framerate'])
+
+    except IOError as e:
+        return _finish(job, error='Failed to write the list of pictures: %s.' % e)
+
+    cmd = ['ffmpeg', '-nostdin', '-nostats', '-loglevel', 'error', '-progress', 'pipe:1',
+            '-f', 'concat', '-safe', '0', '-i', job['list_path'],
+            '-r', str(job['framerate']), '-vcodec', codec, '-format', format, '-b:v', str(_BITRATE),
+            '-qscale:v', '0.1', '-f', 'avi', '-y', job['movie_path']]
+
+    logging.debug('timelapse job %(id)s: executing "%(cmd)s"' % {'id': job['id'], 'cmd': ' '.join(cmd)})
+
+    try:
+        process = subprocess.Popen(cmd, stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
+
+    except OSError as e:
+        _remove_file(job['list_path'])
+        return _finish(job, error='Failed to start ffmpeg: %s.' % e)
+
+    _processes[job['id']] = process
+    job['progress'] = 0.01
+
+    # make subprocess stdout pipe non-blocking
+    fd = process.stdout.fileno()
+    fl = fcntl.fcntl(fd, fcntl.F_GETFL)
+    fcntl.fcntl(fd, fcntl.F_SETFL, fl | os.O_NONBLOCK)
+
+    io_loop = IOLoop.instance()
+    io_loop.add_handler(fd, lambda fd, events: _on_output(job, process), IOLoop.READ | IOLoop.ERROR)
+
+    timeout = datetime.timedelta(seconds=settings.TIMELAPSE_TIMEOUT)
+    job['timeout'] = io_loop.add_timeout(timeout, lambda: _on_timeout(job, process))
+
+
+def _on_output(job, process):
+    try:
+        data = os.read(process.stdout.fileno(), 65536)
+
+    except OSError as e:
+        if e.errno == errno.EAGAIN:
+            return
+
+        data = ''
+
+    if not data: # end of output, ffmpeg is exiting
+        io_loop = IOLoop.instance()
+        io_loop.remove_handler(process.stdout.fileno())
+        process.stdout.close()
+
+        return _wait_ffmpeg(job, process)
+
+    # with -progress, ffmpeg writes blocks of key=value lines, each ending with progress=continue or end
+    lines = (job['buffer'] + data).split('\n')
+    job['buffer'] = lines.pop()
+    for line in lines:
+        line = line.strip()
+        (name, sep, value) = line.partition('=')
+        if not sep or ' ' in name: # not a progress line, so probably an error message
+            if line:
+                job['output'].append(line)
+
+            continue
+
+        if name == 'frame':
+            try:
+                frame = int(value)
+
+            except ValueError:
+                continue
+
+            job['progress'] = min(0.99, max(0.01, float(frame) / job['frames']))
+            logging.debug('timelapse job %(id)s progress: %(progress)s' % {
+                    'id': job['id'], 'progress': int(100 * job['progress'])})
+
+
+def _wait_ffmpeg(job, process):
+    exit_code = process.poll()
+    if exit_code is None:
+        io_loop = IOLoop.instance()
+        io_loop.add_timeout(datetime.timedelta(seconds=_POLL_INTERVAL), lambda: _wait_ffmpeg(job, process))
+
+        return
+
+    if _processes.get(job['id']) is not process:
+        return # timed out in the meantime
+
+    del _processes[job['id']]
+    _remove_file(job['list_path'])
+
+    if exit_code != 0:
+        logging.error('timelapse job %(id)s: ffmpeg failed with exit code %(code)s: %(output)s' % {
+                'id': job['id'], 'code': exit_code, 'output': ' '.join(job['output'])})
+
+        _remove_file(job['movie_path'])
+        _finish(job, error='The timelapse movie could not be created.')
+
+    else:
+        try:
+            job['key'] = preparedcache.add_file(job['movie_path'])
+            logging.debug('timelapse movie is ready with key %(key)s' % {'key': job['key']})
+            _finish(job)
+
+        except Exception as e:
+            logging.error('failed to add timelapse movie file "%s" to the prepared files: %s' % (job['movie_path'], e))
+            _finish(job, error='Failed to store the timelapse movie.')
+
+    _run_next()
+
+
+def _on_timeout(job, process):
+    job['timeout'] = None
+    if _processes.get(job['id']) is not process:
+        return
+
+    logging.error('timelapse job %(id)s: timeout waiting for ffmpeg to finish' % {'id': job['id']})
+
+    try:
+        os.kill(process.pid, signal.SIGTERM)
+
+    except:
+        pass # nevermind
+
+    # the output that ffmpeg still writes while exiting isn't needed anymore
+    io_loop = IOLoop.instance()
+    io_loop.remove_handler(process.stdout.fileno())
+    process.stdout.close()
+
+    del _processes[job['id']]
+    _wait_ffmpeg(job, process) # only reaps the process, now that the job is no longer running
+    _remove_file(job['list_path'])
+    _remove_file(job['movie_path'])
+    _finish(job, error='Timeout waiting for the timelapse movie to be created.')
+    _run_next()
+
+
+def _finish(job, error=None):
+    if error:
+        logging.error('timelapse job %(id)s failed: %(error)s' % {'id': job['id'], 'error': error})
+
+    job['progress'] = -1
+    job['error'] = error
+    for name in ['buffer', 'output', 'camera_config', 'full_paths']:
+        job.pop(name, None)
+
+    io_loop = IOLoop.instance()
+    if job.get('timeout'):
+        io_loop.remove_timeout(job['timeout'])
+
+    job['timeout'] = None
+    io_loop.add_timeout(datetime.timedelta(seconds=_KEEP_FINISHED), lambda: _jobs.pop(job['id'], None))
+
+
+def _remove_file(path):
+    try:
+        os.remove(path)
+
+    except OSError:
+        pass
@@ -20,6 +20,7 @@ import datetime
 import functools
 import hashlib
 import logging
+import multiprocessing
 import os
 import re
 import socket
@@ -780,3 +781,88 @@ def urlopen(*args, **kwargs):
         kwargs.setdefault('context', ctx)
 
     return urllib2.urlopen(*args, **kwargs)
+
+
+class ProcessPool(object):
+    # a pool of processes running func(*args) calls and passing their results to callbacks on the IO loop;
+    # the calls that fail, time out (e.g. because their process died) or are still pending
+    # when the pool is terminated are called back with None
+
+    def __init__(self, size):
+        self._pool = multiprocessing.Pool(size, initializer=_init_pool_process)
+        self._pending = {} # (callback, timeout handle) tuples, indexed by call number
+        self._count = 0
+
+    def apply(self, func, args, callback, timeout=None):
+        io_loop = IOLoop.instance()
+        self._count += 1
+        number = self._count
+
+        handle = None
+        if timeout:
+            handle = io_loop.add_timeout(datetime.timedelta(seconds=timeout), self._on_timeout, number, func)
+
+        self._pending[number] = (callback, handle)
+
+        # the pool calls back from one of its own threads
+        self._pool.apply_async(_call_in_pool, (func, args),
+                callback=lambda result: io_loop.add_callback(self._on_result, number, result))
+
+    def terminate(self):
+        pending = self._pending
+        self._pending = {}
+
+        self._pool.terminate()
+        self._pool.join()
+
+        io_loop = IOLoop.instance()
+        for (callback, handle) in pending.itervalues():
+            if handle:
+                io_loop.remove_timeout(handle)
+
+            self._call_back(callback, None)
+
+    def _on_result(self, number, result):
+        entry = self._pending.pop(number, None)
+        if entry is None:
+            return # timed out in the meantime
+
+        (callback, handle) = entry
+        if handle:
+            IOLoop.instance().remove_timeout(handle)
+
+        self._call_back(callback, result)
+
+    def _on_timeout(self, number, func):
+        entry = self._pending.pop(number, None)
+        if entry is None:
+            return
+
+        logging.error('timeout waiting for %(func)s to finish in the process pool' % {'func': func.__name__})
+
+        self._call_back(entry[0], None)
+
+    def _call_back(self, callback, result):
+        try:
+            callback(result)
+
+        except Exception as e:
+            logging.error('process pool callback failed: %(msg)s' % {'msg': unicode(e)}, exc_info=True)
+
+
+def _init_pool_process():
+    import signal
+
+    # the terminate signal is left alone, as it is what terminates the processes of a pool
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+
+
+def _call_in_pool(func, args):
+    # this will be executed in one of the processes of a pool
+    try:
+        return func(*args)
+
+    except Exception as e:
+        logging.error('%(func)s failed: %(msg)s' % {'func': func.__name__, 'msg': unicode(e)}, exc_info=True)
+
+        return None
@@ -0,0 +1,181 @@
+
+# Copyright (c) 2013 Calin Crisan
+# This file is part of motionEye.
+#
+# motionEye is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import struct
+import time
+import zlib
+
+
+CHUNK_SIZE = 64 * 1024 # bytes read from a file at once
+
+_ZIP64_LIMIT = 0xFFFFFFFF
+_ZIP64_COUNT_LIMIT = 0xFFFF
+
+_FLAG_DATA_DESCRIPTOR = 0x08 # crc and sizes follow the file data
+_FLAG_UTF8 = 0x800
+
+_VERSION = 20
+_VERSION_ZIP64 = 45
+_VERSION_MADE_BY = (3 << 8) | _VERSION_ZIP64 # unix
+_EXTERNAL_ATTR = 0100644 << 16 # regular file, rw-r--r--
+
+
+class ZipStream(object):
+    '''Builds a zip archive of stored (uncompressed) entries on the fly,
+    so that it can be sent out without being written anywhere first.
+    The size of the archive is known in advance from the sizes of the files.'''
+
+    def __init__(self, entries):
+        # entries is a list of (full_path, name, size, timestamp) tuples
+        self._entries = [(full_path, _encode_name(name), size, timestamp)
+                for (full_path, name, size, timestamp) in entries]
+        self.size = self._compute_size()
+
+    def chunks(self):
+        # yields the archive in pieces of at most about CHUNK_SIZE bytes;
+        # raises IOError if a file cannot be read or has shrunk in the meantime
+        central = []
+        offset = 0
+        for (full_path, name, size, timestamp) in self._entries:
+            header = _local_header(name, size, timestamp)
+            yield header
+
+            crc = 0
+            remaining = size
+            with open(full_path, 'rb') as f:
+                while remaining:
+                    data = f.read(min(CHUNK_SIZE, remaining))
+                    if not data:
+                        raise IOError('file %s is shorter than expected' % full_path)
+
+                    crc = zlib.crc32(data, crc)
+                    remaining -= len(data)
+                    yield data
+
+            crc &= 0xFFFFFFFF
+            yield _data_descriptor(crc, size)
+
+            central.append(_central_header(name, size, timestamp, crc, offset))
+            offset += len(header) + size + _data_descriptor_length(size)
+
+        central = ''.join(central)
+        yield central
+        yield _end_records(len(self._entries), offset, len(central))
+
+    def _compute_size(self):
+        # headers have the same length regardless of the crc values
+        size = 0
+        central_size = 0
+        for (full_path, name, file_size, timestamp) in self._entries:  # @UnusedVariable
+            central_size += len(_central_header(name, file_size, timestamp, 0, size))
+            size += len(_local_header(name, file_size, timestamp)) + file_size + _data_descriptor_length(file_size)
+
+        return size + central_size + len(_end_records(len(self._entries), size, central_size))
+
+
+def _encode_name(name):
+    if isinstance(name, unicode):
+        name = name.encode('utf8')
+
+    return name
+
+
+def _dos_time(timestamp):
+    t = time.localtime(timestamp)
+    if t.tm_year < 1980:
+        return (0, (1 << 5) | 1) # 1980-01-01 00:00:00
+
+    return ((t.tm_hour << 11) | (t.tm_min << 5) | (t.tm_sec // 2),
+            ((t.tm_year - 1980) << 9) | (t.tm_mon << 5) | t.tm_mday)
+
+
+def _flags(name):
+    flags = _FLAG_DATA_DESCRIPTOR
+    try:
+        name.decode('ascii')
+
+    except UnicodeDecodeError:
+        flags |= _FLAG_UTF8
+
+    return flags
+
+
+def _local_header(name, size, timestamp):
+    (dos_time, dos_date) = _dos_time(timestamp)
+    if size >= _ZIP64_LIMIT:
+        extra = struct.pack('<HHQQ', 1, 16, 0, 0)
+        version = _VERSION_ZIP64
+        size_field = _ZIP64_LIMIT
+
+    else:
+        extra = ''
+        version = _VERSION
+        size_field = 0
+
+    # the crc is not known yet, it will follow in the data descriptor
+    return struct.pack('<IHHHHHIIIHH', 0x04034b50, version, _flags(name), 0, dos_time, dos_date,
+            0, size_field, size_field, len(name), len(extra)) + name + extra
+
+
+def _data_descriptor_length(size):
+    return 24 if size >= _ZIP64_LIMIT else 16
+
+
+def _data_descriptor(crc, size):
+    if size >= _ZIP64_LIMIT:
+        return struct.pack('<IIQQ', 0x08074b50, crc, size, size)
+
+    return struct.pack('<IIII', 0x08074b50, crc, size, size)
+
+
+def _central_header(name, size, timestamp, crc, offset):
+    (dos_time, dos_date) = _dos_time(timestamp)
+    zip64_fields = []
+    if size >= _ZIP64_LIMIT:
+        zip64_fields += [size, size]
+        size = _ZIP64_LIMIT
+
+    if offset >= _ZIP64_LIMIT:
+        zip64_fields.append(offset)
+        offset = _ZIP64_LIMIT
+
+    if zip64_fields:
+        extra = struct.pack('<HH' + 'Q' * len(zip64_fields), 1, 8 * len(zip64_fields), *zip64_fields)
+        version = _VERSION_ZIP64
+
+    else:
+        extra = ''
+        version = _VERSION
+
+    return struct.pack('<IHHHHHHIIIHHHHHII', 0x02014b50, _VERSION_MADE_BY, version, _flags(name), 0,
+            dos_time, dos_date, crc, size, size, len(name), len(extra), 0, 0, 0,
+            _EXTERNAL_ATTR, offset) + name + extra
+
+
+def _end_records(count, central_offset, central_size):
+    records = ''
+    if count >= _ZIP64_COUNT_LIMIT or central_offset >= _ZIP64_LIMIT or central_size >= _ZIP64_LIMIT:
+        zip64_offset = central_offset + central_size
+        records += struct.pack('<IQHHIIQQQQ', 0x06064b50, 44, _VERSION_MADE_BY, _VERSION_ZIP64, 0, 0,
+                count, count, central_size, central_offset)
+        records += struct.pack('<IIQI', 0x07064b50, 0, zip64_offset, 1)
+
+        count = min(count, _ZIP64_COUNT_LIMIT)
+        central_offset = min(central_offset, _ZIP64_LIMIT)
+        central_size = min(central_size, _ZIP64_LIMIT)
+
+    return records + struct.pack('<IHHHHIIH', 0x06054b50, 0, 0, count, count, central_size, central_offset, 0)